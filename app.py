@@ -1,29 +1,52 @@
 # FastAPI関連
-from fastapi import FastAPI, Request, Form
+from fastapi import FastAPI, Request, Form, Depends, Query
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse, Response, HTMLResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.datastructures import Headers
+from starlette.background import BackgroundTask
 
 # 外部ライブラリ
 import yt_dlp
 import openai
 import ffmpeg
-import aiohttp
+import httpx
+import lz4.frame
 import certifi
 import urllib3
-from supabase import create_client, Client
+from postgrest import AsyncPostgrestClient
+from storage3 import AsyncStorageClient
 from dotenv import load_dotenv
 
 # Python標準ライブラリ
 import os
 import ssl
+import sys
 import uuid
 import math
 import json
 import asyncio
+import re
+import base64
+import hashlib
+import hmac
+import ipaddress
+import secrets
+import socket
+import sqlite3
+import threading
+import shutil
+import time
+import gzip
+import html
+import mimetypes
+import zipfile
 from io import BytesIO
+from urllib.parse import urlparse
+from contextlib import asynccontextmanager, contextmanager, AsyncExitStack
 from datetime import datetime, timezone
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, AsyncIterator
 from fastapi import HTTPException
 
 # 環境変数の読み込みと検証を関数化
@@ -40,7 +63,12 @@ def load_environment():
     }
     
     # 必須の環境変数が設定されているか確認
-    missing_vars = [k for k, v in required_vars.items() if not v]
+    # （テーブルとストレージの両方をローカルで動かす場合はSupabaseの設定は不要）
+    uses_supabase = 'supabase' in (os.getenv('DATABASE_BACKEND', 'supabase'), os.getenv('STORAGE_BACKEND', 'supabase'))
+    missing_vars = [
+        k for k, v in required_vars.items()
+        if not v and (uses_supabase or not k.startswith('SUPABASE_'))
+    ]
     if missing_vars:
         raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
     
@@ -63,40 +91,903 @@ except Exception as e:
     print(f"Environment variable error: {str(e)}")
     raise
 
+# 永続化先の設定（supabase / sqlite、supabase / local）
+DATABASE_BACKEND = os.getenv('DATABASE_BACKEND', 'supabase').lower()
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'supabase').lower()
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'data/app.db')
+LOCAL_STORAGE_DIR = os.getenv('LOCAL_STORAGE_DIR', 'data/storage')
+LOCAL_STORAGE_URL = os.getenv('LOCAL_STORAGE_URL', '/local-storage')
+
+if DATABASE_BACKEND not in ('supabase', 'sqlite'):
+    raise ValueError("Invalid DATABASE_BACKEND. Must be one of: supabase, sqlite")
+if STORAGE_BACKEND not in ('supabase', 'local'):
+    raise ValueError("Invalid STORAGE_BACKEND. Must be one of: supabase, local")
+
+# Supabaseの設定
+if 'supabase' in (DATABASE_BACKEND, STORAGE_BACKEND) and (not supabase_url or not supabase_key):
+    raise Exception("Supabase環境変数が設定されていません")
+# サーバーからのテーブル・ストレージの操作にはRLSを通らないservice_roleキーを使う（ブラウザには渡さない）
+# webhooksなどRLSを有効にしてポリシーを置いていないテーブルはこのキーでないと読み書きできない
+supabase_service_key = os.getenv('SUPABASE_SERVICE_ROLE_KEY') or supabase_key
+if 'supabase' in (DATABASE_BACKEND, STORAGE_BACKEND) and not os.getenv('SUPABASE_SERVICE_ROLE_KEY'):
+    print("Warning: SUPABASE_SERVICE_ROLE_KEY is not set; using SUPABASE_KEY for server requests. "
+          "Tables with row level security (webhooks, webhook_deliveries) will not be accessible.")
+# ブラウザのログインに使う公開用のanonキー（サーバー用のキーは渡さない）
+SUPABASE_ANON_KEY = os.getenv('SUPABASE_ANON_KEY')
+
+# zstdはzstandardパッケージがある場合のみ利用可能
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 静的ファイルのbrotli圧縮はbrotliパッケージがある場合のみ
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 音声の特徴量（波形・音量・無音区間）はnumpyがある場合のみ計算する
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# ローカルでの文字起こし（CTranslate2版Whisper）はfaster-whisperパッケージがある場合のみ
+try:
+    from faster_whisper import WhisperModel
+except ImportError:
+    WhisperModel = None
+
+# HTTP/2はh2パッケージがある場合のみ有効化
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# 接続プールの設定（環境変数で調整可能）
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', 20))
+HTTP_MAX_KEEPALIVE = int(os.getenv('HTTP_MAX_KEEPALIVE', 10))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', 60))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 30))
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', 300))
+
+def create_http_client(timeout: float = HTTP_TIMEOUT, **kwargs) -> httpx.AsyncClient:
+    """keep-aliveと接続数上限を設定したhttpxクライアントを作成する"""
+    return httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(timeout, connect=10.0),
+        follow_redirects=True,
+        **kwargs
+    )
+
+# SQLiteのテーブル定義（列名: 型）。JSON列はJSON文字列で保存し、読み出し時に戻す
+SQLITE_TABLES = {
+    'projects': {
+        'id': 'TEXT PRIMARY KEY',
+        'video_url': 'TEXT NOT NULL',
+        'video_path': 'TEXT',
+        'screenshots': 'JSON',
+        'status': "TEXT DEFAULT 'pending'",
+        'error_message': 'TEXT',
+        'metadata': 'JSON',
+        'checkpoints': 'JSON',
+        'lease_owner': 'TEXT',
+        'lease_expires_at': 'TEXT',
+        'attempts': 'INTEGER DEFAULT 0',
+        'user_id': 'TEXT',
+        'created_at': 'TEXT',
+        'updated_at': 'TEXT'
+    },
+    'videos': {
+        'id': 'TEXT PRIMARY KEY',
+        'youtube_id': 'TEXT',
+        'youtube_url': 'TEXT NOT NULL',
+        'video_path': 'TEXT',
+        'transcription': 'TEXT',
+        'transcription_segments': 'JSON',
+        'translation': 'TEXT',
+        'title': 'TEXT',
+        'summary': 'TEXT',
+        'hashtags': 'JSON',
+        'audio_features': 'JSON',
+        'thumbnail_url': 'TEXT',
+        'duration': 'INTEGER',
+        'created_at': 'TEXT',
+        'updated_at': 'TEXT'
+    },
+    'webhooks': {
+        'id': 'TEXT PRIMARY KEY',
+        'user_id': 'TEXT NOT NULL',
+        'url': 'TEXT NOT NULL',
+        'secret': 'TEXT NOT NULL',
+        'created_at': 'TEXT',
+        'updated_at': 'TEXT'
+    },
+    'webhook_deliveries': {
+        'id': 'TEXT PRIMARY KEY',
+        'webhook_id': 'TEXT REFERENCES webhooks(id) ON DELETE CASCADE',
+        'project_id': 'TEXT',
+        'url': 'TEXT NOT NULL',
+        'event': 'JSON',
+        'status': "TEXT DEFAULT 'pending'",
+        'attempts': 'INTEGER DEFAULT 0',
+        'next_attempt_at': 'TEXT',
+        'last_error': 'TEXT',
+        'created_at': 'TEXT',
+        'updated_at': 'TEXT'
+    },
+    'storage_objects': {
+        'id': 'TEXT PRIMARY KEY',
+        'bucket': 'TEXT NOT NULL',
+        'path': 'TEXT NOT NULL',
+        'sha256': 'TEXT NOT NULL',
+        'size': 'INTEGER',
+        'content_type': 'TEXT',
+        'upload_count': 'INTEGER DEFAULT 0',
+        'created_at': 'TEXT',
+        'updated_at': 'TEXT'
+    },
+    'processing_logs': {
+        'id': 'TEXT PRIMARY KEY',
+        'video_id': 'TEXT REFERENCES videos(id)',
+        'status': 'TEXT NOT NULL',
+        'message': 'TEXT',
+        'created_at': 'TEXT'
+    }
+}
+SQLITE_JSON_DEFAULTS = {'screenshots': [], 'metadata': {}, 'checkpoints': {}, 'transcription_segments': [], 'audio_features': None, 'hashtags': [], 'event': {}}
+# 後から追加した列に既存の行の値を埋めるSQL（列を追加したときだけ実行する）
+SQLITE_BACKFILLS = {
+    ('projects', 'user_id'): "UPDATE projects SET user_id = json_extract(metadata, '$.user_id') WHERE json_extract(metadata, '$.user_id') IS NOT NULL"
+}
+SQLITE_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS projects_created_at_id_idx ON projects (created_at DESC, id DESC)',
+    'CREATE INDEX IF NOT EXISTS projects_status_created_at_id_idx ON projects (status, created_at DESC, id DESC)',
+    'CREATE INDEX IF NOT EXISTS projects_status_updated_at_idx ON projects (status, updated_at)',
+    'CREATE INDEX IF NOT EXISTS projects_status_lease_expires_at_idx ON projects (status, lease_expires_at)',
+    'CREATE INDEX IF NOT EXISTS projects_user_id_created_at_id_idx ON projects (user_id, created_at DESC, id DESC)',
+    'CREATE INDEX IF NOT EXISTS videos_created_at_id_idx ON videos (created_at DESC, id DESC)',
+    'CREATE INDEX IF NOT EXISTS videos_youtube_id_idx ON videos (youtube_id)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS storage_objects_bucket_path_idx ON storage_objects (bucket, path)',
+    'CREATE INDEX IF NOT EXISTS webhooks_user_id_idx ON webhooks (user_id)',
+    'CREATE INDEX IF NOT EXISTS webhook_deliveries_status_next_attempt_at_idx ON webhook_deliveries (status, next_attempt_at)'
+]
+
+# 文字起こし・翻訳の全文検索（FTS5のtrigramトークナイザは日本語も分かち書きなしで検索できる）
+# videosの書き込み時にトリガーでセグメント単位のインデックスを差分更新する
+SQLITE_FTS_INDEX_ROWS = """
+    INSERT INTO videos_fts (text, video_id, field, start_time, end_time)
+    SELECT json_extract(value, '$.text'), NEW.id, 'transcription', json_extract(value, '$.start'), json_extract(value, '$.end')
+    FROM json_each(COALESCE(NEW.transcription_segments, '[]'));
+    INSERT INTO videos_fts (text, video_id, field, start_time, end_time)
+    SELECT NEW.transcription, NEW.id, 'transcription', NULL, NULL
+    WHERE NEW.transcription IS NOT NULL AND json_array_length(COALESCE(NEW.transcription_segments, '[]')) = 0;
+    INSERT INTO videos_fts (text, video_id, field, start_time, end_time)
+    SELECT NEW.translation, NEW.id, 'translation', NULL, NULL
+    WHERE NEW.translation IS NOT NULL;
+"""
+SQLITE_FTS = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS videos_fts USING fts5(
+        text, video_id UNINDEXED, field UNINDEXED, start_time UNINDEXED, end_time UNINDEXED,
+        tokenize='trigram'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS videos_fts_insert AFTER INSERT ON videos BEGIN
+        {SQLITE_FTS_INDEX_ROWS}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS videos_fts_update
+    AFTER UPDATE OF transcription, transcription_segments, translation ON videos BEGIN
+        DELETE FROM videos_fts WHERE video_id = OLD.id;
+        {SQLITE_FTS_INDEX_ROWS}
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS videos_fts_delete AFTER DELETE ON videos BEGIN
+        DELETE FROM videos_fts WHERE video_id = OLD.id;
+    END"""
+]
+
+class SQLiteQuery:
+    """PostgRESTのクエリビルダーと同じ書き方で使えるSQLiteのクエリ"""
+
+    OPERATORS = {'eq': '=', 'neq': '!=', 'lt': '<', 'lte': '<=', 'gt': '>', 'gte': '>='}
+
+    def __init__(self, db: 'SQLiteTables', table: str):
+        self.db = db
+        self.table = table
+        self.columns = SQLITE_TABLES[table]
+        self.action = 'select'
+        self.fields = '*'
+        self.payload = None
+        self.filters = []
+        self.params = []
+        self.ordering = []
+        self.row_limit = None
+
+    def select(self, fields: str = '*', count: Optional[str] = None):
+        self.action = 'select'
+        self.fields = fields
+        return self
+
+    def insert(self, data):
+        self.action = 'insert'
+        self.payload = data if isinstance(data, list) else [data]
+        return self
+
+    def update(self, data: Dict):
+        self.action = 'update'
+        self.payload = data
+        return self
+
+    def delete(self):
+        self.action = 'delete'
+        return self
+
+    def _column(self, column: str) -> str:
+        if column not in self.columns:
+            raise ValueError(f"Unknown column '{column}' for table '{self.table}'")
+        return f'"{column}"'
+
+    def _filter(self, column: str, operator: str, value):
+        self.filters.append(f'{self._column(column)} {operator} ?')
+        self.params.append(self.db.encode(column, value))
+        return self
+
+    @staticmethod
+    def _split_conditions(text: str) -> List[str]:
+        """括弧と引用符の外側にあるカンマで分割する"""
+        parts, depth, quoted, current = [], 0, False, ''
+        for char in text:
+            if char == '"':
+                quoted = not quoted
+            elif not quoted and char == '(':
+                depth += 1
+            elif not quoted and char == ')':
+                depth -= 1
+            elif not quoted and depth == 0 and char == ',':
+                parts.append(current)
+                current = ''
+                continue
+            current += char
+        if current:
+            parts.append(current)
+        return parts
+
+    def _logic(self, text: str, joiner: str):
+        clauses, params = [], []
+        for item in self._split_conditions(text):
+            group = re.fullmatch(r'(and|or)\((.*)\)', item, re.S)
+            if group:
+                clause, values = self._logic(group.group(2), group.group(1).upper())
+            else:
+                column, operator, value = item.split('.', 2)
+                if len(value) >= 2 and value[0] == value[-1] == '"':
+                    value = value[1:-1]
+                if operator == 'is':
+                    clause = f"{self._column(column)} IS {'NULL' if value == 'null' else 'NOT NULL'}"
+                    values = []
+                else:
+                    clause = f'{self._column(column)} {self.OPERATORS[operator]} ?'
+                    values = [self.db.encode(column, value)]
+            clauses.append(clause)
+            params.extend(values)
+        return f"({f' {joiner} '.join(clauses)})", params
+
+    def or_(self, filters: str):
+        """PostgRESTのor構文（col.op.value と and(...) の組み合わせ）"""
+        clause, params = self._logic(filters, 'OR')
+        self.filters.append(clause)
+        self.params.extend(params)
+        return self
+
+    def eq(self, column: str, value):
+        return self._filter(column, '=', value)
+
+    def neq(self, column: str, value):
+        return self._filter(column, '!=', value)
+
+    def lt(self, column: str, value):
+        return self._filter(column, '<', value)
+
+    def lte(self, column: str, value):
+        return self._filter(column, '<=', value)
+
+    def gt(self, column: str, value):
+        return self._filter(column, '>', value)
+
+    def gte(self, column: str, value):
+        return self._filter(column, '>=', value)
+
+    def is_(self, column: str, value):
+        self.filters.append(f'{self._column(column)} IS NULL' if value in (None, 'null') else f'{self._column(column)} IS NOT NULL')
+        return self
+
+    def in_(self, column: str, values: list):
+        values = list(values)
+        self.filters.append(f'{self._column(column)} IN ({", ".join("?" for _ in values)})' if values else '0')
+        self.params.extend(self.db.encode(column, v) for v in values)
+        return self
+
+    def order(self, column: str, desc: bool = False):
+        self.ordering.append(f'{self._column(column)} {"DESC" if desc else "ASC"}')
+        return self
+
+    def limit(self, size: int):
+        self.row_limit = size
+        return self
+
+    def _where(self) -> str:
+        return f" WHERE {' AND '.join(self.filters)}" if self.filters else ''
+
+    def _select_sql(self) -> str:
+        fields = '*' if self.fields.strip() == '*' else ', '.join(
+            self._column(f.strip()) for f in self.fields.split(',') if f.strip()
+        )
+        sql = f'SELECT {fields} FROM "{self.table}"{self._where()}'
+        if self.ordering:
+            sql += f" ORDER BY {', '.join(self.ordering)}"
+        if self.row_limit is not None:
+            sql += f" LIMIT {int(self.row_limit)}"
+        return sql
+
+    async def execute(self):
+        return SQLiteResult(self.db.run(self))
+
+class SQLiteRPC:
+    """PostgRESTのrpc()と同じ書き方でSQLite側の関数を呼び出す"""
+
+    def __init__(self, db: 'SQLiteTables', name: str, params: Dict):
+        self.db = db
+        self.name = name
+        self.params = params
+
+    async def execute(self):
+        return SQLiteResult(getattr(self.db, SQLITE_RPC[self.name])(**self.params))
+
+# rpc名とSQLiteTablesのメソッドの対応
+SQLITE_RPC = {'search_videos': 'search_videos', 'register_storage_object': 'register_storage_object'}
+
+class SQLiteResult:
+    def __init__(self, data: List[Dict]):
+        self.data = data
+        self.count = None
+
+def like_pattern(text: str) -> str:
+    """LIKEの部分一致用のパターン（ESCAPE '\\' で使う）"""
+    return '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def like_snippet(text: str, search_query: str, width: int = 32) -> str:
+    """一致した箇所の前後を切り出し、<mark>で強調したスニペットを作る"""
+    start = text.lower().find(search_query.lower())
+    if start < 0:
+        return html.escape(text[:width * 2])
+    end = start + len(search_query)
+    prefix = '…' if start > width else ''
+    suffix = '…' if end + width < len(text) else ''
+    return (prefix + html.escape(text[max(start - width, 0):start])
+            + '<mark>' + html.escape(text[start:end]) + '</mark>'
+            + html.escape(text[end:end + width]) + suffix)
+
+class SQLiteTables:
+    """projects / videos / processing_logs をローカルのSQLite（WALモード）に保存する"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        self.migrate()
+
+    def migrate(self):
+        """テーブルを作成し、後から追加された列を足す"""
+        with self.lock:
+            for table, columns in SQLITE_TABLES.items():
+                definition = ', '.join(f'"{name}" {kind}' for name, kind in columns.items())
+                self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ({definition})')
+                existing = {row['name'] for row in self.conn.execute(f'PRAGMA table_info("{table}")')}
+                for name, kind in columns.items():
+                    if name not in existing:
+                        self.conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{name}" {kind.replace("PRIMARY KEY", "")}')
+                        if (table, name) in SQLITE_BACKFILLS:
+                            self.conn.execute(SQLITE_BACKFILLS[(table, name)])
+            for statement in SQLITE_INDEXES:
+                self.conn.execute(statement)
+            try:
+                for statement in SQLITE_FTS:
+                    self.conn.execute(statement)
+                self.fts_enabled = True
+            except sqlite3.OperationalError as e:
+                # FTS5やtrigramが使えないSQLiteではLIKE検索にフォールバックする
+                print(f"Debug: SQLite full-text search unavailable: {str(e)}")
+                self.fts_enabled = False
+
+    def rpc(self, name: str, params: Optional[Dict] = None) -> 'SQLiteRPC':
+        if name not in SQLITE_RPC:
+            raise ValueError(f"Unknown function '{name}'")
+        return SQLiteRPC(self, name, params or {})
+
+    def register_storage_object(self, p_bucket: str, p_path: str, p_sha256: str, p_size: int, p_content_type: str) -> List[Dict]:
+        """ストレージのオブジェクトを登録し、登録回数を1つ増やす"""
+        now = datetime.now(timezone.utc).isoformat()
+        with self.lock:
+            rows = self.conn.execute(
+                """INSERT INTO storage_objects (id, bucket, path, sha256, size, content_type, upload_count, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?)
+                   ON CONFLICT (bucket, path) DO UPDATE SET upload_count = upload_count + 1, updated_at = excluded.updated_at
+                   RETURNING *""",
+                [str(uuid.uuid4()), p_bucket, p_path, p_sha256, p_size, p_content_type, now, now]
+            ).fetchall()
+            return [dict(row) for row in rows]
+
+    def search_videos(self, search_query: str, result_limit: int = 20) -> List[Dict]:
+        """文字起こし・翻訳をセグメント単位で検索し、動画ごとにまとめてスコア順に返す"""
+        with self.lock:
+            # trigramは3文字未満の語に使えないため、短い語はLIKEで検索する
+            if self.fts_enabled and len(search_query) >= 3:
+                phrase = '"' + search_query.replace('"', '""') + '"'
+                hits = self.conn.execute(
+                    """SELECT video_id, field, start_time, end_time, text, bm25(videos_fts) AS rank
+                       FROM videos_fts WHERE videos_fts MATCH ? ORDER BY rank LIMIT ?""",
+                    [phrase, result_limit * 20]
+                ).fetchall()
+            elif self.fts_enabled:
+                hits = self.conn.execute(
+                    """SELECT video_id, field, start_time, end_time, text, -1.0 AS rank
+                       FROM videos_fts WHERE text LIKE ? ESCAPE '\\' LIMIT ?""",
+                    [like_pattern(search_query), result_limit * 20]
+                ).fetchall()
+            else:
+                # FTS5がない場合は動画全体の文字起こし・翻訳をLIKEで検索する（時刻は分からない）
+                rows = self.conn.execute(
+                    """SELECT id AS video_id, 'transcription' AS field, transcription AS text FROM videos
+                       WHERE transcription LIKE ?1 ESCAPE '\\'
+                       UNION ALL
+                       SELECT id AS video_id, 'translation' AS field, translation AS text FROM videos
+                       WHERE translation LIKE ?1 ESCAPE '\\'
+                       LIMIT ?2""",
+                    [like_pattern(search_query), result_limit * 2]
+                ).fetchall()
+                hits = [{
+                    'video_id': row['video_id'],
+                    'field': row['field'],
+                    'start_time': None,
+                    'end_time': None,
+                    'text': row['text'],
+                    'rank': -1.0
+                } for row in rows]
+
+            results = {}
+            for hit in hits:
+                result = results.setdefault(hit['video_id'], {'video_id': hit['video_id'], 'score': 0.0, 'matches': []})
+                # bm25は小さいほど関連度が高いので符号を反転して合計する
+                result['score'] += -hit['rank']
+                result['matches'].append({
+                    'field': hit['field'],
+                    'start': hit['start_time'],
+                    'end': hit['end_time'],
+                    'text': hit['text']
+                })
+
+            ranked = sorted(results.values(), key=lambda r: r['score'], reverse=True)[:result_limit]
+            if not ranked:
+                return []
+            ids = [r['video_id'] for r in ranked]
+            videos = {
+                row['id']: row for row in self.conn.execute(
+                    f'SELECT id, youtube_id, youtube_url, thumbnail_url FROM videos WHERE id IN ({", ".join("?" for _ in ids)})', ids
+                )
+            }
+            for result in ranked:
+                video = videos.get(result['video_id'])
+                if video:
+                    result.update(youtube_id=video['youtube_id'], youtube_url=video['youtube_url'], thumbnail_url=video['thumbnail_url'])
+            return ranked
+
+    def table(self, name: str) -> SQLiteQuery:
+        return SQLiteQuery(self, name)
+
+    def encode(self, column: str, value):
+        if column in SQLITE_JSON_DEFAULTS and value is not None:
+            return json.dumps(value, ensure_ascii=False)
+        if isinstance(value, bool):
+            return int(value)
+        return value
+
+    def decode(self, row: sqlite3.Row) -> Dict:
+        data = dict(row)
+        for column in SQLITE_JSON_DEFAULTS:
+            if isinstance(data.get(column), str):
+                data[column] = json.loads(data[column])
+        return data
+
+    def run(self, query: SQLiteQuery) -> List[Dict]:
+        with self.lock:
+            if query.action == 'select':
+                rows = self.conn.execute(query._select_sql(), query.params).fetchall()
+                return [self.decode(row) for row in rows]
+
+            if query.action == 'insert':
+                now = datetime.now(timezone.utc).isoformat()
+                ids = []
+                for item in query.payload:
+                    row = {'id': str(uuid.uuid4()), **item}
+                    for column in ('created_at', 'updated_at'):
+                        if column in query.columns and not row.get(column):
+                            row[column] = now
+                    for column, default in SQLITE_JSON_DEFAULTS.items():
+                        if column in query.columns and row.get(column) is None:
+                            row[column] = default
+                    names = ', '.join(f'"{k}"' for k in row)
+                    self.conn.execute(
+                        f'INSERT INTO "{query.table}" ({names}) VALUES ({", ".join("?" for _ in row)})',
+                        [self.encode(k, v) for k, v in row.items()]
+                    )
+                    ids.append(row['id'])
+                return self._fetch_ids(query.table, ids)
+
+            where = query._where()
+            if query.action == 'update':
+                # 別プロセスと同時に更新した場合も実際に更新した行だけを返す（ジョブの確保に使う）
+                assignments = ', '.join(f'"{k}" = ?' for k in query.payload)
+                ids = [row['id'] for row in self.conn.execute(
+                    f'UPDATE "{query.table}" SET {assignments}{where} RETURNING id',
+                    [self.encode(k, v) for k, v in query.payload.items()] + query.params
+                ).fetchall()]
+                return self._fetch_ids(query.table, ids)
+
+            ids = [row['id'] for row in self.conn.execute(f'SELECT id FROM "{query.table}"{where}', query.params)]
+            rows = self._fetch_ids(query.table, ids)
+            self.conn.execute(f'DELETE FROM "{query.table}"{where}', query.params)
+            return rows
+
+    def _fetch_ids(self, table: str, ids: List[str]) -> List[Dict]:
+        if not ids:
+            return []
+        rows = self.conn.execute(
+            f'SELECT * FROM "{table}" WHERE id IN ({", ".join("?" for _ in ids)})', ids
+        ).fetchall()
+        by_id = {row['id']: self.decode(row) for row in rows}
+        return [by_id[i] for i in ids if i in by_id]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class LocalBucket:
+    """ストレージのバケットをローカルのディレクトリとして扱う"""
+
+    def __init__(self, root: str, base_url: str, bucket: str):
+        self.directory = os.path.join(root, bucket)
+        self.base_url = f"{base_url}/{bucket}"
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, path: str) -> str:
+        full_path = os.path.normpath(os.path.join(self.directory, path))
+        if not full_path.startswith(os.path.normpath(self.directory) + os.sep):
+            raise ValueError(f"Invalid storage path: {path}")
+        return full_path
+
+    async def upload(self, path: str, file, file_options: Optional[Dict] = None):
+        full_path = self._path(path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        if isinstance(file, (bytes, bytearray)):
+            with open(full_path, 'wb') as f:
+                f.write(file)
+        else:
+            shutil.copyfile(file, full_path)
+        return {'path': path}
+
+    async def upload_stream(self, path: str, chunks: AsyncIterator[bytes]):
+        full_path = self._path(path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as f:
+            async for chunk in chunks:
+                f.write(chunk)
+        return {'path': path}
+
+    async def exists(self, path: str) -> bool:
+        return os.path.exists(self._path(path))
+
+    async def move(self, from_path: str, to_path: str):
+        full_path = self._path(to_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        os.replace(self._path(from_path), full_path)
+        return {'message': 'Successfully moved'}
+
+    async def download(self, path: str) -> bytes:
+        with open(self._path(path), 'rb') as f:
+            return f.read()
+
+    async def remove(self, paths: List[str]):
+        for path in paths:
+            if os.path.exists(self._path(path)):
+                os.remove(self._path(path))
+        return [{'name': path} for path in paths]
+
+    async def get_public_url(self, path: str) -> str:
+        return f"{self.base_url}/{path}"
+
+class LocalStorage:
+    """Supabase Storageの代わりにローカルのファイルシステムへ保存する"""
+
+    def __init__(self, root: str, base_url: str):
+        self.root = root
+        self.base_url = base_url.rstrip('/')
+        os.makedirs(root, exist_ok=True)
+
+    def from_(self, bucket: str) -> LocalBucket:
+        return LocalBucket(self.root, self.base_url, bucket)
+
+class ClientPool:
+    """Supabase（PostgREST / Storage）とOpenAIの非同期クライアントをまとめて保持する
+
+    PostgRESTとStorageは同じホストなので1つのhttpxクライアントを共有し、
+    ジョブ内の細かいリクエストでTLSセッションとHTTP/2接続を使い回す。
+    """
+
+    def __init__(self):
+        if supabase_url:
+            print(f"Debug: Initializing Supabase client with URL: {supabase_url}")
+            print(f"Debug: Using key starting with: {supabase_service_key[:10]}...")
+        print(f"Debug: HTTP/2 enabled: {HTTP2_AVAILABLE}")
+
+        headers = {
+            'apikey': supabase_service_key,
+            'Authorization': f"Bearer {supabase_service_key}"
+        }
+        self.supabase_headers = headers
+        # Auth・ストリーミングアップロードなど絶対URLで送るリクエスト用
+        self.supabase_http = create_http_client()
+        # postgrest・storage3は渡したクライアントのbase_urlを書き換える版があるため、それぞれ専用のクライアントを渡す
+        self.postgrest_http = create_http_client()
+        self.storage_http = create_http_client()
+
+        # テーブル（PostgREST または SQLite）
+        if DATABASE_BACKEND == 'sqlite':
+            print(f"Debug: Using SQLite database at {SQLITE_PATH}")
+            self.rest = SQLiteTables(SQLITE_PATH)
+        else:
+            self.rest = AsyncPostgrestClient(
+                f"{supabase_url}/rest/v1",
+                headers=headers,
+                http_client=self.postgrest_http
+            )
+
+        # ストレージ（Supabase Storage または ローカルのディレクトリ）
+        if STORAGE_BACKEND == 'local':
+            print(f"Debug: Using local storage at {LOCAL_STORAGE_DIR}")
+            self.storage = LocalStorage(LOCAL_STORAGE_DIR, LOCAL_STORAGE_URL)
+        else:
+            self.storage = AsyncStorageClient(
+                f"{supabase_url}/storage/v1",
+                headers=headers,
+                http_client=self.storage_http
+            )
+
+        self.openai_http = create_http_client(timeout=OPENAI_TIMEOUT)
+        self.openai = openai.AsyncOpenAI(
+            api_key=env_vars['OPENAI_API_KEY'],
+            http_client=self.openai_http
+        )
+
+        # 外部サイト（動画の取得など）向けの汎用クライアント
+        self.http = create_http_client()
+
+    async def aclose(self):
+        if isinstance(self.rest, SQLiteTables):
+            self.rest.close()
+        await asyncio.gather(
+            self.supabase_http.aclose(),
+            self.postgrest_http.aclose(),
+            self.storage_http.aclose(),
+            self.openai_http.aclose(),
+            self.http.aclose(),
+            return_exceptions=True
+        )
+
+_client_pool: Optional[ClientPool] = None
+
+def get_clients() -> ClientPool:
+    """共有クライアントプールを返す（lifespan外で呼ばれた場合は遅延生成する）"""
+    global _client_pool
+    if _client_pool is None:
+        _client_pool = ClientPool()
+        print("Supabase connection established")
+    return _client_pool
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 起動時にクライアントプールを作成し、終了時に接続を閉じる
+    global _client_pool
+    get_clients()
+    cleanup_stale_partials()
+    cleanup_media_cache()
+    if PROFILE_NEXT_JOBS:
+        profiler.arm(jobs=PROFILE_NEXT_JOBS)
+    # 前回のプロセスで中断されたジョブをバックグラウンドで再開（queueモードではワーカーが担当）
+    recovery_task = asyncio.create_task(recover_stuck_jobs()) if RECOVER_STUCK_JOBS and JOB_MODE == 'inline' else None
+    # ローカルの文字起こしを使う場合は最初のジョブを待たせないよう先にモデルを読み込む
+    if TRANSCRIPTION_BACKEND == 'local':
+        await asyncio.to_thread(get_local_whisper_model)
+    # クォータの集計を復元し、定期的に保存する
+    usage_quota.load()
+    quota_task = asyncio.create_task(persist_usage_quota())
+    # 完了・エラーのWebhookを配信する（queueモードのワーカーでも同じものが動く）
+    webhook_task = asyncio.create_task(run_webhook_dispatcher()) if WEBHOOK_DISPATCHER else None
+    cleanup_task = asyncio.create_task(cleanup_caches_periodically())
+    try:
+        yield
+    finally:
+        cleanup_task.cancel()
+        await asyncio.gather(cleanup_task, return_exceptions=True)
+        if webhook_task:
+            webhook_task.cancel()
+            await asyncio.gather(webhook_task, return_exceptions=True)
+        if recovery_task:
+            recovery_task.cancel()
+            await asyncio.gather(recovery_task, return_exceptions=True)
+        quota_task.cancel()
+        await asyncio.gather(quota_task, return_exceptions=True)
+        try:
+            usage_quota.save()
+        except Exception as e:
+            print(f"Failed to save quota usage: {str(e)}")
+        if _client_pool is not None:
+            await _client_pool.aclose()
+            _client_pool = None
+
 # FastAPIアプリケーションの作成
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+# 静的ファイル・レスポンス圧縮の設定
+STATIC_DIR = 'static'
+# Vercelなどでは/tmp以外に書き込めないため、圧縮版は/tmpに作る
+STATIC_CACHE_DIR = os.getenv('STATIC_CACHE_DIR', '/tmp/static-cache')
+STATIC_COMPRESS_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt', '.html', '.ico', '.map')
+STATIC_IMMUTABLE_MAX_AGE = int(os.getenv('STATIC_IMMUTABLE_MAX_AGE', 31536000))
+GZIP_MIN_SIZE = int(os.getenv('GZIP_MIN_SIZE', 1024))
+# 動画など既に圧縮済みのレスポンスを返すパスはgzipしない
+GZIP_SKIP_PREFIXES = [LOCAL_STORAGE_URL]
+GZIP_SKIP_SUFFIXES = ['/export', '/media']
+TEMPLATE_CACHE = os.getenv('TEMPLATE_CACHE', 'true').lower() == 'true'
+TEMPLATE_CACHE_SIZE = 32
+
+def build_static_manifest(static_dir: str = STATIC_DIR, cache_dir: str = STATIC_CACHE_DIR) -> Dict[str, Dict]:
+    """静的ファイルのハッシュを計算し、gzip/brotli圧縮版を事前に作成する
+
+    圧縮版を書き込めない場合はその形式を省き、圧縮していないファイルをそのまま配信する。
+    """
+    manifest = {}
+    for root, _, files in os.walk(static_dir):
+        for name in files:
+            file_path = os.path.join(root, name)
+            rel_path = os.path.relpath(file_path, static_dir)
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            entry = {'hash': hashlib.sha256(data).hexdigest()[:12], 'encodings': {}}
+            if name.lower().endswith(STATIC_COMPRESS_EXTENSIONS):
+                encoders = [('gzip', '.gz', lambda b: gzip.compress(b, compresslevel=9, mtime=0))]
+                if brotli is not None:
+                    encoders.insert(0, ('br', '.br', lambda b: brotli.compress(b, quality=11)))
+                for encoding, suffix, compress in encoders:
+                    # ファイル名にハッシュを含め、内容が変わったときだけ作り直す
+                    target = os.path.join(cache_dir, f"{rel_path}.{entry['hash']}{suffix}")
+                    if not os.path.exists(target):
+                        compressed = compress(data)
+                        if len(compressed) >= len(data):
+                            continue
+                        try:
+                            os.makedirs(os.path.dirname(target), exist_ok=True)
+                            with open(f"{target}.tmp", 'wb') as f:
+                                f.write(compressed)
+                            os.replace(f"{target}.tmp", target)
+                        except OSError as e:
+                            print(f"Failed to write precompressed static file {target}: {str(e)}")
+                            continue
+                    entry['encodings'][encoding] = target
+            manifest[rel_path] = entry
+    print(f"Debug: Static manifest built for {len(manifest)} files")
+    return manifest
+
+STATIC_MANIFEST = build_static_manifest()
+
+def static_url(path: str) -> str:
+    """内容ハッシュ付きの静的ファイルURLを返す（テンプレートから利用）"""
+    entry = STATIC_MANIFEST.get(os.path.normpath(path))
+    return f"/static/{path}?v={entry['hash']}" if entry else f"/static/{path}"
+
+class PrecompressedStaticFiles(StaticFiles):
+    """事前圧縮したファイルをAccept-Encodingに応じて返し、ハッシュ付きURLは長期キャッシュさせる"""
+
+    async def get_response(self, path: str, scope) -> Response:
+        entry = STATIC_MANIFEST.get(path)
+        request_headers = Headers(scope=scope)
+        response = None
+        if entry and scope['method'] in ('GET', 'HEAD'):
+            accept_encoding = request_headers.get('accept-encoding', '')
+            for encoding, target in entry['encodings'].items():
+                if encoding in accept_encoding:
+                    response = FileResponse(
+                        target,
+                        media_type=mimetypes.guess_type(path)[0] or 'application/octet-stream',
+                        headers={'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'},
+                        stat_result=os.stat(target)
+                    )
+                    if self.is_not_modified(response.headers, request_headers):
+                        response = Response(status_code=304, headers={
+                            k: v for k, v in response.headers.items()
+                            if k in ('etag', 'vary', 'content-encoding')
+                        })
+                    break
+        if response is None:
+            response = await super().get_response(path, scope)
+
+        query = scope.get('query_string', b'').decode()
+        if entry and f"v={entry['hash']}" in query.split('&'):
+            response.headers['Cache-Control'] = f'public, max-age={STATIC_IMMUTABLE_MAX_AGE}, immutable'
+        else:
+            response.headers['Cache-Control'] = 'public, no-cache'
+        return response
+
+class SelectiveGZipMiddleware(GZipMiddleware):
+    """GZIP_SKIP_PREFIXES / GZIP_SKIP_SUFFIXES に該当するパス以外のレスポンスをgzip圧縮する"""
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] == 'http' and (scope['path'].startswith(tuple(GZIP_SKIP_PREFIXES))
+                                        or scope['path'].endswith(tuple(GZIP_SKIP_SUFFIXES))):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+# /process などの文字起こし全文を含むJSONを圧縮して返す
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=GZIP_MIN_SIZE)
 
 # 静的ファイルのマウント
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", PrecompressedStaticFiles(directory=STATIC_DIR), name="static")
+
+# ローカルストレージを使う場合は保存したファイルを配信する
+if STORAGE_BACKEND == 'local':
+    os.makedirs(LOCAL_STORAGE_DIR, exist_ok=True)
+    app.mount(LOCAL_STORAGE_URL, StaticFiles(directory=LOCAL_STORAGE_DIR), name="local-storage")
 
 # テンプレートの設定
 templates = Jinja2Templates(directory="templates")
+templates.env.globals['static_url'] = static_url
 
-# Supabaseの設定
-supabase_url = supabase_url
-supabase_key = supabase_key
+# 設定値ごとにレンダリング済みのindex.htmlを保持する
+_index_cache: Dict[tuple, tuple] = {}
 
-if not supabase_url or not supabase_key:
-    raise Exception("Supabase環境変数が設定されていません")
+def index_config(request: Request) -> Dict:
+    return {
+        "SUPABASE_URL": os.getenv("SUPABASE_URL"),
+        "SUPABASE_ANON_KEY": SUPABASE_ANON_KEY,
+        "SITE_URL": os.getenv("NEXT_PUBLIC_SITE_URL", str(request.base_url).rstrip('/'))
+    }
 
-# Supabaseクライアントの初期化時のデバッグ部分を修正
-try:
-    print(f"Debug: Initializing Supabase client with URL: {supabase_url}")
-    print(f"Debug: Using key starting with: {supabase_key[:10]}...")
-    
-    supabase: Client = create_client(
-        supabase_url,
-        supabase_key
-    )
-    
-    # 接続テストを削除（この部分が問題を引き起こしている）
-    # test = supabase.table('projects').select("*").limit(1).execute()
-    # print(f"Debug: Connection test result: {test}")
-    
-    print("Supabase connection established")
-except Exception as e:
-    print(f"Debug: Supabase initialization error: {str(e)}")
-    raise
+def render_index(request: Request) -> Response:
+    """index.htmlを設定値をキーにキャッシュして返す（ETagが一致すれば304）"""
+    config = index_config(request)
+    key = tuple(sorted(config.items()))
+    cached = _index_cache.get(key) if TEMPLATE_CACHE else None
+    if cached is None:
+        body = templates.get_template("index.html").render(config=config).encode()
+        cached = (body, f'"{hashlib.sha1(body).hexdigest()}"')
+        if TEMPLATE_CACHE:
+            if len(_index_cache) >= TEMPLATE_CACHE_SIZE:
+                _index_cache.pop(next(iter(_index_cache)))
+            _index_cache[key] = cached
+    body, etag = cached
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if etag in [tag.strip() for tag in request.headers.get('if-none-match', '').split(',')]:
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(content=body, headers=headers)
 
 # SSL証明書の設定を更新
 import os
@@ -116,23 +1007,657 @@ SCREENSHOT_DIR = f"{TEMP_DIR}/screenshots"
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 os.makedirs(SCREENSHOT_DIR, exist_ok=True)
 
-def get_yt_dlp_opts():
-    cookies_path = '/tmp/cookies.txt'
-    
-    # 環境変数からクッキーを取得して一時ファイルに保存
-    if os.getenv('YOUTUBE_COOKIES'):
-        print(f"Debug: Writing cookies to {cookies_path}")  # デバッグ用
-        with open(cookies_path, 'w') as f:
-            f.write(os.getenv('YOUTUBE_COOKIES'))
-        print(f"Debug: Cookies file exists: {os.path.exists(cookies_path)}")  # デバッグ用
-    
+# リソース種別ごとの同時実行数（jobは/processで同時に処理するジョブ数）
+RESOURCE_LIMITS = {
+    'job': int(os.getenv('MAX_ACTIVE_JOBS', 4)),
+    'download': int(os.getenv('LIMIT_DOWNLOADS', 4)),
+    'encode': int(os.getenv('LIMIT_ENCODES', os.cpu_count() or 2)),
+    'openai': int(os.getenv('LIMIT_OPENAI', 4)),
+    'upload': int(os.getenv('LIMIT_UPLOADS', 8)),
+    # ローカルの文字起こしは1件でCPUの全コアを使うので既定では1件ずつ
+    'transcribe': int(os.getenv('LIMIT_LOCAL_TRANSCRIBE', 1))
+}
+# 待ち行列の上限（超えた場合は429を返す）。Noneは無制限
+RESOURCE_MAX_WAITING = {
+    'job': int(os.getenv('MAX_QUEUED_JOBS', 16))
+}
+
+# ジョブの優先度クラス（先頭ほど優先）と、待ちすぎを防ぐための上限秒数
+PRIORITY_CLASSES = ('interactive', 'batch')
+STARVATION_SECONDS = int(os.getenv('STARVATION_SECONDS', 120))
+
+class ResourceBusy(Exception):
+    """待ち行列が一杯でリソースを確保できない場合の例外"""
+
+    def __init__(self, resource: str, retry_after: int):
+        super().__init__(f"Resource '{resource}' is saturated")
+        self.resource = resource
+        self.retry_after = retry_after
+
+class ResourceGovernor:
+    """リソース種別ごとに同時実行数を制限し、待ち行列の長さを監視する
+
+    空きが出たときの割り当て順:
+      1. STARVATION_SECONDS 以上待っている待ち（先に並んだ順）
+      2. 優先度クラス（interactive → batch）
+      3. 実行中の件数が少ない利用者（owner）
+      4. 処理時間の見積もり（cost）が短いもの（shortest-job-first）
+      5. 最後に割り当ててから長く経っているowner、先に並んだ順
+    owner・priority・costを指定しない場合は単純な先着順になる。
+    """
+
+    def __init__(self, limits: Dict[str, int], max_waiting: Dict[str, int]):
+        self.limits = limits
+        self.max_waiting = max_waiting
+        self.active = {name: 0 for name in limits}
+        self.active_by_owner: Dict[str, Dict[Optional[str], int]] = {name: {} for name in limits}
+        self.waiters: Dict[str, List[Dict]] = {name: [] for name in limits}
+        self.sequence = 0
+        # ownerごとの最後に割り当てた順番（同数のときは長く待たされているownerを優先）
+        self.last_grant: Dict[str, Dict[str, int]] = {name: {} for name in limits}
+        # 保持時間の指数移動平均（Retry-Afterの見積もりに使う）
+        self.average_hold = {name: 30.0 for name in limits}
+
+    def retry_after(self, resource: str) -> int:
+        queued = len(self.waiters[resource]) + 1
+        return max(1, math.ceil(self.average_hold[resource] * queued / self.limits[resource]))
+
+    def _take(self, resource: str, owner: Optional[str]):
+        self.active[resource] += 1
+        counts = self.active_by_owner[resource]
+        counts[owner] = counts.get(owner, 0) + 1
+        if owner is not None:
+            self.sequence += 1
+            last_grant = self.last_grant[resource]
+            last_grant[owner] = self.sequence
+            if len(last_grant) > 1000:
+                waiting_owners = {w['owner'] for w in self.waiters[resource]}
+                for stale in [o for o in last_grant if o not in counts and o not in waiting_owners]:
+                    del last_grant[stale]
+
+    def _release(self, resource: str, owner: Optional[str]):
+        self.active[resource] -= 1
+        counts = self.active_by_owner[resource]
+        counts[owner] -= 1
+        if not counts[owner]:
+            del counts[owner]
+        self._grant_next(resource)
+
+    def _order(self, resource: str, now: float):
+        counts = self.active_by_owner[resource]
+        last_grant = self.last_grant[resource]
+
+        def key(waiter: Dict):
+            # 待ちすぎた場合は優先度やcostに関係なく先に並んだ順で処理する
+            if now - waiter['enqueued'] >= STARVATION_SECONDS:
+                return (0, waiter['seq'])
+            return (
+                1,
+                PRIORITY_CLASSES.index(waiter['priority']),
+                counts.get(waiter['owner'], 0),
+                waiter['cost'],
+                last_grant.get(waiter['owner'], 0),
+                waiter['seq']
+            )
+        return key
+
+    def _grant_next(self, resource: str):
+        waiters = self.waiters[resource]
+        while waiters and self.active[resource] < self.limits[resource]:
+            waiter = min(waiters, key=self._order(resource, time.monotonic()))
+            waiters.remove(waiter)
+            if waiter['future'].done():
+                continue
+            self._take(resource, waiter['owner'])
+            waiter['future'].set_result(True)
+
+    @asynccontextmanager
+    async def acquire(self, resource: str, owner: Optional[str] = None, priority: str = 'interactive', cost: float = 0):
+        if self.active[resource] >= self.limits[resource] or self.waiters[resource]:
+            max_waiting = self.max_waiting.get(resource)
+            if max_waiting is not None and len(self.waiters[resource]) >= max_waiting:
+                raise ResourceBusy(resource, self.retry_after(resource))
+
+            self.sequence += 1
+            waiter = {
+                'seq': self.sequence,
+                'owner': owner,
+                'priority': priority,
+                'cost': cost,
+                'enqueued': time.monotonic(),
+                'future': asyncio.get_running_loop().create_future()
+            }
+            self.waiters[resource].append(waiter)
+            try:
+                await waiter['future']
+            except asyncio.CancelledError:
+                if waiter in self.waiters[resource]:
+                    self.waiters[resource].remove(waiter)
+                elif waiter['future'].done() and not waiter['future'].cancelled():
+                    # 割り当て済みの枠は次の待ちに回す
+                    self._release(resource, owner)
+                raise
+        else:
+            self._take(resource, owner)
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(resource, owner)
+            elapsed = time.monotonic() - started
+            self.average_hold[resource] = self.average_hold[resource] * 0.8 + elapsed * 0.2
+
+    def stats(self) -> Dict:
+        now = time.monotonic()
+        return {
+            name: {
+                'limit': self.limits[name],
+                'active': self.active[name],
+                'waiting': len(self.waiters[name]),
+                'waiting_by_priority': {
+                    priority: len([w for w in self.waiters[name] if w['priority'] == priority])
+                    for priority in PRIORITY_CLASSES
+                },
+                'oldest_wait_seconds': round(max([now - w['enqueued'] for w in self.waiters[name]], default=0), 1),
+                'owners': len([owner for owner in self.active_by_owner[name] if owner is not None])
+            }
+            for name in self.limits
+        }
+
+governor = ResourceGovernor(RESOURCE_LIMITS, RESOURCE_MAX_WAITING)
+
+# 認証・レート制限・1日あたりの処理時間クォータ
+SUPABASE_JWT_SECRET = os.getenv('SUPABASE_JWT_SECRET')
+AUTH_REQUIRED = os.getenv('AUTH_REQUIRED', 'false').lower() == 'true'
+AUTH_CACHE_SECONDS = int(os.getenv('AUTH_CACHE_SECONDS', 60))
+RATE_LIMIT_PER_MINUTE = float(os.getenv('RATE_LIMIT_PER_MINUTE', 6))
+RATE_LIMIT_BURST = int(os.getenv('RATE_LIMIT_BURST', 3))
+# 0は無制限
+DAILY_QUOTA_MINUTES = float(os.getenv('DAILY_QUOTA_MINUTES', 30))
+QUOTA_STATE_PATH = os.getenv('QUOTA_STATE_PATH', '/tmp/quotas.json')
+QUOTA_PERSIST_INTERVAL = int(os.getenv('QUOTA_PERSIST_INTERVAL', 60))
+# X-Forwarded-Forを信頼するプロキシのIPアドレス・CIDR（カンマ区切り、*はすべて）。空なら接続元のIPを使う
+# Vercelなどプロキシの後ろで動かす場合に設定しないと、未ログインの利用者が全員同じ集計単位になる
+TRUSTED_PROXIES = [proxy.strip() for proxy in os.getenv('TRUSTED_PROXIES', '').split(',') if proxy.strip()]
+# /admin/* を利用できるユーザーID（カンマ区切り）
+ADMIN_USER_IDS = {user_id.strip() for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if user_id.strip()}
+# <video>から読み込む /projects/{id}/media の署名付きURL（Authorizationヘッダーを送れないため）
+# 未設定ならSUPABASE_JWT_SECRETを使う。どちらもなければプロセスごとの乱数になり、
+# 別のワーカープロセスや再起動後のプロセスでは署名を検証できないため起動時に警告する
+MEDIA_URL_SECRET = os.getenv('MEDIA_URL_SECRET') or SUPABASE_JWT_SECRET
+if not MEDIA_URL_SECRET:
+    print("Warning: neither MEDIA_URL_SECRET nor SUPABASE_JWT_SECRET is set; signed media URLs use a per-process "
+          "random key and fail in other worker processes or after a restart. Set MEDIA_URL_SECRET.")
+    MEDIA_URL_SECRET = secrets.token_hex(32)
+MEDIA_URL_TTL = int(os.getenv('MEDIA_URL_TTL', 3600))
+
+def b64url_decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+def verify_supabase_jwt(token: str) -> Dict:
+    """SupabaseのJWT（HS256）を署名・有効期限・audienceで検証してペイロードを返す"""
+    try:
+        header_b64, payload_b64, signature_b64 = token.split('.')
+        header = json.loads(b64url_decode(header_b64))
+        payload = json.loads(b64url_decode(payload_b64))
+        signature = b64url_decode(signature_b64)
+    except Exception:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+    if header.get('alg') != 'HS256':
+        raise HTTPException(status_code=401, detail="Unsupported token algorithm")
+    expected = hmac.new(SUPABASE_JWT_SECRET.encode(), f"{header_b64}.{payload_b64}".encode(), hashlib.sha256).digest()
+    if not hmac.compare_digest(signature, expected):
+        raise HTTPException(status_code=401, detail="Invalid token signature")
+    if payload.get('exp', 0) < time.time():
+        raise HTTPException(status_code=401, detail="Token expired")
+    audience = payload.get('aud')
+    if 'authenticated' not in (audience if isinstance(audience, list) else [audience]):
+        raise HTTPException(status_code=401, detail="Invalid token audience")
+    if not payload.get('sub'):
+        raise HTTPException(status_code=401, detail="Invalid token subject")
+    return payload
+
+# JWTシークレットがない場合に Supabase Auth へ問い合わせた結果のキャッシュ
+_auth_cache: Dict[str, tuple] = {}
+
+async def fetch_supabase_user(token: str, clients: ClientPool) -> Dict:
+    """Supabase Auth の /auth/v1/user でトークンを検証する（結果は短時間キャッシュ）"""
+    cache_key = hashlib.sha256(token.encode()).hexdigest()
+    cached = _auth_cache.get(cache_key)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+
+    response = await clients.supabase_http.get(
+        f"{supabase_url}/auth/v1/user",
+        headers={'apikey': supabase_key, 'Authorization': f"Bearer {token}"}
+    )
+    if response.status_code != 200:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    user = response.json()
+    payload = {'sub': user['id'], 'email': user.get('email')}
+
+    # 期限切れのエントリを掃除してから保存
+    now = time.monotonic()
+    for key in [key for key, (_, expires) in _auth_cache.items() if expires <= now]:
+        del _auth_cache[key]
+    _auth_cache[cache_key] = (payload, now + AUTH_CACHE_SECONDS)
+    return payload
+
+async def get_current_user(request: Request, clients: ClientPool = Depends(get_clients)) -> Optional[Dict]:
+    """Authorizationヘッダーのトークンを検証し、ログイン中のユーザーを返す（未ログインはNone）"""
+    authorization = request.headers.get('authorization', '')
+    if not authorization.lower().startswith('bearer '):
+        if AUTH_REQUIRED:
+            raise HTTPException(status_code=401, detail="ログインが必要です")
+        return None
+
+    token = authorization[7:].strip()
+    if SUPABASE_JWT_SECRET:
+        payload = verify_supabase_jwt(token)
+    elif supabase_url and supabase_key:
+        payload = await fetch_supabase_user(token, clients)
+    else:
+        raise HTTPException(status_code=401, detail="認証が設定されていません")
+    return {'id': payload['sub'], 'email': payload.get('email')}
+
+def check_project_access(project: Dict, user: Optional[Dict]):
+    """ログインして作ったプロジェクトは本人（と管理者）だけが見られる（他人には存在も見せない）"""
+    owner = decode_json_field(project.get('metadata'), {}).get('user_id')
+    if owner and not (user and (user['id'] == owner or user['id'] in ADMIN_USER_IDS)):
+        raise HTTPException(status_code=404, detail="Project not found")
+
+def media_url_signature(project_id: str, expires: int) -> str:
+    return hmac.new(MEDIA_URL_SECRET.encode(), f"{project_id}.{expires}".encode(), hashlib.sha256).hexdigest()
+
+def signed_media_url(project_id: str) -> str:
+    """MEDIA_URL_TTL秒だけ有効な /projects/{id}/media のURL"""
+    expires = int(time.time()) + MEDIA_URL_TTL
+    return f"/projects/{project_id}/media?expires={expires}&signature={media_url_signature(project_id, expires)}"
+
+async def require_admin(user: Optional[Dict] = Depends(get_current_user)) -> Dict:
+    if not user or user['id'] not in ADMIN_USER_IDS:
+        raise HTTPException(status_code=403, detail="管理者のみ利用できます")
+    return user
+
+def is_trusted_proxy(host: Optional[str]) -> bool:
+    if not host or not TRUSTED_PROXIES:
+        return False
+    if '*' in TRUSTED_PROXIES:
+        return True
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    for proxy in TRUSTED_PROXIES:
+        try:
+            if address in ipaddress.ip_network(proxy, strict=False):
+                return True
+        except ValueError:
+            continue
+    return False
+
+def client_ip(request: Request) -> str:
+    """利用者のIPアドレス（信頼するプロキシからの接続ならX-Forwarded-Forの先頭を使う）"""
+    host = request.client.host if request.client else None
+    if is_trusted_proxy(host):
+        forwarded = request.headers.get('x-forwarded-for', '').split(',')[0].strip()
+        if forwarded:
+            return forwarded
+    return host or 'unknown'
+
+def usage_key(request: Request, user: Optional[Dict]) -> str:
+    """レート制限・クォータの集計単位（ログイン中はユーザーID、未ログインはIPアドレス）"""
+    if user:
+        return f"user:{user['id']}"
+    return f"ip:{client_ip(request)}"
+
+class TokenBucketLimiter:
+    """キーごとのトークンバケットでリクエスト頻度を制限する"""
+
+    def __init__(self, rate_per_minute: float, burst: int):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        # key -> [残りトークン, 最終更新時刻]
+        self.buckets: Dict[str, list] = {}
+
+    def take(self, key: str) -> Optional[int]:
+        """トークンを1つ消費する。足りない場合は再試行までの秒数を返す"""
+        if self.rate <= 0:
+            return None
+        now = time.monotonic()
+        self.prune(now)
+        tokens, updated = self.buckets.get(key, [self.burst, now])
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = [tokens, now]
+            return max(1, math.ceil((1 - tokens) / self.rate))
+        self.buckets[key] = [tokens - 1, now]
+        return None
+
+    def prune(self, now: float):
+        # 満タンまで回復したバケットは保持する必要がない
+        full_after = self.burst / self.rate
+        if len(self.buckets) > 1000:
+            for key in [key for key, (_, updated) in self.buckets.items() if now - updated >= full_after]:
+                del self.buckets[key]
+
+class QuotaExceeded(Exception):
+    """1日あたりの処理時間クォータを超えた場合の例外"""
+
+    def __init__(self, remaining_seconds: float, retry_after: int):
+        super().__init__("Daily processing quota exceeded")
+        self.remaining_seconds = remaining_seconds
+        self.retry_after = retry_after
+
+class UsageQuota:
+    """キーごとの1日（UTC）あたりの処理秒数をメモリで集計し、定期的にファイルへ保存する"""
+
+    def __init__(self, daily_minutes: float, state_path: str):
+        self.daily_seconds = daily_minutes * 60
+        self.state_path = state_path
+        # key -> {'day': 'YYYY-MM-DD', 'seconds': float}
+        self.usage: Dict[str, Dict] = {}
+        self.dirty = False
+
+    @staticmethod
+    def today() -> str:
+        return datetime.now(timezone.utc).strftime('%Y-%m-%d')
+
+    def used(self, key: str) -> float:
+        entry = self.usage.get(key)
+        return entry['seconds'] if entry and entry['day'] == self.today() else 0.0
+
+    def reserve(self, key: str, seconds: float):
+        """処理予定の秒数を計上する（超える場合はQuotaExceeded）"""
+        used = self.used(key)
+        if self.daily_seconds > 0 and used + seconds > self.daily_seconds:
+            now = datetime.now(timezone.utc)
+            seconds_until_reset = 86400 - (now.hour * 3600 + now.minute * 60 + now.second)
+            raise QuotaExceeded(max(0.0, self.daily_seconds - used), seconds_until_reset)
+        self.usage[key] = {'day': self.today(), 'seconds': used + seconds}
+        self.dirty = True
+
+    def refund(self, key: str, seconds: float):
+        if key in self.usage and self.usage[key]['day'] == self.today():
+            self.usage[key]['seconds'] = max(0.0, self.usage[key]['seconds'] - seconds)
+            self.dirty = True
+
+    def load(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            today = self.today()
+            self.usage = {key: entry for key, entry in state.items() if entry.get('day') == today}
+            print(f"Debug: Loaded quota usage for {len(self.usage)} keys")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Failed to load quota usage: {str(e)}")
+
+    def save(self):
+        if not self.dirty:
+            return
+        today = self.today()
+        state = {key: entry for key, entry in self.usage.items() if entry['day'] == today}
+        os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+        temp_path = f"{self.state_path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.state_path)
+        self.usage = state
+        self.dirty = False
+
+rate_limiter = TokenBucketLimiter(RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST)
+usage_quota = UsageQuota(DAILY_QUOTA_MINUTES, QUOTA_STATE_PATH)
+
+# 一度に確認するエラー終了したqueueジョブの件数
+QUOTA_REFUND_BATCH_SIZE = 200
+
+async def refund_failed_queue_jobs(clients: ClientPool):
+    """queueモードでエラーに終わったジョブのクォータを返す
+
+    ジョブはワーカーの別プロセスで失敗するため、クォータを持つWebサーバー側で
+    エラーのプロジェクトを拾って返す。quota_refundedを立てる更新をupdated_atの条件付きで行い、
+    複数のWebサーバーから二重に返さないようにする。クォータは日ごとなので直近24時間分だけ見る。
+    """
+    since = datetime.fromtimestamp(time.time() - 86400, timezone.utc).isoformat()
+    response = await clients.rest.table('projects') \
+        .select('id,metadata,updated_at') \
+        .eq('status', 'error') \
+        .gte('updated_at', since) \
+        .order('updated_at', desc=True) \
+        .limit(QUOTA_REFUND_BATCH_SIZE) \
+        .execute()
+    for project in response.data or []:
+        metadata = project.get('metadata') or {}
+        if not metadata.get('quota_key') or not metadata.get('quota_seconds') or metadata.get('quota_refunded'):
+            continue
+        updated = await clients.rest.table('projects') \
+            .update({
+                'metadata': {**metadata, 'quota_refunded': True},
+                'updated_at': datetime.now(timezone.utc).isoformat()
+            }) \
+            .eq('id', project['id']) \
+            .eq('updated_at', project['updated_at']) \
+            .execute()
+        if updated.data:
+            usage_quota.refund(metadata['quota_key'], metadata['quota_seconds'])
+            print(f"Debug: Refunded {metadata['quota_seconds']}s of quota for failed project {project['id']}")
+
+async def persist_usage_quota():
+    """クォータの集計を定期的にファイルへ書き出す（queueモードでは失敗したジョブの分を先に返す）"""
+    while True:
+        await asyncio.sleep(QUOTA_PERSIST_INTERVAL)
+        if JOB_MODE == 'queue':
+            try:
+                await refund_failed_queue_jobs(get_clients())
+            except Exception as e:
+                print(f"Failed to refund quota for failed jobs: {str(e)}")
+        try:
+            usage_quota.save()
+        except Exception as e:
+            print(f"Failed to save quota usage: {str(e)}")
+
+# 処理中のチェックポイントに一時的に持つ文字起こし・セグメントの圧縮: none / lz4 / zstd
+# videosの文字起こし・翻訳は検索インデックス（PGroonga / FTS5）が直接読むため圧縮しない。
+# PostgresはTOASTで大きなjsonbを既に圧縮しており、base64にした圧縮データはかえって大きくなるので
+# 既定ではSQLiteの場合だけ圧縮する
+TEXT_COMPRESSION = os.getenv('TEXT_COMPRESSION', 'lz4' if DATABASE_BACKEND == 'sqlite' else 'none').lower()
+TEXT_COMPRESSION_MIN_BYTES = int(os.getenv('TEXT_COMPRESSION_MIN_BYTES', 1024))
+if TEXT_COMPRESSION == 'zstd' and zstandard is None:
+    print("Debug: zstandard is not installed, falling back to lz4")
+    TEXT_COMPRESSION = 'lz4'
+if TEXT_COMPRESSION not in ('none', 'lz4', 'zstd'):
+    raise ValueError("Invalid TEXT_COMPRESSION. Must be one of: none, lz4, zstd")
+COMPRESSED_TEXT_PREFIXES = {'lz4': 'lz4+b64:', 'zstd': 'zstd+b64:'}
+COMPRESSED_CHECKPOINT_KEYS = ('transcription', 'translation', 'segments')
+JSON_CHECKPOINT_KEYS = ('segments',)
+
+# 停止したジョブの再開設定
+RECOVER_STUCK_JOBS = os.getenv('RECOVER_STUCK_JOBS', 'true').lower() == 'true'
+# この秒数以上更新のないpending/processingのプロジェクトを停止したとみなす
+JOB_STALE_SECONDS = int(os.getenv('JOB_STALE_SECONDS', 900))
+RECOVERY_BATCH_SIZE = int(os.getenv('RECOVERY_BATCH_SIZE', 20))
+
+# ジョブの実行方法: inline（/processの中で実行）/ queue（projectsを待ち行列としてworker.pyが実行）
+JOB_MODE = os.getenv('JOB_MODE', 'inline').lower()
+if JOB_MODE not in ('inline', 'queue'):
+    raise ValueError("Invalid JOB_MODE. Must be one of: inline, queue")
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', RESOURCE_LIMITS['job']))
+WORKER_POLL_SECONDS = float(os.getenv('WORKER_POLL_SECONDS', 2))
+WORKER_SHUTDOWN_GRACE = int(os.getenv('WORKER_SHUTDOWN_GRACE', 30))
+# リースの有効期間（この間にハートビートがなければ他のワーカーが再取得する）
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', 60))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 3))
+JOB_CLAIM_SCAN = int(os.getenv('JOB_CLAIM_SCAN', 50))
+
+# 完了・エラー時のWebhook通知
+# リクエストごとのwebhook_urlへの通知はWEBHOOK_SECRETで署名する（未設定ならwebhook_urlは指定できない）
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_DISPATCHER = os.getenv('WEBHOOK_DISPATCHER', 'true').lower() == 'true'
+WEBHOOK_TIMEOUT = float(os.getenv('WEBHOOK_TIMEOUT', 10))
+WEBHOOK_POLL_SECONDS = float(os.getenv('WEBHOOK_POLL_SECONDS', 5))
+# 通知を受けてから送信するまでに同じ宛先のイベントをまとめる時間（秒）と1回に送る最大件数
+WEBHOOK_BATCH_WINDOW = float(os.getenv('WEBHOOK_BATCH_WINDOW', 1))
+WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', 50))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 8))
+WEBHOOK_RETRY_BASE = float(os.getenv('WEBHOOK_RETRY_BASE', 10))
+WEBHOOK_RETRY_MAX = float(os.getenv('WEBHOOK_RETRY_MAX', 60 * 60))
+WEBHOOK_CLAIM_SCAN = int(os.getenv('WEBHOOK_CLAIM_SCAN', 200))
+# trueにするとループバック・プライベートアドレスへのWebhookを許可する（ローカルでの開発用）
+WEBHOOK_ALLOW_PRIVATE = os.getenv('WEBHOOK_ALLOW_PRIVATE', 'false').lower() == 'true'
+
+# サンプリングプロファイラ（/admin/profiler で有効にしたジョブだけスタックを採取する）
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'data/profiles')
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', 5))
+PROFILE_MAX_DEPTH = int(os.getenv('PROFILE_MAX_DEPTH', 128))
+# 起動時に次のN件のジョブを計測する（別プロセスのワーカーを計測する場合に使う）
+PROFILE_NEXT_JOBS = int(os.getenv('PROFILE_NEXT_JOBS', 0))
+
+# ダウンロードの設定
+YTDLP_CONCURRENT_FRAGMENTS = int(os.getenv('YTDLP_CONCURRENT_FRAGMENTS', 4))
+YTDLP_HTTP_CHUNK_SIZE = int(os.getenv('YTDLP_HTTP_CHUNK_SIZE', 10 * 1024 * 1024))
+YTDLP_RETRIES = int(os.getenv('YTDLP_RETRIES', 10))
+YTDLP_SOCKET_TIMEOUT = float(os.getenv('YTDLP_SOCKET_TIMEOUT', 30))
+# 詳細ログ（本番では無効にして警告とエラーだけを出力する）
+YTDLP_VERBOSE = os.getenv('YTDLP_VERBOSE', 'false').lower() == 'true'
+# オプションの組み合わせごとに使い回すYoutubeDLインスタンスの上限
+YTDLP_POOL_SIZE = int(os.getenv('YTDLP_POOL_SIZE', 4))
+# クッキー: YOUTUBE_COOKIES（内容）か YOUTUBE_COOKIES_FILE（ファイル）のどちらか
+YOUTUBE_COOKIES_PATH = '/tmp/cookies.txt'
+# ジョブ単位の再試行回数（.partファイルから再開する）
+DOWNLOAD_ATTEMPTS = int(os.getenv('DOWNLOAD_ATTEMPTS', 3))
+# 失敗したジョブのダウンロード（.partファイルとダウンロード済みのファイル）を残しておく時間（秒）
+DOWNLOAD_PARTIAL_TTL = int(os.getenv('DOWNLOAD_PARTIAL_TTL', 6 * 60 * 60))
+
+# プレビュー配信用の動画キャッシュ（moovアトムを先頭に移したMP4をプロジェクトごとに保持する）
+# Vercelなどでは/tmp以外に書き込めないため既定は/tmpに置く
+MEDIA_CACHE_DIR = os.getenv('MEDIA_CACHE_DIR', '/tmp/media-cache')
+MEDIA_CACHE_TTL = int(os.getenv('MEDIA_CACHE_TTL', 24 * 60 * 60))
+MEDIA_FASTSTART = os.getenv('MEDIA_FASTSTART', 'true').lower() == 'true'
+# 期限切れのダウンロード・プレビュー用キャッシュを削除する間隔（秒）
+CACHE_CLEANUP_INTERVAL = int(os.getenv('CACHE_CLEANUP_INTERVAL', 60 * 60))
+
+# ストリーミングパイプラインの設定
+# 有効にするとダウンロード中のバイト列をStorageとffmpegに同時に流し、/tmpへの書き出しを省く
+STREAMING_PIPELINE = os.getenv('STREAMING_PIPELINE', 'false').lower() == 'true'
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 1024 * 1024))
+STREAM_QUEUE_SIZE = int(os.getenv('STREAM_QUEUE_SIZE', 8))
+
+# スクリーンショットの出力設定
+SCREENSHOT_FORMATS = {
+    'webp': {'ext': '.webp', 'content_type': 'image/webp'},
+    'avif': {'ext': '.avif', 'content_type': 'image/avif'},
+    'jpg': {'ext': '.jpg', 'content_type': 'image/jpeg'}
+}
+SCREENSHOT_FORMAT = os.getenv('SCREENSHOT_FORMAT', 'webp').lower()
+if SCREENSHOT_FORMAT not in SCREENSHOT_FORMATS:
+    raise ValueError(f"Invalid SCREENSHOT_FORMAT. Must be one of: {', '.join(SCREENSHOT_FORMATS)}")
+SCREENSHOT_QUALITY = int(os.getenv('SCREENSHOT_QUALITY', 80))
+# レスポンシブ用の縮小幅（例: "320,640"）。空なら元サイズのみ
+SCREENSHOT_WIDTHS = [int(w) for w in os.getenv('SCREENSHOT_WIDTHS', '320,640').split(',') if w.strip()]
+# 動画を保存しない場合にスクリーンショット用として取得する映像の最大の高さ
+SCREENSHOT_SOURCE_HEIGHT = int(os.getenv('SCREENSHOT_SOURCE_HEIGHT', 720))
+
+# 音声の特徴量の設定（波形の点数・RMSの窓幅・無音とみなす音量と長さ）
+AUDIO_FEATURES = os.getenv('AUDIO_FEATURES', 'true').lower() == 'true'
+if AUDIO_FEATURES and np is None:
+    print("Debug: numpy is not installed, audio features are disabled")
+    AUDIO_FEATURES = False
+AUDIO_FEATURE_SAMPLE_RATE = int(os.getenv('AUDIO_FEATURE_SAMPLE_RATE', 16000))
+WAVEFORM_POINTS = int(os.getenv('WAVEFORM_POINTS', 800))
+RMS_FRAME_SECONDS = float(os.getenv('RMS_FRAME_SECONDS', 0.05))
+SILENCE_THRESHOLD_DB = float(os.getenv('SILENCE_THRESHOLD_DB', -40))
+SILENCE_MIN_SECONDS = float(os.getenv('SILENCE_MIN_SECONDS', 0.3))
+
+class YtDlpLogger:
+    """yt-dlpのログのうち、詳細ログが無効なときは警告とエラーだけを出力する"""
+
+    def debug(self, message: str):
+        if YTDLP_VERBOSE:
+            print(message)
+
+    def info(self, message: str):
+        if YTDLP_VERBOSE:
+            print(message)
+
+    def warning(self, message: str):
+        print(f"yt-dlp: {message}")
+
+    def error(self, message: str):
+        print(f"yt-dlp: {message}")
+
+class CookieJar:
+    """YouTubeのクッキーファイルを用意し、内容が変わったときだけ書き直す"""
+
+    def __init__(self, path: str = YOUTUBE_COOKIES_PATH):
+        self.path = path
+        self.signature = None
+        self.lock = threading.Lock()
+
+    def source_signature(self) -> Optional[str]:
+        if os.getenv('YOUTUBE_COOKIES_FILE'):
+            try:
+                stat = os.stat(os.getenv('YOUTUBE_COOKIES_FILE'))
+                return f"file:{stat.st_mtime_ns}:{stat.st_size}"
+            except FileNotFoundError:
+                return None
+        if os.getenv('YOUTUBE_COOKIES'):
+            return f"env:{hashlib.sha256(os.getenv('YOUTUBE_COOKIES').encode()).hexdigest()}"
+        return None
+
+    @staticmethod
+    def to_netscape(cookies: str) -> str:
+        """「SID=xxx; HSID=yyy」形式の場合はyt-dlpが読めるNetscape形式に変換する"""
+        if cookies.lstrip().startswith('#') or '\t' in cookies:
+            return cookies
+        lines = ['# Netscape HTTP Cookie File']
+        for pair in cookies.split(';'):
+            name, _, value = pair.strip().partition('=')
+            if name:
+                lines.append('\t'.join(['.youtube.com', 'TRUE', '/', 'TRUE', '2147483647', name, value]))
+        return '\n'.join(lines) + '\n'
+
+    def refresh(self) -> Optional[str]:
+        """クッキーファイルのパスを返す（クッキーがなければNone）"""
+        with self.lock:
+            signature = self.source_signature()
+            if signature is None:
+                self.signature = None
+                return None
+            if signature != self.signature or not os.path.exists(self.path):
+                if os.getenv('YOUTUBE_COOKIES_FILE'):
+                    shutil.copyfile(os.getenv('YOUTUBE_COOKIES_FILE'), self.path)
+                else:
+                    with open(self.path, 'w') as f:
+                        f.write(self.to_netscape(os.getenv('YOUTUBE_COOKIES')))
+                print(f"Debug: Cookies file refreshed at {self.path}")
+                self.signature = signature
+            return self.path
+
+cookie_jar = CookieJar()
+
+def get_yt_dlp_opts(format_selector: str = 'best[ext=mp4]', outtmpl: str = f'{DOWNLOAD_DIR}/%(id)s.%(ext)s'):
     return {
-        'format': 'best[ext=mp4]',
-        'outtmpl': f'{DOWNLOAD_DIR}/%(id)s.%(ext)s',
-        'quiet': False,  # デバッグのため出力を有効化
-        'no_warnings': False,  # デバッグのため警告を表示
-        'cookies': cookies_path,
-        'verbose': True,  # 詳細なログを出力
+        'format': format_selector,
+        'outtmpl': outtmpl,
+        'quiet': not YTDLP_VERBOSE,
+        'no_warnings': False,
+        'verbose': YTDLP_VERBOSE,
+        'logger': YtDlpLogger(),
+        'noprogress': not YTDLP_VERBOSE,
+        'cookiefile': cookie_jar.refresh(),
+        # ダウンロードの並列化・再試行・途中からの再開
+        'concurrent_fragment_downloads': YTDLP_CONCURRENT_FRAGMENTS,
+        'http_chunk_size': YTDLP_HTTP_CHUNK_SIZE,
+        'retries': YTDLP_RETRIES,
+        'fragment_retries': YTDLP_RETRIES,
+        'file_access_retries': 3,
+        'socket_timeout': YTDLP_SOCKET_TIMEOUT,
+        'continuedl': True,
+        'nopart': False,
         'extractor_args': {
             'youtube': {
                 'player_client': ['android'],
@@ -140,16 +1665,177 @@ def get_yt_dlp_opts():
         }
     }
 
-def save_to_markdown(video_id: str, url: str, transcription: str, translation: str):
-    """結果をMarkdownファイルとして保存する"""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"/tmp/outputs/{video_id}_{timestamp}.md"  # /tmp に変更
-    
-    content = f"""# YouTube 文字起こし & 翻訳結果
+class YoutubeDLPool:
+    """オプションの組み合わせ（プロファイル）ごとに初期化済みのYoutubeDLを使い回す
+
+    YoutubeDLはスレッドセーフではないので、1つのインスタンスは同時に1つの
+    スレッドだけが使う。クッキーが更新された場合は古いインスタンスを破棄する。
+    """
+
+    def __init__(self, size: int = YTDLP_POOL_SIZE):
+        self.size = size
+        self.idle: Dict[tuple, List] = {}
+        self.lock = threading.Lock()
+        self.created = 0
+
+    @contextmanager
+    def acquire(self, format_selector: str = 'best[ext=mp4]', outtmpl: str = f'{DOWNLOAD_DIR}/%(id)s.%(ext)s'):
+        cookie_jar.refresh()
+        key = (format_selector, outtmpl, cookie_jar.signature)
+        with self.lock:
+            idle = self.idle.get(key)
+            ydl = idle.pop() if idle else None
+        if ydl is None:
+            ydl = yt_dlp.YoutubeDL(get_yt_dlp_opts(format_selector, outtmpl))
+            self.created += 1
+
+        reusable = False
+        try:
+            yield ydl
+            reusable = True
+        finally:
+            with self.lock:
+                # クッキーが変わっていたら古いプロファイルをまとめて破棄する
+                stale = [ydl for k in list(self.idle) if k[2] != cookie_jar.signature for ydl in self.idle.pop(k)]
+                idle = self.idle.setdefault(key, [])
+                if reusable and key[2] == cookie_jar.signature and len(idle) < self.size:
+                    idle.append(ydl)
+                else:
+                    stale.append(ydl)
+            for old in stale:
+                self.discard(old)
+
+    @staticmethod
+    def discard(ydl):
+        # closeで古いクッキーが新しいクッキーファイルに書き戻されないようにする
+        ydl.params['cookiefile'] = None
+        ydl.close()
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                'created': self.created,
+                'idle': sum(len(idle) for idle in self.idle.values()),
+                'profiles': len(self.idle)
+            }
+
+ydl_pool = YoutubeDLPool()
+
+def plan_download_formats(store_video: bool, num_screenshots: int, transcribe: bool = True) -> Dict:
+    """要求された出力を満たす最小のフォーマットを選ぶ
+
+    動画を保存する場合のみ音声付きのMP4を取得し、それ以外は文字起こし用の
+    音声のみと、スクリーンショット用の低解像度の映像のみを別々に取得する。
+    """
+    if store_video:
+        return {'store_video': True, 'formats': {'video': 'best[ext=mp4]'}}
+
+    formats = {}
+    if transcribe:
+        formats['audio'] = 'worstaudio[ext=m4a]/worstaudio[ext=webm]/worstaudio/worst'
+    if num_screenshots > 0:
+        height = SCREENSHOT_SOURCE_HEIGHT
+        formats['video'] = (
+            f"bestvideo[height<={height}][ext=mp4]/bestvideo[height<={height}]"
+            f"/best[height<={height}]/worst"
+        )
+    return {'store_video': False, 'formats': formats}
+
+def download_format(youtube_url: str, format_selector: str, suffix: str = '') -> str:
+    """指定したフォーマットをダウンロードし、保存先のパスを返す
+
+    ファイル名に動画IDとformat_idを含めているので、失敗したジョブを
+    再実行すると同じ.partファイルから続きをダウンロードできる。
+    """
+    outtmpl = f'{DOWNLOAD_DIR}/%(id)s{suffix}.%(format_id)s.%(ext)s'
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        try:
+            with ydl_pool.acquire(format_selector, outtmpl) as ydl:
+                info = ydl.extract_info(youtube_url, download=True)
+                if not info:
+                    raise Exception("動画のダウンロードに失敗しました")
+                return info['requested_downloads'][0]['filepath']
+        except yt_dlp.utils.DownloadError as e:
+            if attempt == DOWNLOAD_ATTEMPTS:
+                raise
+            print(f"Download attempt {attempt} failed, resuming: {str(e)}")
+            time.sleep(min(2 ** attempt, 10))
+
+async def download_planned_formats(youtube_url: str, plan: Dict) -> Dict[str, str]:
+    """計画したフォーマットを並行してダウンロードする"""
+    formats = plan['formats']
+
+    async def download(kind: str, selector: str) -> str:
+        async with governor.acquire('download'):
+            return await asyncio.to_thread(download_format, youtube_url, selector, f'.{kind}')
+
+    paths = await asyncio.gather(*(download(kind, selector) for kind, selector in formats.items()))
+    return dict(zip(formats, paths))
+
+def cleanup_stale_partials():
+    """期限切れのダウンロードを削除する（期限内のものは再開用に残す）
+
+    .partファイルだけでなく、失敗したジョブが残したダウンロード済みのファイルも対象にする。
+    """
+    now = time.time()
+    for name in os.listdir(DOWNLOAD_DIR):
+        path = os.path.join(DOWNLOAD_DIR, name)
+        try:
+            if os.path.isfile(path) and now - os.path.getmtime(path) > DOWNLOAD_PARTIAL_TTL:
+                print(f"Removing stale download: {path}")
+                os.remove(path)
+        except FileNotFoundError:
+            # 処理を終えたジョブが同時に削除した場合
+            pass
+
+def media_cache_path(project_id: str) -> str:
+    return os.path.join(MEDIA_CACHE_DIR, f"{project_id}.mp4")
+
+def remux_faststart(source: str, target: str):
+    """再エンコードせずにmoovアトムを先頭へ移し、ダウンロード途中でもシークできるMP4にする"""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    temp_target = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        ffmpeg.input(source).output(temp_target, c='copy', movflags='+faststart', f='mp4') \
+            .overwrite_output().run(quiet=True)
+        os.replace(temp_target, target)
+    finally:
+        if os.path.exists(temp_target):
+            os.remove(temp_target)
+
+def cleanup_media_cache():
+    """期限切れのプレビュー用キャッシュを削除する"""
+    if not os.path.isdir(MEDIA_CACHE_DIR):
+        return
+    now = time.time()
+    for name in os.listdir(MEDIA_CACHE_DIR):
+        path = os.path.join(MEDIA_CACHE_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > MEDIA_CACHE_TTL:
+                print(f"Removing expired media cache: {path}")
+                os.remove(path)
+        except FileNotFoundError:
+            # 別のプロセスが同時に削除した場合
+            pass
+
+async def cleanup_caches_periodically():
+    """起動中もCACHE_CLEANUP_INTERVALごとに期限切れのダウンロードとキャッシュを削除する"""
+    while True:
+        await asyncio.sleep(CACHE_CLEANUP_INTERVAL)
+        try:
+            await asyncio.to_thread(cleanup_stale_partials)
+            await asyncio.to_thread(cleanup_media_cache)
+        except Exception as e:
+            print(f"Failed to clean up caches: {str(e)}")
+
+def build_markdown_report(url: str, transcription: str, translation: str, processed_at: Optional[datetime] = None) -> str:
+    """結果のMarkdownを組み立てる"""
+    processed_at = processed_at or datetime.now()
+    return f"""# YouTube 文字起こし & 翻訳結果
 
 ## 元動画情報
 - URL: {url}
-- 処理日時: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+- 処理日時: {processed_at.strftime("%Y-%m-%d %H:%M:%S")}
 
 ## 文字起こし結果
 {transcription}
@@ -157,6 +1843,13 @@ def save_to_markdown(video_id: str, url: str, transcription: str, translation: s
 ## 英訳結果
 {translation}
 """
+
+def save_to_markdown(video_id: str, url: str, transcription: str, translation: str):
+    """結果をMarkdownファイルとして保存する"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"/tmp/outputs/{video_id}_{timestamp}.md"  # /tmp に変更
+    
+    content = build_markdown_report(url, transcription, translation)
     
     os.makedirs('/tmp/outputs', exist_ok=True)
     with open(filename, 'w', encoding='utf-8') as f:
@@ -167,33 +1860,90 @@ def save_to_markdown(video_id: str, url: str, transcription: str, translation: s
 def extract_video_id(url: str) -> str:
     """YouTube URLからVideo IDを抽出する"""
     try:
-        with yt_dlp.YoutubeDL() as ydl:
-            info = ydl.extract_info(url, download=False)
+        with ydl_pool.acquire() as ydl:
+            info = ydl.extract_info(url, download=False, process=False)
             return info['id']
     except Exception:
         return datetime.now().strftime("%Y%m%d_%H%M%S")
 
-async def upload_to_supabase(file_path: str, content_type: str, bucket: str = 'videos') -> str:
+# 同じ内容のファイルは内容のSHA-256をキーにして1つだけ保存する
+STORAGE_DEDUP = os.getenv('STORAGE_DEDUP', 'true').lower() == 'true'
+HASH_CHUNK_SIZE = 1024 * 1024
+# 内容で名前が決まるオブジェクトは変わらないので長期間キャッシュさせる
+# storage3のcache-controlはSupabase Storageが先頭に max-age= を付けるため秒数だけを渡す
+CONTENT_ADDRESSED_CACHE_SECONDS = '31536000'
+CONTENT_ADDRESSED_CACHE_CONTROL = f'max-age={CONTENT_ADDRESSED_CACHE_SECONDS}, immutable'
+
+def file_sha256(file_path: str) -> tuple:
+    """ファイルを少しずつ読みながらSHA-256とサイズを計算する"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+def content_key(digest: str, extension: str) -> str:
+    return f"sha256/{digest[:2]}/{digest}{extension}"
+
+async def register_storage_object(bucket: str, path: str, digest: str, size: int, content_type: str, clients: ClientPool):
+    """オブジェクトを台帳に登録する（失敗してもアップロード自体は成功として扱う）"""
+    try:
+        await clients.rest.rpc('register_storage_object', {
+            'p_bucket': bucket,
+            'p_path': path,
+            'p_sha256': digest,
+            'p_size': size,
+            'p_content_type': content_type
+        }).execute()
+    except Exception as e:
+        print(f"Failed to register storage object {bucket}/{path}: {str(e)}")
+
+async def upload_to_supabase(file_path: str, content_type: str, bucket: str = 'videos', clients: Optional[ClientPool] = None) -> str:
+    clients = clients or get_clients()
     try:
-        file_name = f"{uuid.uuid4()}{os.path.splitext(file_path)[1]}"
-        
         if not os.path.exists(file_path):
             raise Exception(f"File not found: {file_path}")
-            
+
+        extension = os.path.splitext(file_path)[1]
+        storage = clients.storage.from_(bucket)
+        if STORAGE_DEDUP:
+            digest, size = await asyncio.to_thread(file_sha256, file_path)
+            file_name = content_key(digest, extension)
+            # 同じ内容が既にあればアップロードせずに既存のURLを返す
+            if await storage.exists(file_name):
+                print(f"Reusing stored file {file_name} in bucket {bucket}")
+                await register_storage_object(bucket, file_name, digest, size, content_type, clients)
+                return await storage.get_public_url(file_name)
+        else:
+            file_name = f"{uuid.uuid4()}{extension}"
+
         print(f"Uploading file {file_name} to bucket {bucket}")
         
         with open(file_path, 'rb') as f:
             file_data = f.read()
             
         # アップロード処理
-        storage = supabase.storage.from_(bucket)
-        response = storage.upload(file_name, file_data)
+        file_options = {'content-type': content_type}
+        if STORAGE_DEDUP:
+            file_options['cache-control'] = CONTENT_ADDRESSED_CACHE_SECONDS
+        try:
+            async with governor.acquire('upload'):
+                response = await storage.upload(file_name, file_data, file_options)
+        except Exception:
+            # 同じ内容を同時にアップロードした別のジョブが先に保存した場合はそれを使う
+            if not (STORAGE_DEDUP and await storage.exists(file_name)):
+                raise
+            response = {'path': file_name}
         
         if not response:
             raise Exception("Upload failed: No response from storage")
+        if STORAGE_DEDUP:
+            await register_storage_object(bucket, file_name, digest, size, content_type, clients)
             
         # 公開URLを取得
-        file_url = storage.get_public_url(file_name)
+        file_url = await storage.get_public_url(file_name)
         print(f"File uploaded successfully: {file_url}")
         
         return file_url
@@ -205,33 +1955,162 @@ async def upload_to_supabase(file_path: str, content_type: str, bucket: str = 'v
         print(f"Bucket: {bucket}")
         raise Exception(f"Supabaseへのアップロードに失敗しました: {str(e)}")
 
+async def upload_stream_to_supabase(chunks: AsyncIterator[bytes], content_type: str, extension: str, bucket: str = 'videos', clients: Optional[ClientPool] = None) -> str:
+    """バイト列のストリームをメモリに溜めずにそのままStorageへアップロードする
+
+    内容のハッシュは最後まで読まないと分からないため、一時的な名前でアップロードしながら
+    SHA-256を計算し、最後に内容のキーへ移動する（既にあれば一時ファイルを消す）。
+    uploadの枠は呼び出し側で確保する（stream_video_pipelineを参照）。
+    """
+    clients = clients or get_clients()
+    try:
+        file_name = f"{'tmp/' if STORAGE_DEDUP else ''}{uuid.uuid4()}{extension}"
+        print(f"Streaming file {file_name} to bucket {bucket}")
+        storage = clients.storage.from_(bucket)
+
+        digest = hashlib.sha256()
+        size = 0
+
+        async def hashed(source: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+            nonlocal size
+            async for chunk in source:
+                digest.update(chunk)
+                size += len(chunk)
+                yield chunk
+
+        if STORAGE_BACKEND == 'local':
+            await storage.upload_stream(file_name, hashed(chunks))
+        else:
+            response = await clients.supabase_http.post(
+                f"{supabase_url}/storage/v1/object/{bucket}/{file_name}",
+                content=hashed(chunks),
+                headers={
+                    **clients.supabase_headers,
+                    'content-type': content_type,
+                    'cache-control': CONTENT_ADDRESSED_CACHE_CONTROL if STORAGE_DEDUP else 'max-age=3600'
+                }
+            )
+            response.raise_for_status()
+
+        if STORAGE_DEDUP:
+            key = content_key(digest.hexdigest(), extension)
+            moved = False
+            if not await storage.exists(key):
+                try:
+                    await storage.move(file_name, key)
+                    moved = True
+                except Exception:
+                    # 同じ内容を同時に保存した別のジョブが先に移動した場合はそれを使う
+                    if not await storage.exists(key):
+                        raise
+            if not moved:
+                print(f"Reusing stored file {key} in bucket {bucket}")
+                await storage.remove([file_name])
+            await register_storage_object(bucket, key, digest.hexdigest(), size, content_type, clients)
+            file_name = key
+
+        file_url = await storage.get_public_url(file_name)
+        print(f"File uploaded successfully: {file_url}")
+
+        return file_url
+
+    except Exception as e:
+        print(f"Upload error details: {str(e)}")
+        print(f"Content type: {content_type}")
+        print(f"Bucket: {bucket}")
+        raise Exception(f"Supabaseへのアップロードに失敗しました: {str(e)}")
+
+async def stream_remote_file(url: str, headers: Optional[Dict] = None, clients: Optional[ClientPool] = None) -> AsyncIterator[bytes]:
+    """リモートのファイルをチャンク単位で読み出す"""
+    clients = clients or get_clients()
+    async with clients.http.stream('GET', url, headers=headers, timeout=httpx.Timeout(HTTP_TIMEOUT, read=60.0)) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+            yield chunk
+
+_STREAM_EOF = object()
+
+class StreamTee:
+    """1つの非同期バイトストリームを複数の消費者に分配する
+
+    各ブランチは上限付きキューで受け取るため、一番遅い消費者に合わせて
+    ダウンロード側に背圧がかかる。途中で閉じられたブランチは読み飛ばす。
+    """
+
+    def __init__(self, source: AsyncIterator[bytes], branches: int, maxsize: int = STREAM_QUEUE_SIZE):
+        self.source = source
+        self.queues = [asyncio.Queue(maxsize) for _ in range(branches)]
+        self.closed = [False] * branches
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._pump())
+
+    async def _pump(self):
+        end = _STREAM_EOF
+        try:
+            async for chunk in self.source:
+                if all(self.closed):
+                    break
+                for i, queue in enumerate(self.queues):
+                    if not self.closed[i]:
+                        await queue.put(chunk)
+        except Exception as e:
+            end = e
+        for i, queue in enumerate(self.queues):
+            if not self.closed[i]:
+                await queue.put(end)
+
+    async def branch(self, index: int) -> AsyncIterator[bytes]:
+        queue = self.queues[index]
+        try:
+            while True:
+                item = await queue.get()
+                if item is _STREAM_EOF:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # 読み残しを捨ててポンプ側のputを解放する
+            self.closed[index] = True
+            while not queue.empty():
+                queue.get_nowait()
+
+    async def aclose(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
 # 動画の長さをチェック関数を修正
+def extract_video_info(youtube_url: str, format_selector: str = 'best[ext=mp4]') -> Dict:
+    """プールのYoutubeDLで動画情報だけを取得する（ダウンロードはしない）"""
+    with ydl_pool.acquire(format_selector) as ydl:
+        return ydl.extract_info(youtube_url, download=False)
+
 async def check_video_duration(youtube_url: str) -> Dict:
     try:
-        with yt_dlp.YoutubeDL({
-            'quiet': True,
-            'no_warnings': True,
-            'cookies_from_browser': 'chrome'  # ここにも追加
-        }) as ydl:
-            info = ydl.extract_info(youtube_url, download=False)
-            
-            if not info:
-                raise Exception("動画情報の取得に失敗しました")
-                
-            duration = info.get('duration', 0)
-            
-            return {
-                'is_valid': duration <= 180,
-                'duration': duration,
-                'id': info.get('id'),
-                'thumbnail': info.get('thumbnail')
-            }
+        # 情報の取得は同期処理なのでスレッドで実行する
+        info = await asyncio.to_thread(extract_video_info, youtube_url, 'bestvideo*+bestaudio/best')
+
+        if not info:
+            raise Exception("動画情報の取得に失敗しました")
+
+        duration = info.get('duration', 0)
+
+        return {
+            'is_valid': duration <= 180,
+            'duration': duration,
+            'id': info.get('id'),
+            'thumbnail': info.get('thumbnail')
+        }
     except Exception as e:
         print(f"Error checking video duration: {str(e)}")
         raise Exception(f"動画情報の取得に失敗しました: {str(e)}")
 
 # プロジェクト保存関数の修正
-async def save_project_to_db(video_url: str, video_path: str = None, screenshots: list = None, status: str = 'pending', error_message: str = None, metadata: dict = None):
+async def save_project_to_db(video_url: str, video_path: str = None, screenshots: list = None, status: str = 'pending', error_message: str = None, metadata: dict = None, clients: Optional[ClientPool] = None):
+    clients = clients or get_clients()
     try:
         # statusの値を検証
         valid_statuses = {'pending', 'processing', 'completed', 'error'}
@@ -241,18 +2120,20 @@ async def save_project_to_db(video_url: str, video_path: str = None, screenshots
         data = {
             'video_url': video_url,
             'video_path': video_path,
-            'screenshots': json.dumps(screenshots or []),
+            'screenshots': screenshots or [],
             'status': status,
             'error_message': error_message,
-            'metadata': json.dumps(metadata or {}),
+            'metadata': metadata or {},
+            # 履歴APIで持ち主ごとに絞り込むため、metadataのuser_idを列にも持つ
+            'user_id': (metadata or {}).get('user_id'),
             'created_at': datetime.now(timezone.utc).isoformat(),
             'updated_at': datetime.now(timezone.utc).isoformat()
         }
         
         print(f"Debug: Attempting to save project with data:")
-        print(json.dumps(data, indent=2))
+        print(json.dumps(data, indent=2, ensure_ascii=False))
         
-        response = supabase.table('projects').insert(data).execute()
+        response = await clients.rest.table('projects').insert(data).execute()
         print(f"Debug: Insert response: {response}")
         
         return response.data[0]
@@ -262,86 +2143,626 @@ async def save_project_to_db(video_url: str, video_path: str = None, screenshots
         raise
 
 # プロジェクト更新関数の追加
-async def update_project_status(project_id: str, status: str, error_message: str = None):
+async def update_project_status(project_id: str, status: str, error_message: str = None, clients: Optional[ClientPool] = None):
+    clients = clients or get_clients()
     try:
         data = {
             'status': status,
             'error_message': error_message,
-            'updated_at': datetime.now().isoformat()
+            'updated_at': datetime.now(timezone.utc).isoformat()
         }
         
-        response = supabase.table('projects').update(data).eq('id', project_id).execute()
+        response = await clients.rest.table('projects').update(data).eq('id', project_id).execute()
+        if status in ('completed', 'error'):
+            await enqueue_project_webhooks(response.data[0], clients=clients)
         return response.data[0]
     except Exception as e:
         print(f"ステータス更新エラー: {str(e)}")
 
-# 動画からスクリーンショットを生成する関数
-async def generate_screenshots(video_path: str, num_screenshots: int = 3) -> list:
-    try:
-        # 動画の長さを取得
-        probe = ffmpeg.probe(video_path)
-        duration = float(probe['streams'][0]['duration'])
-        
-        # スクリーンショットを撮る時間間隔を計算
-        interval = duration / (num_screenshots + 1)
-        
-        screenshots = []
-        for i in range(num_screenshots):
-            timestamp = interval * (i + 1)
-            output_path = f"/tmp/screenshots/{uuid.uuid4()}.jpg"
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            
-            # FFmpegでスクリーンショットを生成
-            stream = ffmpeg.input(video_path, ss=timestamp)
-            stream = ffmpeg.output(stream, output_path, vframes=1)
-            ffmpeg.run(stream, overwrite_output=True)
-            
-            # スクリーンショットをSupabaseにアップロード
-            screenshot_url = await upload_to_supabase(
-                output_path, 
-                'image/jpeg'
+def decode_json_field(value, default=None):
+    """JSON列を辞書・リストとして返す（以前のJSON文字列として保存された行にも対応）"""
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return default
+    return value if value is not None else default
+
+def compress_text(text: str) -> str:
+    """大きな文字列をLZ4/zstdで圧縮し、接頭辞付きのbase64文字列にする
+
+    圧縮しても小さくならない場合や閾値未満の場合はそのまま返す。
+    """
+    data = text.encode('utf-8')
+    if TEXT_COMPRESSION == 'none' or len(data) < TEXT_COMPRESSION_MIN_BYTES:
+        return text
+    if TEXT_COMPRESSION == 'zstd':
+        packed = zstandard.ZstdCompressor(level=10).compress(data)
+    else:
+        packed = lz4.frame.compress(data, compression_level=lz4.frame.COMPRESSIONLEVEL_MINHC)
+    encoded = COMPRESSED_TEXT_PREFIXES[TEXT_COMPRESSION] + base64.b64encode(packed).decode()
+    return encoded if len(encoded) < len(data) else text
+
+def decompress_text(value):
+    """compress_textで圧縮した文字列を元に戻す（圧縮されていなければそのまま返す）"""
+    if not isinstance(value, str):
+        return value
+    for codec, prefix in COMPRESSED_TEXT_PREFIXES.items():
+        if value.startswith(prefix):
+            packed = base64.b64decode(value[len(prefix):])
+            if codec == 'zstd':
+                return zstandard.ZstdDecompressor().decompress(packed).decode('utf-8')
+            return lz4.frame.decompress(packed).decode('utf-8')
+    return value
+
+def encode_checkpoints(checkpoints: Dict) -> Dict:
+    """文字起こしなどの大きな値を圧縮して保存用のチェックポイントを作る"""
+    encoded = dict(checkpoints)
+    for key in COMPRESSED_CHECKPOINT_KEYS:
+        if key in encoded:
+            value = encoded[key]
+            encoded[key] = compress_text(value if isinstance(value, str) else json.dumps(value, ensure_ascii=False))
+    return encoded
+
+def decode_checkpoints(value) -> Dict:
+    """保存されたチェックポイントを読み込み、圧縮された値を元に戻す"""
+    checkpoints = decode_json_field(value, {}) or {}
+    for key in COMPRESSED_CHECKPOINT_KEYS:
+        if key in checkpoints:
+            checkpoints[key] = decompress_text(checkpoints[key])
+            if key in JSON_CHECKPOINT_KEYS and isinstance(checkpoints[key], str):
+                checkpoints[key] = json.loads(checkpoints[key])
+    return checkpoints
+
+# ステージ完了ごとのチェックポイント保存
+async def save_checkpoint(project_id: str, checkpoints: Dict, stage: str, clients: Optional[ClientPool] = None) -> Dict:
+    clients = clients or get_clients()
+    checkpoints['stage'] = stage
+    data = {
+        'checkpoints': encode_checkpoints(checkpoints),
+        'updated_at': datetime.now(timezone.utc).isoformat()
+    }
+    print(f"Debug: Checkpoint {stage} for project {project_id}")
+    response = await clients.rest.table('projects').update(data).eq('id', project_id).execute()
+    return response.data[0]
+
+# プロジェクトの完了状態を保存
+async def complete_project(project_id: str, video_path: Optional[str], screenshots: list, metadata: Dict, checkpoints: Optional[Dict] = None, clients: Optional[ClientPool] = None) -> Dict:
+    clients = clients or get_clients()
+    data = {
+        'video_path': video_path,
+        'screenshots': screenshots or [],
+        'status': 'completed',
+        'error_message': None,
+        'metadata': metadata or {},
+        'updated_at': datetime.now(timezone.utc).isoformat()
+    }
+    if checkpoints is not None:
+        # 文字起こし・翻訳はvideosに保存済みなので、完了後はチェックポイントから外す
+        data['checkpoints'] = {
+            k: v for k, v in checkpoints.items() if k not in COMPRESSED_CHECKPOINT_KEYS
+        }
+    response = await clients.rest.table('projects').update(data).eq('id', project_id).execute()
+    await enqueue_project_webhooks(response.data[0], clients=clients)
+    return response.data[0]
+
+def screenshot_timestamps(duration: float, num_screenshots: int) -> List[float]:
+    """スクリーンショットを撮る時刻を等間隔で計算する"""
+    interval = duration / (num_screenshots + 1)
+    return [interval * (i + 1) for i in range(num_screenshots)]
+
+def build_screenshot_select(timestamps: List[float]) -> str:
+    """各時刻以降の最初のフレームだけを選ぶselectフィルタの式を組み立てる"""
+    return '+'.join(
+        f"gte(t,{t:.3f})*(isnan(prev_selected_t)+lt(prev_selected_t,{t:.3f}))"
+        for t in timestamps
+    )
+
+def screenshot_codec_options(image_format: str, quality: int) -> Dict:
+    """画像形式ごとのエンコーダ設定（qualityは0〜100）"""
+    if image_format == 'webp':
+        return {'vcodec': 'libwebp', 'quality': quality, 'compression_level': 6}
+    if image_format == 'avif':
+        return {'vcodec': 'libaom-av1', 'crf': round(63 - quality * 0.63), 'still-picture': 1, 'cpu-used': 6}
+    return {'q:v': max(2, round(31 - quality * 0.29))}
+
+def screenshot_labels() -> List[str]:
+    """出力するバリアント名（元サイズ + 幅ごとの縮小版）"""
+    return ['full'] + [f"w{width}" for width in SCREENSHOT_WIDTHS]
+
+def build_screenshot_outputs(video_stream, timestamps: List[float], output_dir: str) -> list:
+    """選択したフレームを各幅に縮小して書き出すffmpegの出力を1パス分まとめて作る"""
+    image_format = SCREENSHOT_FORMATS[SCREENSHOT_FORMAT]
+    codec_options = screenshot_codec_options(SCREENSHOT_FORMAT, SCREENSHOT_QUALITY)
+    selected = video_stream.filter('select', build_screenshot_select(timestamps))
+
+    labels = screenshot_labels()
+    split = selected.split() if len(labels) > 1 else None
+
+    outputs = []
+    for i, label in enumerate(labels):
+        branch = split[i] if split is not None else selected
+        if label != 'full':
+            branch = branch.filter('scale', int(label[1:]), -2)
+        outputs.append(branch.output(
+            f"{output_dir}/{label}_%02d{image_format['ext']}",
+            fps_mode='vfr',
+            vframes=len(timestamps),
+            **codec_options
+        ))
+    return outputs
+
+async def upload_screenshot_files(output_dir: str, count: int, source_width: Optional[int] = None, clients: Optional[ClientPool] = None) -> List[Dict]:
+    """書き出したスクリーンショットを全バリアントまとめてアップロードする"""
+    image_format = SCREENSHOT_FORMATS[SCREENSHOT_FORMAT]
+    labels = screenshot_labels()
+
+    files = []
+    for i in range(1, count + 1):
+        for label in labels:
+            path = f"{output_dir}/{label}_{i:02d}{image_format['ext']}"
+            if os.path.exists(path):
+                files.append((i, label, path))
+
+    urls = await asyncio.gather(*(
+        upload_to_supabase(path, image_format['content_type'], 'videos', clients=clients)
+        for _, _, path in files
+    ))
+
+    screenshots = {}
+    for (i, label, _), url in zip(files, urls):
+        screenshot = screenshots.setdefault(i, {'url': None, 'width': source_width, 'variants': {}})
+        if label == 'full':
+            screenshot['url'] = url
+        else:
+            screenshot['variants'][label[1:]] = url
+    return [screenshots[i] for i in sorted(screenshots) if screenshots[i]['url']]
+
+# 動画からスクリーンショットを生成する関数
+async def generate_screenshots(video_path: str, num_screenshots: int = 3, clients: Optional[ClientPool] = None) -> List[Dict]:
+    output_dir = f"{SCREENSHOT_DIR}/{uuid.uuid4()}"
+    try:
+        # 動画の長さを取得
+        probe = ffmpeg.probe(video_path)
+        duration = float(probe['streams'][0].get('duration') or probe['format']['duration'])
+        video_stream = next((st for st in probe['streams'] if st.get('codec_type') == 'video'), {})
+
+        # 全スクリーンショットと縮小版を1回のffmpegで生成
+        os.makedirs(output_dir, exist_ok=True)
+        timestamps = screenshot_timestamps(duration, num_screenshots)
+        outputs = build_screenshot_outputs(ffmpeg.input(video_path).video, timestamps, output_dir)
+        async with governor.acquire('encode'):
+            await asyncio.to_thread(
+                ffmpeg.run,
+                ffmpeg.merge_outputs(*outputs),
+                overwrite_output=True,
+                quiet=True
+            )
+
+        # スクリーンショットをSupabaseにアップロード
+        return await upload_screenshot_files(output_dir, len(timestamps), video_stream.get('width'), clients=clients)
+    except Exception as e:
+        raise Exception(f"スクリーンショットの生成に失敗しました: {str(e)}")
+    finally:
+        # 一時ファイルを削除
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+async def extract_media_from_stream(chunks: AsyncIterator[bytes], video_id: str, timestamps: List[float], screenshot_dir: str):
+    """パイプで受け取った動画から音声とスクリーンショットを1回のffmpegで抽出する
+
+    encodeの枠は呼び出し側で確保する（stream_video_pipelineを参照）。
+    """
+    audio_path = f"{DOWNLOAD_DIR}/{video_id}.m4a"
+
+    stream = ffmpeg.input('pipe:0')
+    outputs = [stream.audio.output(audio_path, ac=1, ar=16000, **{'b:a': '64k'})]
+    if timestamps:
+        outputs.extend(build_screenshot_outputs(stream.video, timestamps, screenshot_dir))
+    args = ffmpeg.merge_outputs(*outputs).overwrite_output().compile()
+
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stderr_task = asyncio.create_task(process.stderr.read())
+    try:
+        try:
+            async for chunk in chunks:
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpegが先に終了した場合は終了コードで判定する
+            pass
+        finally:
+            process.stdin.close()
+
+        returncode = await process.wait()
+        stderr = await stderr_task
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+        raise
+
+    if returncode != 0:
+        raise Exception(f"ffmpegの処理に失敗しました: {stderr.decode(errors='ignore')[-500:]}")
+
+    return audio_path
+
+class StreamingPipelineError(Exception):
+    """ストリーミング処理の失敗（アップロードだけ完了していればそのURLを持つ）"""
+
+    def __init__(self, message: str, video_path: Optional[str] = None):
+        super().__init__(message)
+        self.video_path = video_path
+
+async def stream_video_pipeline(youtube_url: str, video_info: Dict, num_screenshots: int, clients: Optional[ClientPool] = None) -> Dict:
+    """ダウンロード中の動画をStorageへのアップロードとffmpegに同時に流す"""
+    clients = clients or get_clients()
+
+    info = await asyncio.to_thread(extract_video_info, youtube_url)
+    if not info or not info.get('url'):
+        raise Exception("ストリーミング用の動画URLを取得できませんでした")
+
+    duration = float(info.get('duration') or video_info.get('duration') or 0)
+    timestamps = screenshot_timestamps(duration, num_screenshots) if duration else []
+
+    screenshot_dir = f"{SCREENSHOT_DIR}/{uuid.uuid4()}"
+    os.makedirs(screenshot_dir, exist_ok=True)
+
+    try:
+        # 2つのブランチは同じ上限付きのティーから読むので、片方の枠を持ったまま
+        # もう片方の枠を待つと他のジョブと互いに止め合う。必要な枠を先に決まった順で確保する
+        async with AsyncExitStack() as slots:
+            await slots.enter_async_context(governor.acquire('download'))
+            if STORAGE_BACKEND != 'local':
+                await slots.enter_async_context(governor.acquire('upload'))
+            await slots.enter_async_context(governor.acquire('encode'))
+            tee = StreamTee(stream_remote_file(info['url'], info.get('http_headers'), clients), 2)
+            upload_branch, media_branch = tee.branch(0), tee.branch(1)
+            tee.start()
+            tasks = [
+                asyncio.create_task(upload_stream_to_supabase(upload_branch, 'video/mp4', '.mp4', 'videos', clients)),
+                asyncio.create_task(extract_media_from_stream(media_branch, info['id'], timestamps, screenshot_dir))
+            ]
+            try:
+                video_path, audio_path = await asyncio.gather(*tasks)
+            except Exception as e:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                upload = tasks[0]
+                if upload.done() and not upload.cancelled() and upload.exception() is None:
+                    # 保存済みの動画を呼び出し側で使い回せるようにする（もう一度アップロードしない）
+                    raise StreamingPipelineError(str(e), video_path=upload.result()) from e
+                raise
+            finally:
+                await upload_branch.aclose()
+                await media_branch.aclose()
+                await tee.aclose()
+
+        screenshots = await upload_screenshot_files(screenshot_dir, len(timestamps), info.get('width'), clients=clients)
+    finally:
+        shutil.rmtree(screenshot_dir, ignore_errors=True)
+
+    return {
+        'video_path': video_path,
+        'audio_path': audio_path,
+        'screenshots': screenshots
+    }
+
+async def decode_audio_samples(audio_file: str, sample_rate: int = AUDIO_FEATURE_SAMPLE_RATE):
+    """音声をモノラルのfloat32 PCMにデコードしてnumpy配列で返す"""
+    args = ffmpeg.input(audio_file).audio.output('pipe:1', format='f32le', ac=1, ar=sample_rate).compile()
+    async with governor.acquire('encode'):
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise Exception(f"音声のデコードに失敗しました: {stderr.decode(errors='ignore')[-500:]}")
+    return np.frombuffer(stdout, dtype=np.float32)
+
+def encode_float16(values) -> str:
+    """配列をリトルエンディアンのfloat16にしてbase64文字列で返す"""
+    return base64.b64encode(np.asarray(values, dtype='<f2').tobytes()).decode()
+
+def compute_audio_features(samples, sample_rate: int = AUDIO_FEATURE_SAMPLE_RATE) -> Optional[Dict]:
+    """波形のピーク・RMS音量（dBFS）・無音区間をまとめて計算する
+
+    配列はfloat16のbase64で保存する（フロントエンドでは Float16Array か
+    Uint16Array からの変換で復元する）。
+    """
+    if len(samples) == 0:
+        return None
+
+    # 波形: 区間ごとの最小値・最大値を交互に並べる
+    points = min(WAVEFORM_POINTS, len(samples))
+    bucket = math.ceil(len(samples) / points)
+    points = math.ceil(len(samples) / bucket)
+    padded = np.pad(samples, (0, points * bucket - len(samples)), mode='edge').reshape(points, bucket)
+    peaks = np.column_stack([padded.min(axis=1), padded.max(axis=1)]).ravel()
+
+    # RMS音量: 固定長の窓ごとに計算し、dBFSに変換する
+    frame = max(1, int(sample_rate * RMS_FRAME_SECONDS))
+    frames = math.ceil(len(samples) / frame)
+    framed = np.pad(samples, (0, frames * frame - len(samples))).reshape(frames, frame)
+    rms = np.sqrt(np.mean(np.square(framed, dtype=np.float64), axis=1))
+    rms_db = np.maximum(20 * np.log10(np.maximum(rms, 1e-10)), -100.0)
+
+    # 無音区間: 閾値未満の窓が続く区間の開始・終了を差分で求める
+    quiet = np.concatenate([[0], (rms_db < SILENCE_THRESHOLD_DB).astype(np.int8), [0]])
+    edges = np.diff(quiet)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    keep = (ends - starts) * frame >= SILENCE_MIN_SECONDS * sample_rate
+    duration = len(samples) / sample_rate
+    silences = [
+        [round(float(start * frame / sample_rate), 3), round(float(min(end * frame / sample_rate, duration)), 3)]
+        for start, end in zip(starts[keep], ends[keep])
+    ]
+
+    overall_rms = float(np.sqrt(np.mean(np.square(samples, dtype=np.float64))))
+    return {
+        'encoding': 'float16-le-base64',
+        'sample_rate': sample_rate,
+        'duration': round(duration, 3),
+        'loudness_db': round(max(20 * math.log10(max(overall_rms, 1e-10)), -100.0), 2),
+        'peak': round(float(np.max(np.abs(samples))), 4),
+        'waveform': {
+            'points': points,
+            'seconds_per_point': bucket / sample_rate,
+            'peaks': encode_float16(peaks)
+        },
+        'rms': {
+            'frame_seconds': frame / sample_rate,
+            'db': encode_float16(rms_db)
+        },
+        'silences': silences
+    }
+
+async def analyze_audio(audio_file: str) -> Optional[Dict]:
+    """音声を1回だけデコードして特徴量を計算する"""
+    samples = await decode_audio_samples(audio_file)
+    return await asyncio.to_thread(compute_audio_features, samples)
+
+# 文字起こしの実行先: openai（Whisper API）/ local（faster-whisperでCPU実行）
+TRANSCRIPTION_BACKEND = os.getenv('TRANSCRIPTION_BACKEND', 'openai').lower()
+LOCAL_WHISPER_MODEL = os.getenv('LOCAL_WHISPER_MODEL', 'small')
+LOCAL_WHISPER_COMPUTE_TYPE = os.getenv('LOCAL_WHISPER_COMPUTE_TYPE', 'int8')
+LOCAL_WHISPER_THREADS = int(os.getenv('LOCAL_WHISPER_THREADS', 0))
+LOCAL_WHISPER_BEAM_SIZE = int(os.getenv('LOCAL_WHISPER_BEAM_SIZE', 5))
+LOCAL_WHISPER_MODEL_DIR = os.getenv('LOCAL_WHISPER_MODEL_DIR') or None
+
+_local_whisper_model = None
+_local_whisper_lock = threading.Lock()
+
+def get_local_whisper_model():
+    """ローカルのWhisperモデルをプロセスごとに1回だけ読み込んで使い回す"""
+    global _local_whisper_model
+    with _local_whisper_lock:
+        if _local_whisper_model is None:
+            print(f"Debug: Loading local Whisper model {LOCAL_WHISPER_MODEL} ({LOCAL_WHISPER_COMPUTE_TYPE})")
+            _local_whisper_model = WhisperModel(
+                LOCAL_WHISPER_MODEL,
+                device='cpu',
+                compute_type=LOCAL_WHISPER_COMPUTE_TYPE,
+                cpu_threads=LOCAL_WHISPER_THREADS,
+                download_root=LOCAL_WHISPER_MODEL_DIR
             )
-            screenshots.append(screenshot_url)
-            
-            # 一時ファイルを削除
-            os.remove(output_path)
-            
-        return screenshots
-    except Exception as e:
-        raise Exception(f"スクリーンショットの生成に失敗しました: {str(e)}")
+        return _local_whisper_model
 
-# OpenAI APIによる文字起こしと翻訳を修正
-async def transcribe_and_translate(audio_file: str):
-    try:
-        # Whisper APIによる文字起こし
-        print("Starting transcription with Whisper API...")
-        with open(audio_file, "rb") as audio:
-            # 同期的に実行するように修正
-            transcription = openai.audio.transcriptions.create(
+def run_local_whisper(audio_file: str) -> Dict:
+    model = get_local_whisper_model()
+    segments, _ = model.transcribe(audio_file, language='ja', beam_size=LOCAL_WHISPER_BEAM_SIZE)
+    # segmentsはジェネレーターなので、ここで最後まで推論する
+    segments = [
+        {'start': round(segment.start, 2), 'end': round(segment.end, 2), 'text': segment.text.strip()}
+        for segment in segments
+    ]
+    return {'text': ''.join(segment['text'] for segment in segments), 'segments': segments}
+
+async def transcribe_with_openai(audio_file: str, clients: ClientPool) -> Dict:
+    # Whisper APIによる文字起こし
+    print("Starting transcription with Whisper API...")
+    with open(audio_file, "rb") as audio:
+        async with governor.acquire('openai'):
+            result = await clients.openai.audio.transcriptions.create(
                 file=audio,
                 model="whisper-1",
-                language="ja"
-            ).text
+                language="ja",
+                response_format="verbose_json"
+            )
+    return {
+        'text': result.text,
+        'segments': [
+            {'start': round(segment.start, 2), 'end': round(segment.end, 2), 'text': segment.text.strip()}
+            for segment in (result.segments or [])
+        ]
+    }
+
+async def transcribe_with_local(audio_file: str, clients: ClientPool) -> Dict:
+    # faster-whisperによるCPUでの文字起こし（推論はスレッドで実行してイベントループを止めない）
+    print("Starting transcription with local Whisper model...")
+    async with governor.acquire('transcribe'):
+        return await asyncio.to_thread(run_local_whisper, audio_file)
+
+TRANSCRIPTION_BACKENDS = {
+    'openai': transcribe_with_openai,
+    'local': transcribe_with_local
+}
+if TRANSCRIPTION_BACKEND not in TRANSCRIPTION_BACKENDS:
+    raise ValueError(f"Invalid TRANSCRIPTION_BACKEND. Must be one of: {', '.join(TRANSCRIPTION_BACKENDS)}")
+if TRANSCRIPTION_BACKEND == 'local' and WhisperModel is None:
+    raise Exception("TRANSCRIPTION_BACKEND=local には faster-whisper パッケージが必要です")
+
+def available_transcription_backends() -> List[str]:
+    return [name for name in TRANSCRIPTION_BACKENDS if name != 'local' or WhisperModel is not None]
+
+# OpenAI APIによる文字起こし
+async def transcribe_audio(audio_file: str, clients: Optional[ClientPool] = None, backend: Optional[str] = None) -> Dict:
+    """文字起こしの全文とタイムスタンプ付きのセグメントを返す（どのバックエンドでも同じ形式）"""
+    clients = clients or get_clients()
+    backend = backend or TRANSCRIPTION_BACKEND
+    try:
+        result = await TRANSCRIPTION_BACKENDS[backend](audio_file, clients)
         print("Transcription completed")
+        return result
+
+    except Exception as e:
+        print(f"API Error: {str(e)}")
+        raise Exception(f"文字起こしに失敗しました: {str(e)}")
+
+# 翻訳と一緒に生成するショート動画用のメタデータ（項目を増やしてもリクエストは1回のまま）
+VIDEO_METADATA_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'translation': {'type': 'string', 'description': 'English translation of the full transcript'},
+        'title': {'type': 'string', 'description': 'Catchy title for a short video, in Japanese'},
+        'summary': {'type': 'string', 'description': 'Two or three sentence summary, in Japanese'},
+        'hashtags': {'type': 'array', 'items': {'type': 'string'}, 'description': '3 to 8 hashtags without the leading #'}
+    },
+    'required': ['translation', 'title', 'summary', 'hashtags'],
+    'additionalProperties': False
+}
+VIDEO_METADATA_PROMPT = (
+    "You are a professional translator and short-video editor. Translate the following Japanese transcript "
+    "to English, maintaining the original meaning and nuance. Also write a title, a short summary and "
+    "hashtags for a short video made from it."
+)
+
+def token_usage(response) -> Dict:
+    """OpenAIのレスポンスからトークン使用量を取り出す"""
+    usage = response.usage
+    return {
+        'model': response.model,
+        'prompt_tokens': usage.prompt_tokens if usage else 0,
+        'completion_tokens': usage.completion_tokens if usage else 0,
+        'total_tokens': usage.total_tokens if usage else 0
+    }
+
+def sum_token_usage(usages: List[Dict]) -> Dict:
+    """複数のリクエストのトークン使用量を合計する"""
+    return {
+        'model': usages[0]['model'] if usages else ai_model,
+        **{key: sum(usage[key] for usage in usages) for key in ('prompt_tokens', 'completion_tokens', 'total_tokens')}
+    }
 
-        # GPT-4 Optimized (Mini)による翻訳
-        print("Starting translation with GPT-4 Optimized (Mini)...")
-        # Chat Completionsの呼び出しを修正
-        translation_response = openai.chat.completions.create(  # awaitを削除
+# 出力の上限で構造化出力が途中で切れた場合の、翻訳とタイトル等を分けたリクエスト
+VIDEO_DETAILS_SCHEMA = {
+    **VIDEO_METADATA_SCHEMA,
+    'properties': {key: value for key, value in VIDEO_METADATA_SCHEMA['properties'].items() if key != 'translation'},
+    'required': ['title', 'summary', 'hashtags']
+}
+VIDEO_DETAILS_PROMPT = (
+    "You are a professional short-video editor. Write a title, a short summary and hashtags for a short video "
+    "made from the following Japanese transcript."
+)
+TRANSLATION_PROMPT = (
+    "You are a professional translator. Translate the following Japanese transcript to English, "
+    "maintaining the original meaning and nuance. Output only the translation."
+)
+# 1回の翻訳でも出力の上限に達した場合に分割する文字数
+TRANSLATION_CHUNK_CHARS = int(os.getenv('TRANSLATION_CHUNK_CHARS', 3000))
+
+def split_transcript(text: str, max_chars: int) -> List[str]:
+    """文の区切り（。！？と改行）でmax_chars以下のまとまりに分ける（長すぎる文はそのまま切る）"""
+    sentences = re.findall(r'[^。！？!?\n]*[。！？!?\n]+|[^。！？!?\n]+$', text)
+    chunks, current = [], ''
+    for sentence in sentences:
+        while len(sentence) > max_chars:
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+        if len(current) + len(sentence) > max_chars:
+            chunks.append(current)
+            current = ''
+        current += sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+async def request_translation(text: str, clients: ClientPool) -> tuple:
+    """構造化出力を使わずに翻訳だけを行い、(翻訳, 出力の上限で切れたか, 使用量) を返す"""
+    async with governor.acquire('openai'):
+        response = await clients.openai.chat.completions.create(
             model=ai_model,
             messages=[
-                {"role": "system", "content": "You are a professional translator. Translate the following Japanese text to English, maintaining the original meaning and nuance:"},
-                {"role": "user", "content": transcription}
+                {"role": "system", "content": TRANSLATION_PROMPT},
+                {"role": "user", "content": text}
             ]
         )
-        translation = translation_response.choices[0].message.content
-        print("Translation completed")
+    choice = response.choices[0]
+    return choice.message.content or '', choice.finish_reason == 'length', token_usage(response)
+
+async def translate_long_text(transcription: str, clients: ClientPool) -> tuple:
+    """翻訳だけを行い、それでも出力の上限に達したら文の区切りで分割して翻訳する（(翻訳, 使用量のリスト)）"""
+    translation, truncated, usage = await request_translation(transcription, clients)
+    if not truncated:
+        return translation, [usage]
+    chunks = split_transcript(transcription, TRANSLATION_CHUNK_CHARS)
+    print(f"Translation hit the output limit, retrying in {len(chunks)} chunks")
+    results = await asyncio.gather(*(request_translation(chunk, clients) for chunk in chunks))
+    if any(truncated for _, truncated, _ in results):
+        raise Exception("翻訳が出力の上限を超えました（TRANSLATION_CHUNK_CHARS を小さくしてください）")
+    return "\n".join(text.strip() for text, _, _ in results), [usage] + [usage for _, _, usage in results]
+
+async def request_structured(prompt: str, schema: Dict, name: str, transcription: str, clients: ClientPool):
+    """JSONスキーマを指定した構造化出力のリクエストを送り、レスポンスを返す"""
+    async with governor.acquire('openai'):
+        response = await clients.openai.chat.completions.create(
+            model=ai_model,
+            messages=[
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": transcription}
+            ],
+            response_format={
+                'type': 'json_schema',
+                'json_schema': {'name': name, 'strict': True, 'schema': schema}
+            }
+        )
+    message = response.choices[0].message
+    if getattr(message, 'refusal', None):
+        raise Exception(message.refusal)
+    return response
 
-        return transcription, translation
+# OpenAI APIによる翻訳とメタデータ生成
+async def generate_video_metadata(transcription: str, clients: Optional[ClientPool] = None) -> Dict:
+    """翻訳・タイトル・要約・ハッシュタグをJSONスキーマ指定の1回のリクエストで生成する
+
+    長い文字起こしで出力の上限に達してJSONが途中で切れた場合は、翻訳（必要なら分割）と
+    タイトル・要約・ハッシュタグを別々のリクエストで作り直し、使用量は合計する。
+    """
+    clients = clients or get_clients()
+    try:
+        print("Starting translation and metadata generation...")
+        response = await request_structured(VIDEO_METADATA_PROMPT, VIDEO_METADATA_SCHEMA, 'video_metadata', transcription, clients)
+        usages = [token_usage(response)]
+        if response.choices[0].finish_reason == 'length':
+            print("Structured output hit the output limit, translating and generating metadata separately")
+            (translation, translation_usages), details = await asyncio.gather(
+                translate_long_text(transcription, clients),
+                request_structured(VIDEO_DETAILS_PROMPT, VIDEO_DETAILS_SCHEMA, 'video_details', transcription, clients)
+            )
+            if details.choices[0].finish_reason == 'length':
+                raise Exception("タイトル・要約の生成が出力の上限を超えました")
+            result = {'translation': translation, **json.loads(details.choices[0].message.content)}
+            usages += translation_usages + [token_usage(details)]
+        else:
+            result = json.loads(response.choices[0].message.content)
+        result['hashtags'] = [tag.lstrip('#') for tag in result['hashtags']]
+        result['usage'] = sum_token_usage(usages)
+        print(f"Translation completed ({result['usage']['total_tokens']} tokens)")
+        return result
 
     except Exception as e:
         print(f"API Error: {str(e)}")
-        raise Exception(f"文字起こしまたは翻訳に失敗しました: {str(e)}")
+        raise Exception(f"翻訳に失敗しました: {str(e)}")
 
 # ビデオ情報保存関数を修正
 async def save_video_to_db(
@@ -351,11 +2772,13 @@ async def save_video_to_db(
     transcription: Optional[str] = None,
     translation: Optional[str] = None,
     thumbnail_url: Optional[str] = None,
-    duration: Optional[int] = None
+    duration: Optional[int] = None,
+    clients: Optional[ClientPool] = None
 ) -> Dict:
+    clients = clients or get_clients()
     try:
         # まず既存の動画を検索
-        existing_video = supabase.table('videos').select("*").eq('youtube_id', youtube_id).execute()
+        existing_video = await clients.rest.table('videos').select("*").eq('youtube_id', youtube_id).execute()
         
         if existing_video.data:
             # 既存の動画が見つかった場合は更新
@@ -368,7 +2791,7 @@ async def save_video_to_db(
                 'duration': duration if duration else existing_video.data[0]['duration'],
                 'updated_at': datetime.now(timezone.utc).isoformat()
             }
-            response = supabase.table('videos').update(data).eq('youtube_id', youtube_id).execute()
+            response = await clients.rest.table('videos').update(data).eq('youtube_id', youtube_id).execute()
         else:
             # 新規動画の場合は挿入
             data = {
@@ -382,7 +2805,7 @@ async def save_video_to_db(
                 'created_at': datetime.now(timezone.utc).isoformat(),
                 'updated_at': datetime.now(timezone.utc).isoformat()
             }
-            response = supabase.table('videos').insert(data).execute()
+            response = await clients.rest.table('videos').insert(data).execute()
         
         return response.data[0]
     except Exception as e:
@@ -390,7 +2813,8 @@ async def save_video_to_db(
         raise Exception(f"ビデオ情報の保存に失敗しました: {str(e)}")
 
 # 処理ログ記録関数
-async def log_processing_status(video_id: str, status: str, message: Optional[str] = None):
+async def log_processing_status(video_id: str, status: str, message: Optional[str] = None, clients: Optional[ClientPool] = None):
+    clients = clients or get_clients()
     try:
         data = {
             'video_id': video_id,
@@ -398,132 +2822,1432 @@ async def log_processing_status(video_id: str, status: str, message: Optional[st
             'message': message
         }
         
-        response = supabase.table('processing_logs').insert(data).execute()
+        response = await clients.rest.table('processing_logs').insert(data).execute()
         return response.data[0]
     except Exception as e:
         print(f"処理ログの記録に失敗しました: {str(e)}")
 
 @app.get("/")
 async def index(request: Request):
-    site_url = os.getenv("NEXT_PUBLIC_SITE_URL", str(request.base_url).rstrip('/'))
-    return templates.TemplateResponse("index.html", {
-        "request": request,
-        "config": {
-            "SUPABASE_URL": os.getenv("SUPABASE_URL"),
-            "SUPABASE_ANON_KEY": os.getenv("SUPABASE_KEY"),
-            "SITE_URL": site_url
+    return render_index(request)
+
+async def process_video_job(youtube_url: str, num_screenshots: int = 3, store_video: bool = True, clients: Optional[ClientPool] = None, video_info: Optional[Dict] = None, user_id: Optional[str] = None, priority: str = 'interactive', transcription_backend: Optional[str] = None, webhook_url: Optional[str] = None) -> Dict:
+    """1件の動画を処理する（ダウンロード・アップロード・スクリーンショット・文字起こし・翻訳）"""
+    clients = clients or get_clients()
+    project = await create_job_project(youtube_url, num_screenshots, store_video, clients, video_info, user_id, priority, transcription_backend, webhook_url)
+    return await run_project_pipeline(project, clients=clients)
+
+async def create_job_project(youtube_url: str, num_screenshots: int = 3, store_video: bool = True, clients: Optional[ClientPool] = None, video_info: Optional[Dict] = None, user_id: Optional[str] = None, priority: str = 'interactive', transcription_backend: Optional[str] = None, webhook_url: Optional[str] = None, quota_key: Optional[str] = None, quota_seconds: float = 0) -> Dict:
+    """動画の長さを確認し、処理に必要な情報を持ったpendingのプロジェクトを作成する"""
+    clients = clients or get_clients()
+
+    # 動画の長さをチェック（呼び出し側で確認済みならその結果を使う）
+    video_info = video_info or await check_video_duration(youtube_url)
+    if not video_info['is_valid']:
+        raise Exception("動画が180秒を超えています")
+
+    # プロジェクトを作成（pending状態）
+    project = await save_project_to_db(
+        video_url=youtube_url,
+        status='pending',
+        metadata={
+            'requested_screenshots': num_screenshots,
+            'store_video': store_video,
+            'video_info': {
+                'id': video_info['id'],
+                'duration': video_info.get('duration'),
+                'thumbnail': video_info.get('thumbnail')
+            },
+            'user_id': user_id,
+            'priority': priority,
+            'transcription_backend': transcription_backend or TRANSCRIPTION_BACKEND,
+            'webhook_url': webhook_url,
+            # エラーで終わったときにWebサーバーが確保済みのクォータを返すための情報
+            'quota_key': quota_key,
+            'quota_seconds': quota_seconds
+        },
+        clients=clients
+    )
+    return project
+
+# 待機中とみなしてプロファイルから除くスタックの最上位の関数
+PROFILE_IDLE_FUNCTIONS = {'select', 'poll', 'wait', '_wait_for_tstate_lock', '_worker', 'get', 'accept'}
+
+class ProfileSession:
+    def __init__(self, project_id: str, frame):
+        self.project_id = project_id
+        self.frame = frame
+        self.stage = 'setup'
+        self.started_at = time.time()
+        self.samples: Dict[str, int] = {}
+
+class SamplingProfiler:
+    """有効にしたジョブの実行中だけ、別スレッドで全スレッドのスタックを定期的に採取する
+
+    結果はステージとスレッド名を根にしたcollapsed形式（flamegraph.pl / speedscope で読める）で
+    PROFILE_DIR/<project_id>.folded に保存する。イベントループ上のサンプルは、スタックに
+    そのジョブのパイプラインのフレームがあるものをそのジョブに割り当てる。スレッドや別タスクの
+    サンプルはどのジョブのものか分からないため、計測中のジョブが1件だけのときに限り含める。
+    無効の間はジョブごとの辞書の参照だけでスレッドは動かない。
+    """
+
+    def __init__(self, output_dir: str, interval: float):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.sessions: Dict[str, ProfileSession] = {}
+        self.remaining_jobs = 0
+        self.armed_until = 0.0
+        self.thread: Optional[threading.Thread] = None
+        self.completed: List[Dict] = []
+
+    def arm(self, jobs: int = 0, seconds: float = 0, interval: Optional[float] = None):
+        """次のjobs件のジョブ、またはseconds秒の間に始まったジョブを計測する"""
+        with self.lock:
+            self.remaining_jobs = max(jobs, 0)
+            self.armed_until = time.time() + seconds if seconds > 0 else 0.0
+            if interval:
+                self.interval = interval
+
+    def disarm(self):
+        with self.lock:
+            self.remaining_jobs = 0
+            self.armed_until = 0.0
+
+    def begin(self, project_id: str, frame) -> bool:
+        """ジョブの開始時に計測対象かを判定し、対象ならサンプリングを始める"""
+        if not self.remaining_jobs and not self.armed_until:
+            return False
+        with self.lock:
+            if self.remaining_jobs > 0:
+                self.remaining_jobs -= 1
+            elif time.time() >= self.armed_until:
+                self.armed_until = 0.0
+                return False
+            self.sessions[project_id] = ProfileSession(project_id, frame)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+                self.thread.start()
+        print(f"Debug: Profiling project {project_id}")
+        return True
+
+    def stage(self, project_id: str, stage: str):
+        session = self.sessions.get(project_id)
+        if session is not None:
+            session.stage = stage
+
+    def end(self, project_id: str):
+        with self.lock:
+            session = self.sessions.pop(project_id, None)
+        if session is None:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"{project_id}.folded")
+        with open(path, 'w') as f:
+            for stack, count in sorted(session.samples.items()):
+                f.write(f"{stack} {count}\n")
+        summary = {
+            'project_id': project_id,
+            'started_at': datetime.fromtimestamp(session.started_at, timezone.utc).isoformat(),
+            'duration_seconds': round(time.time() - session.started_at, 3),
+            'samples': sum(session.samples.values()),
+            'path': path
         }
-    })
+        with self.lock:
+            self.completed = [summary] + self.completed[:99]
+        print(f"Debug: Saved profile for project {project_id} ({summary['samples']} samples)")
 
-@app.post("/process")
-async def process_video(youtube_url: str = Form(...), num_screenshots: int = Form(3)):
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                sessions = list(self.sessions.values())
+                if not sessions:
+                    self.thread = None
+                    return
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self._sample(frame, names.get(thread_id, str(thread_id)), sessions)
+
+    def _sample(self, frame, thread_name: str, sessions: List[ProfileSession]):
+        if frame.f_code.co_name in PROFILE_IDLE_FUNCTIONS:
+            return
+        owner = None
+        stack = []
+        while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+            if owner is None:
+                owner = next((session for session in sessions if session.frame is frame), None)
+            code = frame.f_code
+            filename = '/'.join(code.co_filename.replace('\\', '/').split('/')[-2:])
+            stack.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if owner is None:
+            if len(sessions) != 1:
+                return
+            owner = sessions[0]
+        key = ';'.join([owner.stage, thread_name] + stack[::-1])
+        owner.samples[key] = owner.samples.get(key, 0) + 1
+
+    def status(self) -> Dict:
+        with self.lock:
+            return {
+                'remaining_jobs': self.remaining_jobs,
+                'armed_until': datetime.fromtimestamp(self.armed_until, timezone.utc).isoformat() if self.armed_until else None,
+                'interval_ms': self.interval * 1000,
+                'active': [
+                    {'project_id': session.project_id, 'stage': session.stage, 'samples': sum(session.samples.values())}
+                    for session in self.sessions.values()
+                ],
+                'completed': list(self.completed)
+            }
+
+profiler = SamplingProfiler(PROFILE_DIR, PROFILE_INTERVAL_MS / 1000)
+
+async def run_project_pipeline(project: Dict, clients: Optional[ClientPool] = None) -> Dict:
+    """プロジェクトを処理する（計測対象のジョブはサンプリングプロファイラで計測する）"""
+    pipeline = execute_project_pipeline(project, clients)
+    if not profiler.begin(project['id'], pipeline.cr_frame):
+        return await pipeline
     try:
-        # 動画の長さをチェック
-        video_info = await check_video_duration(youtube_url)
-        if not video_info['is_valid']:
-            raise Exception("動画が180秒を超えています")
-
-        # プロジェクトを作成（pending状態）
-        project = await save_project_to_db(
-            video_url=youtube_url,
-            status='pending',
-            metadata={'requested_screenshots': num_screenshots}
-        )
+        return await pipeline
+    finally:
+        profiler.end(project['id'])
 
-        try:
-            # ステータスを処理中に更新
-            await update_project_status(project['id'], 'processing')
+async def execute_project_pipeline(project: Dict, clients: Optional[ClientPool] = None) -> Dict:
+    """プロジェクトを処理する
+
+    各ステージの結果をprojects.checkpointsに保存するので、プロセスが途中で
+    落ちても最後に完了したステージの次から再開できる。
+    """
+    clients = clients or get_clients()
+    youtube_url = project['video_url']
+    metadata = decode_json_field(project.get('metadata'), {})
+    num_screenshots = metadata.get('requested_screenshots', 3)
+    store_video = metadata.get('store_video', True)
+    video_info = metadata['video_info']
+    checkpoints = decode_checkpoints(project.get('checkpoints'))
+    resumed_from = checkpoints.get('stage')
+    temp_files = []
+
+    try:
+        # ステータスを処理中に更新
+        await update_project_status(project['id'], 'processing', clients=clients)
 
-            # 動画情報をDBに保存
+        # 動画情報をDBに保存
+        if 'video_id' not in checkpoints:
             video = await save_video_to_db(
                 youtube_url=youtube_url,
                 youtube_id=video_info['id'],
                 thumbnail_url=video_info.get('thumbnail'),
-                duration=video_info.get('duration')
+                duration=video_info.get('duration'),
+                clients=clients
             )
+            checkpoints['video_id'] = video['id']
+            await save_checkpoint(project['id'], checkpoints, 'video', clients=clients)
+        video_id = checkpoints['video_id']
 
-            # 処理開始ログを記録
-            await log_processing_status(video['id'], 'processing', '処理を開始しました')
+        # 処理開始ログを記録
+        message = f"{resumed_from}から処理を再開しました" if resumed_from else '処理を開始しました'
+        await log_processing_status(video_id, 'processing', message, clients=clients)
 
+        need_upload = store_video and 'video_path' not in checkpoints
+        need_screenshots = num_screenshots > 0 and 'screenshots' not in checkpoints
+        need_features = AUDIO_FEATURES and 'audio_features' not in checkpoints
+        need_audio = 'transcription' not in checkpoints or need_features
+        audio_source = None
+
+        if need_upload or need_screenshots or need_audio:
             # 動画のダウンロードと保存
-            temp_video_file = f"{DOWNLOAD_DIR}/{video_info['id']}.mp4"
+            profiler.stage(project['id'], 'download')
             os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+            plan = plan_download_formats(need_upload, num_screenshots if need_screenshots else 0, need_audio)
 
-            with yt_dlp.YoutubeDL(get_yt_dlp_opts()) as ydl:
-                info = ydl.extract_info(youtube_url, download=True)
-                if not info:
-                    raise Exception("動画のダウンロードに失敗しました")
+            # ストリーミングモードではダウンロードしながらアップロードと音声・画像の抽出を行う
+            streamed = None
+            if STREAMING_PIPELINE and plan['store_video']:
+                try:
+                    streamed = await stream_video_pipeline(youtube_url, video_info,
+                                                           num_screenshots if need_screenshots else 0, clients)
+                except Exception as e:
+                    print(f"Streaming pipeline failed, falling back to file download: {str(e)}")
+                    if getattr(e, 'video_path', None):
+                        # 動画のアップロードは済んでいるので、残りの出力に必要な分だけダウンロードする
+                        checkpoints['video_path'] = e.video_path
+                        await save_checkpoint(project['id'], checkpoints, 'uploaded', clients=clients)
+                        need_upload = False
+                        plan = plan_download_formats(False, num_screenshots if need_screenshots else 0, need_audio)
 
-            # Supabaseに動画をアップロード
-            video_path = await upload_to_supabase(
-                temp_video_file, 
-                'video/mp4',
-                'videos'
-            )
+            if streamed:
+                checkpoints['video_path'] = streamed['video_path']
+                if need_screenshots:
+                    checkpoints['screenshots'] = streamed['screenshots']
+                audio_source = streamed['audio_path']
+                temp_files.append(audio_source)
+                await save_checkpoint(project['id'], checkpoints, 'uploaded', clients=clients)
+            else:
+                # 同じインスタンスで再開した場合はダウンロード済みのファイルを再利用する
+                downloads = {
+                    kind: path for kind, path in checkpoints.get('downloads', {}).items()
+                    if kind in plan['formats'] and os.path.exists(path)
+                }
+                missing = {kind: selector for kind, selector in plan['formats'].items() if kind not in downloads}
+                if missing:
+                    # 必要なストリームだけを並行してダウンロード
+                    downloads.update(await download_planned_formats(youtube_url, {**plan, 'formats': missing}))
+                    checkpoints['downloads'] = downloads
+                    await save_checkpoint(project['id'], checkpoints, 'downloaded', clients=clients)
+                temp_files.extend(downloads.values())
+                temp_video_file = downloads.get('video')
+                audio_source = downloads.get('audio') or temp_video_file
+
+                # プレビュー用にfast-start化したMP4を残し、Storageにも同じものを保存する
+                profiler.stage(project['id'], 'remux')
+                if need_upload and MEDIA_FASTSTART:
+                    cached_video = media_cache_path(project['id'])
+                    try:
+                        if not os.path.exists(cached_video):
+                            async with governor.acquire('encode'):
+                                await asyncio.to_thread(remux_faststart, temp_video_file, cached_video)
+                        temp_video_file = cached_video
+                    except Exception as e:
+                        print(f"Fast-start remux failed, uploading original file: {str(e)}")
+
+                # Supabaseに動画をアップロード
+                profiler.stage(project['id'], 'upload')
+                if need_upload:
+                    checkpoints['video_path'] = await upload_to_supabase(
+                        temp_video_file, 
+                        'video/mp4',
+                        'videos',
+                        clients=clients
+                    )
+                    await save_checkpoint(project['id'], checkpoints, 'uploaded', clients=clients)
 
-            # ビデオパスを更新
-            supabase.table('videos').update({
+                # スクリーンショットの生成と保存
+                if need_screenshots and temp_video_file:
+                    profiler.stage(project['id'], 'screenshots')
+                    checkpoints['screenshots'] = await generate_screenshots(temp_video_file, num_screenshots, clients=clients)
+                    await save_checkpoint(project['id'], checkpoints, 'screenshots', clients=clients)
+
+        video_path = checkpoints.get('video_path')
+        screenshots = checkpoints.get('screenshots', [])
+
+        # ビデオパスを更新
+        if video_path:
+            await clients.rest.table('videos').update({
                 'video_path': video_path
-            }).eq('id', video['id']).execute()
+            }).eq('id', video_id).execute()
 
-            # スクリーンショットの生成と保存
-            screenshots = await generate_screenshots(temp_video_file, num_screenshots)
+        # 音声の特徴量を計算してvideosに保存（失敗しても処理は続ける）
+        if need_features:
+            profiler.stage(project['id'], 'analyze')
+            try:
+                features = await analyze_audio(audio_source)
+                await clients.rest.table('videos').update({
+                    'audio_features': features
+                }).eq('id', video_id).execute()
+            except Exception as e:
+                print(f"Audio feature extraction failed: {str(e)}")
+            checkpoints['audio_features'] = True
+            await save_checkpoint(project['id'], checkpoints, 'analyzed', clients=clients)
 
-            # 文字起こしと翻訳を実行
-            transcription, translation = await transcribe_and_translate(temp_video_file)
+        # 文字起こしと翻訳を実行
+        if 'transcription' not in checkpoints:
+            profiler.stage(project['id'], 'transcribe')
+            result = await transcribe_audio(audio_source, clients=clients, backend=metadata.get('transcription_backend'))
+            checkpoints['transcription'] = result['text']
+            checkpoints['segments'] = result['segments']
+            await save_checkpoint(project['id'], checkpoints, 'transcribed', clients=clients)
+        if 'translation' not in checkpoints:
+            profiler.stage(project['id'], 'translate')
+            generated = await generate_video_metadata(checkpoints['transcription'], clients=clients)
+            checkpoints['translation'] = generated['translation']
+            checkpoints['video_metadata'] = {key: generated[key] for key in ('title', 'summary', 'hashtags')}
+            checkpoints['token_usage'] = {'translation': generated['usage']}
+            await save_checkpoint(project['id'], checkpoints, 'translated', clients=clients)
+        profiler.stage(project['id'], 'finalize')
+        transcription = checkpoints['transcription']
+        translation = checkpoints['translation']
+        video_metadata = checkpoints.get('video_metadata', {})
 
-            # ビデオ情報を更新
-            supabase.table('videos').update({
-                'transcription': transcription,
-                'translation': translation
-            }).eq('id', video['id']).execute()
-
-            # プロジェクトを更新（完了状態）
-            project = await save_project_to_db(
-                video_url=youtube_url,
-                video_path=video_path,
-                screenshots=screenshots,
-                status='completed',
-                metadata={
-                    'video_id': video['id'],
-                    'requested_screenshots': num_screenshots,
-                    'duration': video_info.get('duration'),
-                    'thumbnail_url': video_info.get('thumbnail')
-                }
-            )
+        # ビデオ情報を更新（検索インデックスもここで更新される）
+        await clients.rest.table('videos').update({
+            'transcription': transcription,
+            'transcription_segments': checkpoints.get('segments', []),
+            'translation': translation,
+            **video_metadata
+        }).eq('id', video_id).execute()
+
+        # プロジェクトを更新（完了状態）
+        screenshot_urls = [screenshot['url'] for screenshot in screenshots]
+        project = await complete_project(
+            project['id'],
+            video_path=video_path,
+            screenshots=screenshot_urls,
+            metadata={
+                **metadata,
+                'video_id': video_id,
+                'duration': video_info.get('duration'),
+                'thumbnail_url': video_info.get('thumbnail'),
+                'screenshot_variants': screenshots,
+                'token_usage': checkpoints.get('token_usage', {})
+            },
+            checkpoints={**checkpoints, 'stage': 'completed'},
+            clients=clients
+        )
+
+        # 処理完了ログを記録
+        await log_processing_status(video_id, 'completed', '処理が完了しました', clients=clients)
+
+        # 一時ファイルの削除
+        for temp_file in temp_files:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+        return {
+            'success': True,
+            'project_id': project['id'],
+            'video_id': video_id,
+            'video_path': video_path,
+            'media_url': signed_media_url(project['id']),
+            'screenshots': screenshot_urls,
+            'screenshot_variants': screenshots,
+            'transcription': transcription,
+            'translation': translation,
+            'title': video_metadata.get('title'),
+            'summary': video_metadata.get('summary'),
+            'hashtags': video_metadata.get('hashtags', []),
+            'status': 'completed'
+        }
+
+    except Exception as e:
+        # エラー発生時の処理（チェックポイントは残すので再実行時に続きから処理できる）
+        error_message = str(e)
+        await update_project_status(project['id'], 'error', error_message, clients=clients)
+        if 'video_id' in checkpoints:
+            await log_processing_status(checkpoints['video_id'], 'error', error_message, clients=clients)
+        raise
+
+async def recover_stuck_jobs(clients: Optional[ClientPool] = None):
+    """処理中のまま止まったプロジェクトを最後のチェックポイントから再開する"""
+    clients = clients or get_clients()
+    try:
+        stale_before = datetime.fromtimestamp(time.time() - JOB_STALE_SECONDS, timezone.utc).isoformat()
+        response = await clients.rest.table('projects').select('*') \
+            .in_('status', ['pending', 'processing']) \
+            .lt('updated_at', stale_before) \
+            .order('updated_at') \
+            .limit(RECOVERY_BATCH_SIZE) \
+            .execute()
+    except Exception as e:
+        print(f"Recovery sweep failed: {str(e)}")
+        return
+
+    for project in response.data:
+        # 他のインスタンスと同時に再開しないよう、updated_atが変わっていない場合だけ確保する
+        claimed = await clients.rest.table('projects').update({
+            'updated_at': datetime.now(timezone.utc).isoformat()
+        }).eq('id', project['id']).eq('updated_at', project['updated_at']).execute()
+        if not claimed.data:
+            continue
+
+        metadata = decode_json_field(project.get('metadata'), {})
+        if not metadata.get('video_info'):
+            await update_project_status(project['id'], 'error', '再開に必要な情報がありません', clients=clients)
+            continue
+
+        print(f"Resuming project {project['id']} from checkpoint")
+        try:
+            owner = f"user:{metadata['user_id']}" if metadata.get('user_id') else None
+            # 再開したジョブを待っている利用者はいないのでbatch扱いにする
+            async with governor.acquire('job', owner=owner, priority='batch',
+                                        cost=metadata['video_info'].get('duration') or 0):
+                await run_project_pipeline(claimed.data[0], clients=clients)
+        except Exception as e:
+            print(f"Recovery of project {project['id']} failed: {str(e)}")
+
+def lease_deadline(seconds: int = JOB_LEASE_SECONDS) -> str:
+    return datetime.fromtimestamp(time.time() + seconds, timezone.utc).isoformat()
+
+def job_queue_order(now: float, active_by_user: Dict[Optional[str], int]):
+    """待ち行列から取り出す順序（ResourceGovernorと同じ優先度・公平性・短い動画優先の規則）"""
+    def key(project: Dict):
+        metadata = decode_json_field(project.get('metadata'), {})
+        try:
+            waited = now - datetime.fromisoformat(project['created_at']).timestamp()
+        except (KeyError, TypeError, ValueError):
+            waited = 0
+        if waited >= STARVATION_SECONDS:
+            return (0, project.get('created_at') or '')
+        priority = metadata.get('priority', 'interactive')
+        return (
+            1,
+            PRIORITY_CLASSES.index(priority) if priority in PRIORITY_CLASSES else 0,
+            active_by_user.get(metadata.get('user_id'), 0),
+            (metadata.get('video_info') or {}).get('duration') or 0,
+            project.get('created_at') or ''
+        )
+    return key
+
+async def claim_jobs(worker_id: str, count: int, clients: Optional[ClientPool] = None) -> List[Dict]:
+    """pendingのプロジェクトか、リースが切れた処理中のプロジェクトを最大count件確保する"""
+    clients = clients or get_clients()
+    now = datetime.now(timezone.utc).isoformat()
+    pending = await clients.rest.table('projects').select('*') \
+        .eq('status', 'pending') \
+        .order('created_at') \
+        .limit(JOB_CLAIM_SCAN) \
+        .execute()
+    expired = await clients.rest.table('projects').select('*') \
+        .eq('status', 'processing') \
+        .lt('lease_expires_at', now) \
+        .order('lease_expires_at') \
+        .limit(JOB_CLAIM_SCAN) \
+        .execute()
+    candidates = pending.data + expired.data
+    if not candidates:
+        return []
+
+    # 他のワーカーで処理中のジョブが少ないユーザーを優先する
+    running = await clients.rest.table('projects').select('metadata') \
+        .eq('status', 'processing') \
+        .gte('lease_expires_at', now) \
+        .execute()
+    active_by_user: Dict[Optional[str], int] = {}
+    for row in running.data:
+        user_id = decode_json_field(row.get('metadata'), {}).get('user_id')
+        active_by_user[user_id] = active_by_user.get(user_id, 0) + 1
+    candidates.sort(key=job_queue_order(time.time(), active_by_user))
+
+    claimed = []
+    for project in candidates:
+        if len(claimed) >= count:
+            break
+        attempts = project.get('attempts') or 0
+        # updated_atが読み込んだときのままの場合だけ更新する（他のワーカーとの取り合いを防ぐ）
+        if attempts >= JOB_MAX_ATTEMPTS:
+            failed = await clients.rest.table('projects').update({
+                'status': 'error',
+                'error_message': f'{JOB_MAX_ATTEMPTS}回試行しても完了しませんでした',
+                'lease_owner': None,
+                'lease_expires_at': None,
+                'updated_at': now
+            }).eq('id', project['id']).eq('updated_at', project['updated_at']).execute()
+            if failed.data:
+                await enqueue_project_webhooks(failed.data[0], clients=clients)
+            continue
+        response = await clients.rest.table('projects').update({
+            'status': 'processing',
+            'lease_owner': worker_id,
+            'lease_expires_at': lease_deadline(),
+            'attempts': attempts + 1,
+            'updated_at': now
+        }).eq('id', project['id']).eq('updated_at', project['updated_at']).execute()
+        if response.data:
+            claimed.append(response.data[0])
+    return claimed
+
+async def heartbeat_lease(project_id: str, worker_id: str, job: asyncio.Task, clients: ClientPool):
+    """処理中はリースを延長し続け、他のワーカーに奪われた場合はジョブを止める"""
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            response = await clients.rest.table('projects').update({
+                'lease_expires_at': lease_deadline()
+            }).eq('id', project_id).eq('lease_owner', worker_id).execute()
+        except Exception as e:
+            # 一時的なエラーは次のハートビートで再試行する（期限までに延長できなければ他が再取得する）
+            print(f"Heartbeat failed for project {project_id}: {str(e)}")
+            continue
+        if not response.data:
+            print(f"Lease lost for project {project_id}, stopping job")
+            job.cancel()
+            return
+
+async def run_leased_job(project: Dict, worker_id: str, clients: ClientPool):
+    """リースを保持したままプロジェクトを処理し、終了したらリースを解放する"""
+    job = asyncio.create_task(run_project_pipeline(project, clients=clients))
+    heartbeat = asyncio.create_task(heartbeat_lease(project['id'], worker_id, job, clients))
+    finished = False
+    try:
+        await job
+        finished = True
+    except asyncio.CancelledError:
+        if not heartbeat.done():
+            # ワーカーの停止による中断（リースを失った場合はheartbeatが終わっている）
+            raise
+    except Exception as e:
+        # エラー状態への更新はrun_project_pipelineで済んでいる
+        finished = True
+        print(f"Project {project['id']} failed: {str(e)}")
+    finally:
+        heartbeat.cancel()
+        if not job.done():
+            job.cancel()
+            await asyncio.gather(job, return_exceptions=True)
+        try:
+            # 終わらなかったジョブはすぐ他のワーカーが拾えるよう期限切れにする
+            await clients.rest.table('projects').update({
+                'lease_owner': None,
+                'lease_expires_at': None if finished else datetime.now(timezone.utc).isoformat()
+            }).eq('id', project['id']).eq('lease_owner', worker_id).execute()
+        except Exception as e:
+            print(f"Failed to release lease for project {project['id']}: {str(e)}")
+
+async def run_worker(worker_id: Optional[str] = None):
+    """projectsテーブルを待ち行列としてジョブを確保・処理し続ける（worker.pyから起動）"""
+    import signal
+
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    clients = get_clients()
+    cleanup_stale_partials()
+    cleanup_media_cache()
+    if PROFILE_NEXT_JOBS:
+        profiler.arm(jobs=PROFILE_NEXT_JOBS)
+    if TRANSCRIPTION_BACKEND == 'local':
+        await asyncio.to_thread(get_local_whisper_model)
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stopping.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    print(f"Worker {worker_id} started (concurrency={WORKER_CONCURRENCY})")
+    running = set()
+    webhook_task = asyncio.create_task(run_webhook_dispatcher(clients)) if WEBHOOK_DISPATCHER else None
+    cleanup_task = asyncio.create_task(cleanup_caches_periodically())
+    try:
+        while not stopping.is_set():
+            claimed = []
+            free = WORKER_CONCURRENCY - len(running)
+            if free > 0:
+                try:
+                    claimed = await claim_jobs(worker_id, free, clients=clients)
+                except Exception as e:
+                    print(f"Failed to claim jobs: {str(e)}")
+            for project in claimed:
+                print(f"Worker {worker_id} claimed project {project['id']}")
+                task = asyncio.create_task(run_leased_job(project, worker_id, clients))
+                running.add(task)
+                task.add_done_callback(running.discard)
+            if not claimed:
+                try:
+                    await asyncio.wait_for(stopping.wait(), timeout=WORKER_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+    finally:
+        # 実行中のジョブは猶予時間だけ待ち、終わらなければ中断してリースを返す
+        if running:
+            print(f"Worker {worker_id} waiting for {len(running)} running jobs")
+            _, pending = await asyncio.wait(running, timeout=WORKER_SHUTDOWN_GRACE)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        cleanup_task.cancel()
+        await asyncio.gather(cleanup_task, return_exceptions=True)
+        if webhook_task:
+            webhook_task.cancel()
+            await asyncio.gather(webhook_task, return_exceptions=True)
+        await clients.aclose()
+        print(f"Worker {worker_id} stopped")
+
+def is_public_address(address: str) -> bool:
+    """インターネット上の宛先か（共有アドレス空間 100.64.0.0/10 なども除くためis_globalで判定する）"""
+    ip = ipaddress.ip_address(address.split('%')[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+async def resolve_webhook_address(url: str) -> str:
+    """Webhookの宛先のホスト名を解決し、接続してよいアドレスを返す
+
+    サーバー内部のサービスやクラウドのメタデータへ送らせないよう、解決したアドレスに
+    グローバルでないもの（ループバック・リンクローカル・プライベート・共有アドレス空間・予約済み）や
+    マルチキャストが1つでもあれば拒否する。
+    """
+    parsed = urlparse(url)
+    try:
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+    except ValueError:
+        raise ValueError("Invalid webhook URL port")
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(parsed.hostname, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise ValueError(f"Could not resolve webhook host: {e}")
+    addresses = [info[4][0] for info in infos]
+    if not addresses:
+        raise ValueError("Could not resolve webhook host")
+    if not WEBHOOK_ALLOW_PRIVATE and not all(is_public_address(address) for address in addresses):
+        raise ValueError("Webhook URL must resolve to a public address")
+    return addresses[0]
+
+async def validate_webhook_url(url: str) -> str:
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise HTTPException(status_code=400, detail="Invalid webhook URL. Must be an http(s) URL")
+    try:
+        await resolve_webhook_address(url)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid webhook URL: {str(e)}")
+    return url
+
+def build_webhook_event(project: Dict) -> Dict:
+    """プロジェクトの完了・エラーを通知するイベントを作る"""
+    metadata = decode_json_field(project.get('metadata'), {})
+    return {
+        'id': str(uuid.uuid4()),
+        'type': f"project.{project['status']}",
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'data': {
+            'project_id': project['id'],
+            'status': project['status'],
+            'error_message': project.get('error_message'),
+            'video_url': project.get('video_url'),
+            'video_id': metadata.get('video_id'),
+            'video_path': project.get('video_path'),
+            'screenshots': decode_json_field(project.get('screenshots'), []),
+            'result_url': f"/projects/{project['id']}"
+        }
+    }
+
+def sign_webhook(secret: str, timestamp: int, body: bytes) -> str:
+    """X-Webhook-Signatureヘッダーの値（t=送信時刻,v1=HMAC-SHA256("{t}.{body}")）"""
+    digest = hmac.new(secret.encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+_webhook_wakeup: Optional[asyncio.Event] = None
+
+async def enqueue_project_webhooks(project: Dict, clients: Optional[ClientPool] = None):
+    """リクエストで指定されたURLと、ユーザーが登録したWebhookへの配信を待ち行列に追加する
+
+    通知に失敗してもジョブの結果には影響させない。
+    """
+    clients = clients or get_clients()
+    try:
+        metadata = decode_json_field(project.get('metadata'), {})
+        targets = [(metadata['webhook_url'], None)] if metadata.get('webhook_url') else []
+        if metadata.get('user_id'):
+            hooks = await clients.rest.table('webhooks').select('id,url').eq('user_id', metadata['user_id']).execute()
+            targets.extend((hook['url'], hook['id']) for hook in hooks.data)
+        if not targets:
+            return
+        event = build_webhook_event(project)
+        now = datetime.now(timezone.utc).isoformat()
+        await clients.rest.table('webhook_deliveries').insert([{
+            'webhook_id': webhook_id,
+            'project_id': project['id'],
+            'url': url,
+            'event': event,
+            'status': 'pending',
+            'attempts': 0,
+            'next_attempt_at': now
+        } for url, webhook_id in targets]).execute()
+        print(f"Debug: Queued {len(targets)} webhook deliveries for project {project['id']}")
+        if _webhook_wakeup is not None:
+            _webhook_wakeup.set()
+    except Exception as e:
+        print(f"Failed to queue webhooks for project {project['id']}: {str(e)}")
+
+async def claim_webhook_deliveries(clients: ClientPool) -> List[Dict]:
+    """送信時刻になった配信を確保する（送信中は次の試行時刻を先に延ばして他のプロセスと重複させない）"""
+    now = datetime.now(timezone.utc).isoformat()
+    response = await clients.rest.table('webhook_deliveries').select('*') \
+        .eq('status', 'pending') \
+        .lte('next_attempt_at', now) \
+        .order('created_at') \
+        .limit(WEBHOOK_CLAIM_SCAN) \
+        .execute()
+    claimed = []
+    for delivery in response.data:
+        updated = await clients.rest.table('webhook_deliveries').update({
+            'next_attempt_at': lease_deadline(int(WEBHOOK_TIMEOUT * 3)),
+            'updated_at': now
+        }).eq('id', delivery['id']).eq('updated_at', delivery['updated_at']).execute()
+        if updated.data:
+            claimed.append(updated.data[0])
+    return claimed
+
+async def send_webhook_batch(url: str, webhook_id: Optional[str], deliveries: List[Dict], clients: ClientPool):
+    """同じ宛先へのイベントを1回のPOSTで送り、結果に応じて配信済み・再試行・失敗にする"""
+    error = None
+    try:
+        if webhook_id:
+            hooks = await clients.rest.table('webhooks').select('secret').eq('id', webhook_id).execute()
+            if not hooks.data:
+                raise Exception("Webhook was deleted")
+            secret = hooks.data[0]['secret']
+        else:
+            secret = WEBHOOK_SECRET
+            if not secret:
+                raise Exception("WEBHOOK_SECRET is not set")
+        body = json.dumps({
+            'events': [decode_json_field(delivery['event'], {}) for delivery in deliveries]
+        }, ensure_ascii=False).encode()
+        # 登録後にDNSの向き先を変えられても内部へ送らないよう、送信時にも確かめたアドレスへ直接接続する
+        # （証明書の検証とHostヘッダーは元のホスト名で行い、リダイレクトは追わない）
+        address = await resolve_webhook_address(url)
+        parsed = httpx.URL(url)
+        response = await clients.http.post(
+            parsed.copy_with(host=address), content=body, timeout=WEBHOOK_TIMEOUT, follow_redirects=False,
+            extensions={'sni_hostname': parsed.host},
+            headers={
+                'Host': parsed.host if parsed.port is None else f"{parsed.host}:{parsed.port}",
+                'Content-Type': 'application/json',
+                'X-Webhook-Signature': sign_webhook(secret, int(time.time()), body)
+            }
+        )
+        if response.status_code >= 300:
+            error = f"HTTP {response.status_code}"
+    except Exception as e:
+        error = str(e) or type(e).__name__
+
+    now = datetime.now(timezone.utc).isoformat()
+    if error is None:
+        await clients.rest.table('webhook_deliveries').update({
+            'status': 'delivered',
+            'attempts': deliveries[0].get('attempts', 0) + 1,
+            'last_error': None,
+            'updated_at': now
+        }).in_('id', [delivery['id'] for delivery in deliveries]).execute()
+        print(f"Debug: Delivered {len(deliveries)} webhook events to {url}")
+        return
+
+    print(f"Webhook delivery to {url} failed: {error}")
+    for delivery in deliveries:
+        attempts = (delivery.get('attempts') or 0) + 1
+        retry_in = min(WEBHOOK_RETRY_BASE * 2 ** (attempts - 1), WEBHOOK_RETRY_MAX)
+        await clients.rest.table('webhook_deliveries').update({
+            'status': 'failed' if attempts >= WEBHOOK_MAX_ATTEMPTS else 'pending',
+            'attempts': attempts,
+            'next_attempt_at': lease_deadline(int(retry_in)),
+            'last_error': error[:500],
+            'updated_at': now
+        }).eq('id', delivery['id']).execute()
+
+async def deliver_pending_webhooks(clients: ClientPool) -> int:
+    """送信時刻になった配信を宛先ごとにまとめて送る"""
+    deliveries = await claim_webhook_deliveries(clients)
+    batches: Dict[tuple, List[Dict]] = {}
+    for delivery in deliveries:
+        batches.setdefault((delivery['url'], delivery.get('webhook_id')), []).append(delivery)
+    await asyncio.gather(*(
+        send_webhook_batch(url, webhook_id, batch[i:i + WEBHOOK_BATCH_SIZE], clients)
+        for (url, webhook_id), batch in batches.items()
+        for i in range(0, len(batch), WEBHOOK_BATCH_SIZE)
+    ))
+    return len(deliveries)
+
+async def run_webhook_dispatcher(clients: Optional[ClientPool] = None):
+    """Webhookの配信を続ける（新しいイベントが追加されると少し待ってからまとめて送る）"""
+    global _webhook_wakeup
+    clients = clients or get_clients()
+    _webhook_wakeup = asyncio.Event()
+    while True:
+        try:
+            await deliver_pending_webhooks(clients)
+        except Exception as e:
+            print(f"Webhook dispatch failed: {str(e)}")
+        try:
+            await asyncio.wait_for(_webhook_wakeup.wait(), timeout=WEBHOOK_POLL_SECONDS)
+            await asyncio.sleep(WEBHOOK_BATCH_WINDOW)
+        except asyncio.TimeoutError:
+            pass
+        _webhook_wakeup.clear()
+
+@app.post("/webhooks")
+async def create_webhook(url: str = Form(...), clients: ClientPool = Depends(get_clients),
+                         user: Optional[Dict] = Depends(get_current_user)):
+    """ログイン中のユーザーの全プロジェクトの完了・エラーを通知するWebhookを登録する（secretは登録時のみ返す）"""
+    if not user:
+        raise HTTPException(status_code=401, detail="ログインが必要です")
+    response = await clients.rest.table('webhooks').insert({
+        'user_id': user['id'],
+        'url': await validate_webhook_url(url),
+        'secret': f"whsec_{secrets.token_urlsafe(32)}"
+    }).execute()
+    webhook = response.data[0]
+    return {'id': webhook['id'], 'url': webhook['url'], 'secret': webhook['secret'], 'created_at': webhook.get('created_at')}
+
+@app.get("/webhooks")
+async def list_webhooks(clients: ClientPool = Depends(get_clients), user: Optional[Dict] = Depends(get_current_user)):
+    if not user:
+        raise HTTPException(status_code=401, detail="ログインが必要です")
+    response = await clients.rest.table('webhooks').select('id,url,created_at').eq('user_id', user['id']).execute()
+    return {'items': response.data}
+
+@app.delete("/webhooks/{webhook_id}")
+async def delete_webhook(webhook_id: str, clients: ClientPool = Depends(get_clients),
+                         user: Optional[Dict] = Depends(get_current_user)):
+    if not user:
+        raise HTTPException(status_code=401, detail="ログインが必要です")
+    response = await clients.rest.table('webhooks').delete().eq('id', webhook_id).eq('user_id', user['id']).execute()
+    if not response.data:
+        raise HTTPException(status_code=404, detail="Webhook not found")
+    return {'success': True}
+
+@app.get("/projects/{project_id}")
+async def get_project(project_id: str, clients: ClientPool = Depends(get_clients),
+                      user: Optional[Dict] = Depends(get_current_user)):
+    """プロジェクトの状態を返す（完了していれば/processと同じ形式の結果も含める）"""
+    response = await clients.rest.table('projects').select('*').eq('id', project_id).execute()
+    if not response.data:
+        raise HTTPException(status_code=404, detail="Project not found")
+    project = response.data[0]
+    check_project_access(project, user)
+    metadata = decode_json_field(project.get('metadata'), {})
+    result = {
+        'project_id': project['id'],
+        'status': project['status'],
+        'error_message': project.get('error_message'),
+        'created_at': project.get('created_at'),
+        'updated_at': project.get('updated_at'),
+        'media_url': signed_media_url(project['id']) if project_media_source(project) else None
+    }
+    if project['status'] == 'completed' and metadata.get('video_id'):
+        videos = await clients.rest.table('videos').select('transcription,translation,title,summary,hashtags') \
+            .eq('id', metadata['video_id']).execute()
+        video = videos.data[0] if videos.data else {}
+        result.update({
+            'success': True,
+            'video_id': metadata['video_id'],
+            'video_path': project.get('video_path'),
+            'screenshots': decode_json_field(project.get('screenshots'), []),
+            'screenshot_variants': metadata.get('screenshot_variants', []),
+            'transcription': video.get('transcription'),
+            'translation': video.get('translation'),
+            'title': video.get('title'),
+            'summary': video.get('summary'),
+            'hashtags': decode_json_field(video.get('hashtags'), []) or []
+        })
+    return result
+
+# 既に圧縮されている形式はZIPで再圧縮せずそのまま格納する
+EXPORT_STORED_EXTENSIONS = ('.mp4', '.webm', '.m4a', '.webp', '.avif', '.jpg', '.jpeg', '.png')
+
+def format_timestamp(seconds: float, separator: str = ',') -> str:
+    """秒をSRT（00:00:01,000）/ VTT（00:00:01.000）の時刻表記にする"""
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    secs, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}{separator}{milliseconds:03d}"
+
+def segments_to_srt(segments: List[Dict]) -> str:
+    return "\n".join(
+        f"{i}\n{format_timestamp(seg['start'])} --> {format_timestamp(seg['end'])}\n{seg['text']}\n"
+        for i, seg in enumerate(segments, 1)
+    )
+
+def segments_to_vtt(segments: List[Dict]) -> str:
+    return "WEBVTT\n\n" + "\n".join(
+        f"{format_timestamp(seg['start'], '.')} --> {format_timestamp(seg['end'], '.')}\n{seg['text']}\n"
+        for seg in segments
+    )
+
+async def read_stored_file(url: str, clients: ClientPool) -> AsyncIterator[bytes]:
+    """保存済みのファイルを少しずつ読み出す（ローカルストレージはファイル、Supabaseはhttp）"""
+    if url.startswith(LOCAL_STORAGE_URL + '/'):
+        path = os.path.join(LOCAL_STORAGE_DIR, url[len(LOCAL_STORAGE_URL) + 1:])
+        with open(path, 'rb') as f:
+            while chunk := await asyncio.to_thread(f.read, STREAM_CHUNK_SIZE):
+                yield chunk
+        return
+    async for chunk in stream_remote_file(url, clients=clients):
+        yield chunk
+
+class ZipStream:
+    """ZipFileの出力を溜めずに取り出すための書き込み先（シークできないので
+    ZipFileはデータディスクリプタ付きで書き出す）"""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.offset = 0
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+async def check_stored_file(url: str, clients: ClientPool) -> Optional[str]:
+    """保存済みのファイルを取得できるか確かめる（できなければ理由を返す）"""
+    try:
+        if url.startswith(LOCAL_STORAGE_URL + '/'):
+            path = os.path.join(LOCAL_STORAGE_DIR, url[len(LOCAL_STORAGE_URL) + 1:])
+            return None if await asyncio.to_thread(os.path.isfile, path) else "ファイルがありません"
+        response = await clients.http.head(url, follow_redirects=True)
+        return None if response.status_code < 400 else f"HTTP {response.status_code}"
+    except Exception as e:
+        return str(e) or type(e).__name__
+
+async def stream_project_zip(entries: List[tuple], clients: ClientPool, errors_name: str = 'ERRORS.txt') -> AsyncIterator[bytes]:
+    """(名前, bytesまたはURL) のリストをZIPとして順に書き出す
+
+    URLのファイルは先にまとめて取得できるか確かめ、できないものは含めない。
+    途中で読めなくなったファイルはそこまでの内容で閉じる。含められなかった・途中で切れた
+    ファイルは最後に errors_name へ一覧にする。
+    """
+    checks = await asyncio.gather(*(
+        check_stored_file(source, clients) for _, source in entries if not isinstance(source, bytes)
+    ))
+    failures = iter(checks)
+    errors = []
+    sink = ZipStream()
+    with zipfile.ZipFile(sink, 'w') as archive:
+        for name, source in entries:
+            if not isinstance(source, bytes):
+                failure = next(failures)
+                if failure:
+                    print(f"Export: skipping {name}: {failure}")
+                    errors.append(f"{name}: 取得できませんでした（{failure}）")
+                    continue
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            stored = name.lower().endswith(EXPORT_STORED_EXTENSIONS)
+            info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+            try:
+                with archive.open(info, 'w', force_zip64=True) as entry:
+                    if isinstance(source, bytes):
+                        entry.write(source)
+                    else:
+                        async for chunk in read_stored_file(source, clients):
+                            entry.write(chunk)
+                            yield sink.drain()
+            except Exception as e:
+                # 途中まで送ったレスポンスは取り消せないので、読めたところまでで閉じる
+                print(f"Export: failed to add {name}: {str(e)}")
+                errors.append(f"{name}: 途中で読み込みに失敗したため不完全です（{str(e) or type(e).__name__}）")
+            yield sink.drain()
+        if errors:
+            archive.writestr(errors_name, "\n".join(errors) + "\n", compress_type=zipfile.ZIP_DEFLATED)
+    yield sink.drain()
 
-            # 処理完了ログを記録
-            await log_processing_status(video['id'], 'completed', '処理が完了しました')
+def project_media_source(project: Dict) -> Optional[tuple]:
+    """プレビューに使える動画を探す（('file', パス) か ('url', URL)、なければNone）
 
-            # 一時ファイルの削除
-            os.remove(temp_video_file)
+    fast-start化したキャッシュ、処理中のダウンロード済みファイル、ローカルストレージの
+    ファイルの順に探し、どれもなければStorageの公開URLを返す。
+    """
+    checkpoints = decode_checkpoints(project.get('checkpoints'))
+    video_url = project.get('video_path') or checkpoints.get('video_path')
+    candidates = [media_cache_path(project['id']), checkpoints.get('downloads', {}).get('video')]
+    if video_url and video_url.startswith(LOCAL_STORAGE_URL + '/'):
+        candidates.append(os.path.join(LOCAL_STORAGE_DIR, video_url[len(LOCAL_STORAGE_URL) + 1:]))
+    for path in candidates:
+        if path and os.path.isfile(path):
+            return ('file', path)
+    return ('url', video_url) if video_url else None
 
+def parse_range_header(value: Optional[str], size: int) -> Optional[tuple]:
+    """Rangeヘッダーから (開始, 終了) を返す。複数範囲や不正な値ならNone（全体を返す）
+
+    範囲がファイルの外にある場合は416を返す。
+    """
+    if not value or not value.startswith('bytes=') or ',' in value:
+        return None
+    start, _, end = value[6:].strip().partition('-')
+    try:
+        if start:
+            start, end = int(start), (int(end) if end else size - 1)
+        else:
+            start, end = max(size - int(end), 0), size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable",
+                            headers={'Content-Range': f"bytes */{size}"})
+    return start, min(end, size - 1)
+
+class FileRangeResponse(Response):
+    """ファイルの指定範囲を返す
+
+    サーバーがASGIのzerocopysend拡張に対応していればsendfileでカーネルから直接送り、
+    対応していなければスレッドでチャンク単位に読み出して送る。
+    """
+
+    def __init__(self, path: str, start: int, end: int, status_code: int = 200,
+                 headers: Optional[Dict] = None, media_type: Optional[str] = None):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        self.init_headers({**(headers or {}), 'content-length': str(end - start + 1)})
+
+    async def __call__(self, scope, receive, send):
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        if scope['method'] == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            return
+        count = self.end - self.start + 1
+        with open(self.path, 'rb') as f:
+            if 'http.response.zerocopysend' in scope.get('extensions', {}):
+                await send({'type': 'http.response.zerocopysend', 'file': f,
+                            'offset': self.start, 'count': count, 'more_body': False})
+                return
+            f.seek(self.start)
+            while count > 0:
+                chunk = await asyncio.to_thread(f.read, min(STREAM_CHUNK_SIZE, count))
+                if not chunk:
+                    break
+                count -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': count > 0})
+            if count > 0:
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+def serve_media_file(request: Request, path: str) -> Response:
+    stat = os.stat(path)
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = {'accept-ranges': 'bytes', 'etag': etag, 'cache-control': 'no-cache'}
+    media_type = mimetypes.guess_type(path)[0] or 'video/mp4'
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers=headers)
+    byte_range = None
+    if request.headers.get('if-range', etag) == etag:
+        byte_range = parse_range_header(request.headers.get('range'), stat.st_size)
+    if byte_range is None:
+        return FileRangeResponse(path, 0, stat.st_size - 1, headers=headers, media_type=media_type)
+    start, end = byte_range
+    headers['content-range'] = f"bytes {start}-{end}/{stat.st_size}"
+    return FileRangeResponse(path, start, end, status_code=206, headers=headers, media_type=media_type)
+
+async def proxy_media(request: Request, url: str, clients: ClientPool) -> Response:
+    """StorageのファイルをRange付きで中継する"""
+    forwarded = {name: request.headers[name] for name in ('range', 'if-range', 'if-none-match') if name in request.headers}
+    upstream = await clients.http.send(
+        clients.http.build_request('GET', url, headers=forwarded, timeout=httpx.Timeout(HTTP_TIMEOUT, read=60.0)),
+        stream=True
+    )
+    if upstream.status_code >= 400 and upstream.status_code != 416:
+        await upstream.aclose()
+        raise HTTPException(status_code=502, detail=f"Failed to fetch media: {upstream.status_code}")
+    headers = {name: upstream.headers[name] for name in
+               ('content-length', 'content-range', 'accept-ranges', 'etag', 'last-modified', 'cache-control')
+               if name in upstream.headers}
+    return StreamingResponse(
+        upstream.aiter_raw(STREAM_CHUNK_SIZE),
+        status_code=upstream.status_code,
+        headers=headers,
+        media_type=upstream.headers.get('content-type', 'video/mp4'),
+        background=BackgroundTask(upstream.aclose)
+    )
+
+@app.api_route("/projects/{project_id}/media", methods=["GET", "HEAD"])
+async def project_media(project_id: str, request: Request, expires: Optional[int] = Query(None),
+                        signature: Optional[str] = Query(None), clients: ClientPool = Depends(get_clients)):
+    """プロジェクトの動画をRange対応で返す（処理中でもダウンロード済みならプレビューできる）
+
+    /projects/{id} や /process が返す署名付きURLか、Authorizationヘッダーで本人であることを確かめる。
+    """
+    response = await clients.rest.table('projects').select('*').eq('id', project_id).execute()
+    if not response.data:
+        raise HTTPException(status_code=404, detail="Project not found")
+    signed = expires is not None and signature and expires >= time.time() and \
+        hmac.compare_digest(signature, media_url_signature(project_id, expires))
+    if not signed:
+        check_project_access(response.data[0], await get_current_user(request, clients))
+    source = project_media_source(response.data[0])
+    if source is None:
+        raise HTTPException(status_code=404, detail="Media is not ready")
+    kind, location = source
+    if kind == 'file':
+        return serve_media_file(request, location)
+    return await proxy_media(request, location, clients)
+
+@app.get("/projects/{project_id}/export")
+async def export_project(project_id: str, clients: ClientPool = Depends(get_clients),
+                         user: Optional[Dict] = Depends(get_current_user)):
+    """動画・スクリーンショット・Markdownレポート・字幕をZIPにしてストリーミングで返す"""
+    response = await clients.rest.table('projects').select('*').eq('id', project_id).execute()
+    if not response.data:
+        raise HTTPException(status_code=404, detail="Project not found")
+    project = response.data[0]
+    check_project_access(project, user)
+    if project['status'] != 'completed':
+        raise HTTPException(status_code=409, detail="Project is not completed")
+
+    metadata = decode_json_field(project.get('metadata'), {})
+    video = {}
+    if metadata.get('video_id'):
+        videos = await clients.rest.table('videos') \
+            .select('youtube_id,youtube_url,transcription,transcription_segments,translation') \
+            .eq('id', metadata['video_id']).execute()
+        video = videos.data[0] if videos.data else {}
+
+    transcription = video.get('transcription') or ''
+    translation = video.get('translation') or ''
+    segments = decode_json_field(video.get('transcription_segments'), []) or []
+    try:
+        processed_at = datetime.fromisoformat(project['updated_at'])
+    except (KeyError, TypeError, ValueError):
+        processed_at = None
+    entries = [('report.md', build_markdown_report(project['video_url'], transcription, translation, processed_at).encode())]
+    if segments:
+        entries.append(('transcript.srt', segments_to_srt(segments).encode()))
+        entries.append(('transcript.vtt', segments_to_vtt(segments).encode()))
+    if project.get('video_path'):
+        entries.append((f"video{os.path.splitext(project['video_path'])[1] or '.mp4'}", project['video_path']))
+    for i, url in enumerate(decode_json_field(project.get('screenshots'), []) or [], 1):
+        entries.append((f"screenshots/screenshot_{i:02d}{os.path.splitext(url)[1]}", url))
+
+    base_name = video.get('youtube_id') or project_id
+    return StreamingResponse(
+        stream_project_zip([(f"{base_name}/{name}", source) for name, source in entries], clients,
+                           errors_name=f"{base_name}/ERRORS.txt"),
+        media_type='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{base_name}.zip"'}
+    )
+
+@app.post("/process")
+async def process_video(
+    request: Request,
+    youtube_url: str = Form(...),
+    num_screenshots: int = Form(3),
+    store_video: bool = Form(True),
+    priority: str = Form('interactive'),
+    transcription_backend: Optional[str] = Form(None),
+    webhook_url: Optional[str] = Form(None),
+    clients: ClientPool = Depends(get_clients),
+    user: Optional[Dict] = Depends(get_current_user)
+):
+    if priority not in PRIORITY_CLASSES:
+        raise HTTPException(status_code=400, detail=f"Invalid priority. Must be one of: {', '.join(PRIORITY_CLASSES)}")
+    if transcription_backend and transcription_backend not in available_transcription_backends():
+        raise HTTPException(status_code=400, detail=f"Invalid transcription_backend. Must be one of: {', '.join(available_transcription_backends())}")
+    if webhook_url:
+        if not user:
+            raise HTTPException(status_code=401, detail="webhook_url の指定にはログインが必要です")
+        if not WEBHOOK_SECRET:
+            raise HTTPException(status_code=400, detail="webhook_url is not available: WEBHOOK_SECRET is not set")
+        await validate_webhook_url(webhook_url)
+
+    key = usage_key(request, user)
+    reserved = 0
+    try:
+        retry_after = rate_limiter.take(key)
+        if retry_after is not None:
+            print(f"Rate limited: {key}")
+            return JSONResponse({
+                'success': False,
+                'error': 'リクエストが多すぎます。しばらくしてから再度お試しください'
+            }, status_code=429, headers={'Retry-After': str(retry_after)})
+
+        # 動画の長さで1日の処理時間クォータを先に確保する
+        video_info = await check_video_duration(youtube_url)
+        if video_info['is_valid']:
+            reserved = video_info.get('duration') or 0
+            usage_quota.reserve(key, reserved)
+
+        # queueモードではプロジェクトを登録するだけで、処理はワーカーが行う
+        if JOB_MODE == 'queue':
+            project = await create_job_project(youtube_url, num_screenshots, store_video, clients,
+                                               video_info=video_info, user_id=user['id'] if user else None,
+                                               priority=priority, transcription_backend=transcription_backend,
+                                               webhook_url=webhook_url, quota_key=key, quota_seconds=reserved)
             return JSONResponse({
                 'success': True,
                 'project_id': project['id'],
-                'video_id': video['id'],
-                'video_path': video_path,
-                'screenshots': screenshots,
-                'transcription': transcription,
-                'translation': translation,
-                'status': 'completed'
-            })
+                'status': project['status']
+            }, status_code=202)
 
-        except Exception as e:
-            # エラー発生時の処理
-            error_message = str(e)
-            await update_project_status(project['id'], 'error', error_message)
-            if 'video' in locals():
-                await log_processing_status(video['id'], 'error', error_message)
-            raise
+        # 同時実行数を超えた分は待ち行列に入れ、待ち行列も一杯なら429を返す
+        # 空きが出たらinteractive、実行中の件数が少ないユーザー、短い動画の順に処理する
+        async with governor.acquire('job', owner=key, priority=priority, cost=video_info.get('duration') or 0):
+            result = await process_video_job(youtube_url, num_screenshots, store_video, clients,
+                                             video_info=video_info, user_id=user['id'] if user else None,
+                                             priority=priority, transcription_backend=transcription_backend,
+                                             webhook_url=webhook_url)
+        return JSONResponse(result)
+
+    except QuotaExceeded as e:
+        print(f"Quota exceeded: {key}")
+        return JSONResponse({
+            'success': False,
+            'error': f'本日の処理時間の上限に達しました（残り{int(e.remaining_seconds)}秒）'
+        }, status_code=429, headers={'Retry-After': str(e.retry_after)})
+
+    except ResourceBusy as e:
+        usage_quota.refund(key, reserved)
+        print(f"Rejecting job: {str(e)}")
+        return JSONResponse({
+            'success': False,
+            'error': 'サーバーが混み合っています。しばらくしてから再度お試しください'
+        }, status_code=429, headers={'Retry-After': str(e.retry_after)})
 
     except Exception as e:
         print(f"Error: {str(e)}")
+        usage_quota.refund(key, reserved)
         return JSONResponse({
             'success': False,
             'error': str(e)
         })
 
+# 一覧APIで返せる列（既定の列には長い文字起こし・翻訳を含めない）
+LIST_FIELDS = {
+    'projects': {
+        'allowed': ['id', 'video_url', 'video_path', 'screenshots', 'status', 'error_message', 'metadata', 'created_at', 'updated_at'],
+        'default': ['id', 'video_url', 'video_path', 'screenshots', 'status', 'error_message', 'created_at', 'updated_at']
+    },
+    'videos': {
+        'allowed': ['id', 'youtube_id', 'youtube_url', 'video_path', 'transcription', 'translation', 'title', 'summary', 'hashtags', 'audio_features', 'thumbnail_url', 'duration', 'created_at', 'updated_at'],
+        'default': ['id', 'youtube_id', 'youtube_url', 'video_path', 'title', 'thumbnail_url', 'duration', 'created_at', 'updated_at']
+    }
+}
+LIST_MAX_LIMIT = 100
+# 一覧のmetadataから除くキー（持ち主・通知先・クォータの集計キー（IPアドレスを含む））
+PRIVATE_METADATA_KEYS = ('user_id', 'webhook_url', 'quota_key', 'quota_seconds', 'quota_refunded')
+
+def encode_cursor(row: Dict) -> str:
+    """最後の行の(created_at, id)をカーソル文字列にする"""
+    raw = json.dumps([row['created_at'], row['id']]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor: str):
+    """カーソル文字列を(created_at, id)に戻す
+
+    値はPostgRESTのフィルタ文字列に埋め込むので、日時とUUIDとして正しい形式のものだけを受け付ける。
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        datetime.fromisoformat(created_at)
+        return created_at, str(uuid.UUID(row_id))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def parse_fields(table: str, fields: Optional[str]) -> List[str]:
+    """fieldsパラメータを検証する（カーソル用にcreated_atとidは必ず含める）"""
+    config = LIST_FIELDS[table]
+    if not fields:
+        return config['default']
+    requested = [f.strip() for f in fields.split(',') if f.strip()]
+    unknown = [f for f in requested if f not in config['allowed']]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return list(dict.fromkeys(requested + ['created_at', 'id']))
+
+def filter_by_owner(query, user: Optional[Dict]):
+    """check_project_accessと同じ範囲に絞る（ログイン中は本人のもの、未ログインは持ち主のないもの、管理者はすべて）"""
+    if user and user['id'] in ADMIN_USER_IDS:
+        return query
+    if user:
+        return query.eq('user_id', user['id'])
+    return query.is_('user_id', 'null')
+
+async def visible_video_ids(user: Optional[Dict], clients: ClientPool) -> List[str]:
+    """見られるプロジェクトが参照している動画のID（videosは持ち主を持たないためprojects経由で絞る）"""
+    response = await filter_by_owner(
+        clients.rest.table('projects').select('metadata').eq('status', 'completed'), user
+    ).execute()
+    video_ids = (decode_json_field(row.get('metadata'), {}).get('video_id') for row in response.data or [])
+    return list(dict.fromkeys(video_id for video_id in video_ids if video_id))
+
+async def list_rows(table: str, fields: List[str], limit: int, cursor: Optional[str] = None, filters: Optional[Dict] = None, clients: Optional[ClientPool] = None, scope=None) -> Dict:
+    """created_at, idの降順でキーセットページングした一覧を返す（scopeはクエリを絞り込む関数）"""
+    clients = clients or get_clients()
+    query = clients.rest.table(table).select(','.join(fields))
+    for column, value in (filters or {}).items():
+        query = query.eq(column, value)
+    if scope:
+        query = scope(query)
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        query = query.or_(f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt."{row_id}")')
+    # 次のページの有無を判定するため1件多く取得する
+    response = await query.order('created_at', desc=True).order('id', desc=True).limit(limit + 1).execute()
+
+    rows = response.data
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    for row in rows:
+        for column in ('screenshots', 'metadata'):
+            if column in row:
+                row[column] = decode_json_field(row[column], row[column])
+        if isinstance(row.get('metadata'), dict):
+            row['metadata'] = {k: v for k, v in row['metadata'].items() if k not in PRIVATE_METADATA_KEYS}
+    return {
+        'items': rows,
+        'next_cursor': encode_cursor(rows[-1]) if has_more and rows else None
+    }
+
+def etag_response(request: Request, payload: Dict) -> Response:
+    """内容のハッシュをETagにし、If-None-Matchが一致すれば304を返す"""
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode()
+    etag = f'W/"{hashlib.sha1(body).hexdigest()}"'
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+    if etag in [tag.strip() for tag in request.headers.get('if-none-match', '').split(',')]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type='application/json', headers=headers)
+
+@app.get("/projects")
+async def list_projects(
+    request: Request,
+    limit: int = Query(20, ge=1, le=LIST_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    status: Optional[str] = None,
+    clients: ClientPool = Depends(get_clients),
+    user: Optional[Dict] = Depends(get_current_user)
+):
+    filters = {'status': status} if status else None
+    result = await list_rows('projects', parse_fields('projects', fields), limit, cursor, filters, clients=clients,
+                             scope=lambda query: filter_by_owner(query, user))
+    return etag_response(request, result)
+
+@app.get("/videos")
+async def list_videos(
+    request: Request,
+    limit: int = Query(20, ge=1, le=LIST_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    clients: ClientPool = Depends(get_clients),
+    user: Optional[Dict] = Depends(get_current_user)
+):
+    scope = None
+    if not (user and user['id'] in ADMIN_USER_IDS):
+        video_ids = await visible_video_ids(user, clients)
+        scope = lambda query: query.in_('id', video_ids)
+    result = await list_rows('videos', parse_fields('videos', fields), limit, cursor, clients=clients, scope=scope)
+    return etag_response(request, result)
+
+@app.get("/search")
+async def search_videos(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=LIST_MAX_LIMIT),
+    clients: ClientPool = Depends(get_clients)
+):
+    """文字起こし・翻訳を全文検索し、一致したセグメントのスニペットと時刻を返す"""
+    try:
+        response = await clients.rest.rpc('search_videos', {
+            'search_query': q.strip(),
+            'result_limit': limit
+        }).execute()
+        # PGroonga・SQLiteとも一致したテキストを返すので、同じ方法でエスケープしたスニペットにする
+        items = response.data or []
+        for item in items:
+            item['matches'] = decode_json_field(item.get('matches'), []) or []
+            for match in item['matches']:
+                match['snippet'] = like_snippet(match.pop('text', None) or '', q.strip())
+        return {'items': items}
+    except Exception as e:
+        print(f"Search error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"検索に失敗しました: {str(e)}")
+
 @app.get("/auth/callback")
 async def auth_callback(request: Request):
     try:
@@ -531,14 +4255,7 @@ async def auth_callback(request: Request):
         
         # ハッシュパラメータがある場合は処理
         if "#" in str(request.url):
-            return templates.TemplateResponse("index.html", {
-                "request": request,
-                "config": {
-                    "SUPABASE_URL": os.getenv("SUPABASE_URL"),
-                    "SUPABASE_ANON_KEY": os.getenv("SUPABASE_KEY"),
-                    "SITE_URL": site_url
-                }
-            })
+            return render_index(request)
         
         # ハッシュがない場合はホームにリダイレクト
         return RedirectResponse(url=site_url)
@@ -574,10 +4291,51 @@ async def debug_info(request: Request):
         "headers": dict(request.headers)
     }
 
+@app.get("/admin/profiler")
+async def profiler_status(admin: Dict = Depends(require_admin)):
+    return profiler.status()
+
+@app.post("/admin/profiler")
+async def arm_profiler(
+    jobs: int = Form(0),
+    seconds: float = Form(0),
+    interval_ms: Optional[float] = Form(None),
+    admin: Dict = Depends(require_admin)
+):
+    """次のjobs件のジョブ、またはseconds秒の間に始まるジョブのサンプリングを有効にする"""
+    if jobs <= 0 and seconds <= 0:
+        raise HTTPException(status_code=400, detail="jobs or seconds must be positive")
+    if interval_ms is not None and not 1 <= interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="interval_ms must be between 1 and 1000")
+    profiler.arm(jobs=jobs, seconds=seconds, interval=interval_ms / 1000 if interval_ms else None)
+    print(f"Profiler armed by {admin['id']}: jobs={jobs}, seconds={seconds}")
+    return profiler.status()
+
+@app.delete("/admin/profiler")
+async def disarm_profiler(admin: Dict = Depends(require_admin)):
+    profiler.disarm()
+    return profiler.status()
+
+@app.get("/admin/profiler/{project_id}")
+async def get_profile(project_id: str, stage: Optional[str] = None, admin: Dict = Depends(require_admin)):
+    """ジョブのプロファイルをcollapsed形式で返す（stageを指定するとそのステージだけ）"""
+    path = os.path.join(PROFILE_DIR, f"{project_id}.folded")
+    if not re.fullmatch(r'[0-9a-fA-F-]+', project_id) or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    with open(path) as f:
+        lines = f.readlines()
+    if stage:
+        lines = [line for line in lines if line.startswith(f"{stage};")]
+    return Response(''.join(lines), media_type='text/plain; charset=utf-8')
+
+@app.get("/debug/resources")
+async def debug_resources():
+    return {**governor.stats(), 'yt_dlp_pool': ydl_pool.stats()}
+
 @app.get("/debug/env")
 async def debug_env():
     cookies = os.getenv("YOUTUBE_COOKIES", "Not set")
-    cookies_path = '/tmp/cookies.txt'
+    cookies_path = YOUTUBE_COOKIES_PATH
     
     # クッキーファイルの内容も確認
     cookie_content = None
@@ -597,12 +4355,8 @@ async def debug_env():
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 os.makedirs('/tmp/outputs', exist_ok=True)
 
-# アプリケーション起動時にクッキーファイルを作成
-if os.getenv('YOUTUBE_COOKIES'):
-    cookies_path = '/tmp/cookies.txt'
-    with open(cookies_path, 'w') as f:
-        f.write(os.getenv('YOUTUBE_COOKIES'))
-    print(f"Debug: Initial cookies file created at {cookies_path}")  # デバッグ用
+# アプリケーション起動時にクッキーファイルを作成（以降は内容が変わったときだけ書き直す）
+cookie_jar.refresh()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,8 @@
+-- ステージごとのチェックポイント（再開用）
+alter table projects
+  add column if not exists checkpoints jsonb default '{}'::jsonb;
+
+-- 停止したジョブの検索用
+create index if not exists projects_status_updated_at_idx
+  on projects (status, updated_at)
+  where status in ('pending', 'processing');
@@ -0,0 +1,13 @@
+-- /projects と /videos のキーセットページング用（created_at, id の降順）
+create index if not exists projects_created_at_id_idx
+  on projects (created_at desc, id desc);
+
+create index if not exists projects_status_created_at_id_idx
+  on projects (status, created_at desc, id desc);
+
+create index if not exists videos_created_at_id_idx
+  on videos (created_at desc, id desc);
+
+-- save_video_to_db の既存動画検索用
+create index if not exists videos_youtube_id_idx
+  on videos (youtube_id);
@@ -0,0 +1,58 @@
+-- 文字起こしのセグメント（Whisperのverbose_json: start / end / text）
+alter table videos
+  add column if not exists transcription_segments jsonb default '[]'::jsonb;
+
+-- 日本語を分かち書きなしで検索できるPGroongaで全文検索する
+-- インデックスはvideosへの書き込み時に差分更新される
+create extension if not exists pgroonga;
+
+create index if not exists videos_transcript_search_idx
+  on videos using pgroonga (transcription, translation);
+
+-- 一致した動画をスコア順に返し、一致したセグメントのスニペットと時刻を添える
+create or replace function search_videos(search_query text, result_limit int default 20)
+returns table (
+  video_id uuid,
+  youtube_id text,
+  youtube_url text,
+  thumbnail_url text,
+  score double precision,
+  matches jsonb
+)
+language sql stable
+as $$
+  with hits as (
+    select v.*, pgroonga_score(v.tableoid, v.ctid) as score
+    from videos v
+    where v.transcription &@~ search_query
+       or v.translation &@~ search_query
+    order by score desc
+    limit result_limit
+  )
+  select
+    h.id,
+    h.youtube_id,
+    h.youtube_url,
+    h.thumbnail_url,
+    h.score,
+    coalesce((
+      select jsonb_agg(jsonb_build_object(
+        'field', 'transcription',
+        'start', (s->>'start')::float8,
+        'end', (s->>'end')::float8,
+        'snippet', array_to_string(
+          pgroonga_snippet_html(s->>'text', pgroonga_query_extract_keywords(search_query)), '…')
+      ))
+      from jsonb_array_elements(coalesce(h.transcription_segments, '[]'::jsonb)) s
+      where (s->>'text') &@~ search_query
+    ), '[]'::jsonb)
+    || case when h.translation &@~ search_query then jsonb_build_array(jsonb_build_object(
+      'field', 'translation',
+      'start', null,
+      'end', null,
+      'snippet', array_to_string(
+        pgroonga_snippet_html(h.translation, pgroonga_query_extract_keywords(search_query)), '…')
+    )) else '[]'::jsonb end
+  from hits h
+  order by h.score desc;
+$$;
@@ -0,0 +1,14 @@
+-- 以前は screenshots / metadata を json.dumps した文字列として jsonb に保存していたため、
+-- 二重エンコードされた行をネイティブな jsonb に戻す
+update projects
+  set screenshots = (screenshots #>> '{}')::jsonb
+  where jsonb_typeof(screenshots) = 'string';
+
+update projects
+  set metadata = (metadata #>> '{}')::jsonb
+  where jsonb_typeof(metadata) = 'string';
+
+-- 完了済みプロジェクトのチェックポイントから文字起こし本文を取り除く（videos 行に保存済み）
+update projects
+  set checkpoints = checkpoints - 'transcription' - 'translation' - 'segments'
+  where status = 'completed';
@@ -0,0 +1,2 @@
+-- 音声の特徴量（波形のピーク・RMS音量・無音区間）
+alter table videos add column if not exists audio_features jsonb;
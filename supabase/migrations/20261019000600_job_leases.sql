@@ -0,0 +1,8 @@
+-- worker.py がprojectsを待ち行列として使うためのリース列
+alter table projects add column if not exists lease_owner text;
+alter table projects add column if not exists lease_expires_at timestamp with time zone;
+alter table projects add column if not exists attempts integer default 0;
+
+-- pending の取り出しとリース切れの検出用
+create index if not exists projects_status_lease_expires_at_idx
+  on projects (status, lease_expires_at);
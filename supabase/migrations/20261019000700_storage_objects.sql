@@ -0,0 +1,32 @@
+-- 内容のSHA-256をキーにしたストレージオブジェクトの台帳（削除の仕組みはないため参照数ではなく登録回数を持つ）
+create table if not exists storage_objects (
+  id uuid default uuid_generate_v4() primary key,
+  bucket text not null,
+  path text not null,
+  sha256 text not null,
+  size bigint,
+  content_type text,
+  upload_count integer default 0,
+  created_at timestamp with time zone default timezone('utc'::text, now()),
+  updated_at timestamp with time zone default timezone('utc'::text, now()),
+  unique (bucket, path)
+);
+
+-- オブジェクトを登録し、既にあれば登録回数を1つ増やす
+create or replace function register_storage_object(
+  p_bucket text,
+  p_path text,
+  p_sha256 text,
+  p_size bigint,
+  p_content_type text
+)
+returns setof storage_objects
+language sql
+as $$
+  insert into storage_objects (bucket, path, sha256, size, content_type, upload_count)
+  values (p_bucket, p_path, p_sha256, p_size, p_content_type, 1)
+  on conflict (bucket, path) do update
+    set upload_count = storage_objects.upload_count + 1,
+        updated_at = timezone('utc'::text, now())
+  returning *;
+$$;
@@ -0,0 +1,4 @@
+-- 翻訳と同じリクエストで生成するショート動画用のタイトル・要約・ハッシュタグ
+alter table videos add column if not exists title text;
+alter table videos add column if not exists summary text;
+alter table videos add column if not exists hashtags jsonb default '[]'::jsonb;
@@ -0,0 +1,27 @@
+-- ユーザーごとに登録する完了・エラー通知のWebhook
+create table if not exists webhooks (
+  id uuid default uuid_generate_v4() primary key,
+  user_id uuid not null,
+  url text not null,
+  secret text not null,
+  created_at timestamp with time zone default timezone('utc'::text, now()),
+  updated_at timestamp with time zone default timezone('utc'::text, now())
+);
+create index if not exists webhooks_user_id_idx on webhooks (user_id);
+
+-- Webhookの配信待ち行列（失敗した配信は next_attempt_at まで待って再試行する）
+create table if not exists webhook_deliveries (
+  id uuid default uuid_generate_v4() primary key,
+  webhook_id uuid references webhooks(id) on delete cascade,
+  project_id uuid,
+  url text not null,
+  event jsonb not null,
+  status text default 'pending' check (status in ('pending', 'delivered', 'failed')),
+  attempts integer default 0,
+  next_attempt_at timestamp with time zone default timezone('utc'::text, now()),
+  last_error text,
+  created_at timestamp with time zone default timezone('utc'::text, now()),
+  updated_at timestamp with time zone default timezone('utc'::text, now())
+);
+create index if not exists webhook_deliveries_status_next_attempt_at_idx
+  on webhook_deliveries (status, next_attempt_at);
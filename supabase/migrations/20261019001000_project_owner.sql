@@ -0,0 +1,9 @@
+-- 履歴APIで持ち主ごとに絞り込むため、metadataのuser_idを列にも持つ
+alter table projects add column if not exists user_id uuid;
+
+update projects
+  set user_id = (metadata->>'user_id')::uuid
+  where user_id is null and metadata->>'user_id' is not null;
+
+create index if not exists projects_user_id_created_at_id_idx
+  on projects (user_id, created_at desc, id desc);
@@ -0,0 +1,45 @@
+-- スニペットはアプリ側でSQLiteと同じ方法（エスケープしてから<mark>で強調）で作るため、一致したテキストをそのまま返す
+create or replace function search_videos(search_query text, result_limit int default 20)
+returns table (
+  video_id uuid,
+  youtube_id text,
+  youtube_url text,
+  thumbnail_url text,
+  score double precision,
+  matches jsonb
+)
+language sql stable
+as $$
+  with hits as (
+    select v.*, pgroonga_score(v.tableoid, v.ctid) as score
+    from videos v
+    where v.transcription &@~ search_query
+       or v.translation &@~ search_query
+    order by score desc
+    limit result_limit
+  )
+  select
+    h.id,
+    h.youtube_id,
+    h.youtube_url,
+    h.thumbnail_url,
+    h.score,
+    coalesce((
+      select jsonb_agg(jsonb_build_object(
+        'field', 'transcription',
+        'start', (s->>'start')::float8,
+        'end', (s->>'end')::float8,
+        'text', s->>'text'
+      ))
+      from jsonb_array_elements(coalesce(h.transcription_segments, '[]'::jsonb)) s
+      where (s->>'text') &@~ search_query
+    ), '[]'::jsonb)
+    || case when h.translation &@~ search_query then jsonb_build_array(jsonb_build_object(
+      'field', 'translation',
+      'start', null,
+      'end', null,
+      'text', h.translation
+    )) else '[]'::jsonb end
+  from hits h
+  order by h.score desc;
+$$;
@@ -0,0 +1,4 @@
+-- webhooksは署名用のsecretを持つため、anonキーでは読み書きできないようにする
+-- ポリシーは置かず、サーバーのservice_roleキーだけが操作する
+alter table webhooks enable row level security;
+alter table webhook_deliveries enable row level security;
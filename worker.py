@@ -0,0 +1,9 @@
+# ジョブ処理ワーカーの起動スクリプト
+# JOB_MODE=queue のWebサーバーが登録したプロジェクトを projects テーブルから確保して処理する
+# 使い方: python worker.py（ノードごとに必要な数だけ起動する）
+import asyncio
+
+from app import run_worker
+
+if __name__ == "__main__":
+    asyncio.run(run_worker())